@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import toml
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# Lower values are served first
+PRIORITIES: Dict[str, int] = {"interactive": 0, "bulk": 1}
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request arrives while the admission queue is full.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Admission queue is full, retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a request's deadline passes before an expensive stage starts.
+    """
+
+
+def check_deadline(deadline: Optional[float], stage: str) -> None:
+    """
+    Raise if the deadline has passed, so that a stage is not started for a
+    caller that has already given up.
+
+    Args:
+        deadline (Optional[float]): time.monotonic() deadline, or None for no deadline.
+        stage (str): the stage about to start, used in the error message.
+
+    Raises:
+        DeadlineExceeded: if the deadline has passed.
+    """
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceeded(f"Deadline passed before {stage}.")
+
+
+class AdmissionController:
+    """
+    Limits how many requests run the generation pipeline at once. Requests
+    beyond max_concurrent wait in a bounded priority queue, ordered by priority
+    class and then arrival, so interactive chat is served before queued bulk
+    traffic. A request arriving to a full queue is rejected immediately with a
+    Retry-After estimate, and a request whose deadline passes while queued
+    leaves the queue without running.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = CONFIG["ADMISSION_MAX_CONCURRENT"],
+        max_queue: int = CONFIG["ADMISSION_MAX_QUEUE"],
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+
+        self._condition = threading.Condition()
+        self._queue = []
+        self._arrivals = itertools.count()
+        self._running = 0
+
+        # Recent wait and service times, in seconds
+        self._waits = {name: deque(maxlen=1000) for name in PRIORITIES}
+        self._service_times = deque(maxlen=100)
+        self._counts = {
+            name: {"admitted": 0, "rejected": 0, "expired": 0} for name in PRIORITIES
+        }
+
+    def _retry_after(self) -> int:
+        # Time for the queue ahead to drain at the recent service rate
+        service_time = (
+            sum(self._service_times) / len(self._service_times)
+            if self._service_times
+            else 10.0
+        )
+        return max(1, math.ceil(service_time * len(self._queue) / self.max_concurrent))
+
+    @contextmanager
+    def admit(
+        self, priority: str = "interactive", deadline: Optional[float] = None
+    ) -> Iterator[float]:
+        """
+        Wait for a slot to run a request, and hold it for the body of the with block.
+
+        Args:
+            priority (str, optional): the request's priority class, one of PRIORITIES.
+                Defaults to "interactive".
+            deadline (Optional[float], optional): time.monotonic() deadline of the
+                request. Defaults to None, for no deadline.
+
+        Raises:
+            AdmissionRejected: if the queue is full.
+            DeadlineExceeded: if the deadline passes while queued.
+
+        Yields:
+            float: seconds the request waited in the queue.
+        """
+        entry = (PRIORITIES[priority], next(self._arrivals))
+        enqueued_at = time.monotonic()
+
+        with self._condition:
+            if len(self._queue) >= self.max_queue:
+                self._counts[priority]["rejected"] += 1
+                raise AdmissionRejected(self._retry_after())
+
+            heapq.heappush(self._queue, entry)
+            try:
+                while not (
+                    self._running < self.max_concurrent and self._queue[0] == entry
+                ):
+                    timeout = None if deadline is None else deadline - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        self._counts[priority]["expired"] += 1
+                        raise DeadlineExceeded("Deadline passed while queued.")
+                    self._condition.wait(timeout)
+            except BaseException:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+                raise
+
+            heapq.heappop(self._queue)
+            self._running += 1
+            self._counts[priority]["admitted"] += 1
+            waited = time.monotonic() - enqueued_at
+            self._waits[priority].append(waited)
+
+        started_at = time.monotonic()
+        try:
+            yield waited
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._service_times.append(time.monotonic() - started_at)
+                self._condition.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the queue depth per priority class, running requests, request counts
+        and recent queue wait times.
+
+        Returns:
+            Dict[str, Any]: admission statistics of this API worker.
+        """
+        with self._condition:
+            depths = {name: 0 for name in PRIORITIES}
+            names = {value: name for name, value in PRIORITIES.items()}
+            for priority, _ in self._queue:
+                depths[names[priority]] += 1
+
+            priorities = {}
+            for name in PRIORITIES:
+                waits = sorted(self._waits[name])
+                priorities[name] = {
+                    "queue_depth": depths[name],
+                    **self._counts[name],
+                    "wait_p50_s": (
+                        round(waits[len(waits) // 2], 3) if waits else None
+                    ),
+                    "wait_p95_s": (
+                        round(waits[min(int(len(waits) * 0.95), len(waits) - 1)], 3)
+                        if waits
+                        else None
+                    ),
+                }
+
+            return {
+                "running": self._running,
+                "max_concurrent": self.max_concurrent,
+                "queue_depth": len(self._queue),
+                "max_queue": self.max_queue,
+                "priorities": priorities,
+            }
+
+
+ADMISSION = AdmissionController()
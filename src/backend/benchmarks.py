@@ -0,0 +1,641 @@
+import argparse
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import toml
+import torch
+
+from languageModels import encode_texts, load_query_encoder
+
+CONFIG = toml.load("config.toml")
+
+
+def _load_eval_questions(eval_file: os.PathLike) -> Dict[str, Dict]:
+    with open(eval_file) as file:
+        return json.load(file)
+
+
+def _latency_ms(func: Callable[[], object], repeats: int) -> Dict[str, float]:
+    """
+    Time repeated calls of a function after one untimed warmup call.
+
+    Args:
+        func (Callable[[], object]): the function to time.
+        repeats (int): number of timed calls.
+
+    Returns:
+        Dict[str, float]: p50, p95 and mean latency in milliseconds.
+    """
+    func()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "p50_ms": round(timings[len(timings) // 2], 2),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 2),
+        "mean_ms": round(statistics.mean(timings), 2),
+    }
+
+
+def _recall_at_k(retrieved: List[int], relevant: List[int]) -> float:
+    if not relevant:
+        return 0.0
+    return len(set(retrieved) & set(relevant)) / len(relevant)
+
+
+def benchmark_encoder(args: argparse.Namespace) -> None:
+    """
+    Compare a query encoder backend against the fp32 reference:
+        - parity: cosine similarity between the two embeddings of each question.
+        - recall: recall@k of the relevant chunks of each question (needs the database).
+        - latency: single-query latency for a range of thread counts.
+    """
+    questions = [
+        test["question"] for test in _load_eval_questions(args.eval_file).values()
+    ]
+
+    reference = load_query_encoder("torch")
+    candidate = load_query_encoder(args.backend)
+
+    # Parity
+    reference_embeddings = encode_texts(*reference, questions)
+    candidate_embeddings = encode_texts(*candidate, questions)
+    similarities = torch.nn.functional.cosine_similarity(
+        reference_embeddings, candidate_embeddings, dim=1
+    )
+    print(
+        f"Parity ({args.backend} vs torch): "
+        f"min cosine={similarities.min().item():.4f}, "
+        f"mean cosine={similarities.mean().item():.4f} "
+        f"[{'PASS' if similarities.min().item() >= args.min_cosine else 'FAIL'}, "
+        f"threshold {args.min_cosine}]"
+    )
+
+    # Recall against the chunks in the database
+    if args.recall:
+        from sqlFunctions import create_connection, vector_search
+
+        engine = create_connection(force_rebuild=False)
+        tests = _load_eval_questions(args.eval_file).values()
+        for name, embeddings in (
+            ("torch", reference_embeddings),
+            (args.backend, candidate_embeddings),
+        ):
+            recalls = []
+            for test, embedding in zip(tests, embeddings):
+                chunks = vector_search(vector=embedding, engine=engine, top_k=args.k)
+                recalls.append(
+                    _recall_at_k([c.chunk_id for c in chunks], test["chunk_ids"])
+                )
+            print(f"Recall@{args.k} ({name}): {statistics.mean(recalls):.3f}")
+
+    # Single-query latency and thread scaling
+    max_threads = os.cpu_count() or 1
+    thread_counts = [n for n in (1, 2, 4, 8, 16) if n <= max_threads]
+    for num_threads in thread_counts:
+        torch.set_num_threads(num_threads)
+        if args.backend == "onnx":
+            candidate = load_query_encoder("onnx", num_threads=num_threads)
+        for name, (tokenizer, model) in (
+            ("torch", reference),
+            (args.backend, candidate),
+        ):
+            latency = _latency_ms(
+                lambda: encode_texts(tokenizer, model, [questions[0]]), args.repeats
+            )
+            print(f"Latency ({name}, {num_threads} threads): {latency}")
+
+
+def _sample_queries_and_exact_neighbours(
+    engine, num_queries: int, k: int
+) -> Tuple[List, List[List[int]]]:
+    """
+    Sample stored chunk embeddings as queries and find their exact nearest
+    chunks with a sequential scan, as ground truth for recall.
+
+    Returns:
+        Tuple[List, List[List[int]]]: the query embeddings and, for each,
+            the ids of its k nearest chunks.
+    """
+    from sqlalchemy import func, select, text
+    from sqlalchemy.orm import Session
+
+    from ormModels import Chunk
+
+    with Session(engine) as session:
+        queries = session.scalars(
+            select(Chunk.embedding).order_by(func.random()).limit(num_queries)
+        ).all()
+
+    exact = []
+    with Session(engine) as session:
+        session.execute(text("SET LOCAL enable_indexscan = off"))
+        for query in queries:
+            exact.append(
+                session.scalars(
+                    select(Chunk.chunk_id)
+                    .order_by(Chunk.embedding.cosine_distance(query))
+                    .limit(k)
+                ).all()
+            )
+    return queries, exact
+
+
+def benchmark_vector_storage(args: argparse.Namespace) -> None:
+    """
+    Build the index of every vector storage mode in turn and report its
+    build time, size, recall@k against an exact scan and search latency.
+    Stored chunk embeddings are used as queries, so no model is needed.
+    The configured VECTOR_INDEX_MODE is restored at the end.
+    """
+    from sqlFunctions import create_connection, vector_search
+    from vectorStorage import embedding_index_size, migrate_embedding_index
+
+    engine = create_connection(force_rebuild=False)
+    queries, exact = _sample_queries_and_exact_neighbours(engine, args.queries, args.k)
+
+    for mode in args.modes:
+        build_seconds = migrate_embedding_index(engine, mode)
+        size = embedding_index_size(engine, mode)
+
+        recalls, timings = [], []
+        for query, truth in zip(queries, exact):
+            start = time.perf_counter()
+            chunks = vector_search(
+                vector=query, engine=engine, top_k=args.k, max_distance=2.0, mode=mode
+            )
+            timings.append((time.perf_counter() - start) * 1000)
+            recalls.append(_recall_at_k([c.chunk_id for c in chunks], truth))
+
+        timings.sort()
+        print(
+            f"{mode}: build={build_seconds:.1f}s, size={size / 2**20:.1f} MiB, "
+            f"recall@{args.k}={statistics.mean(recalls):.3f}, "
+            f"p50={timings[len(timings) // 2]:.2f} ms, "
+            f"p95={timings[int(len(timings) * 0.95) - 1]:.2f} ms"
+        )
+
+    migrate_embedding_index(engine, CONFIG["VECTOR_INDEX_MODE"])
+
+
+def benchmark_retrieval(args: argparse.Namespace) -> None:
+    """
+    Compare the retrieval backends on recall@k against an exact scan and on
+    search latency. The in-memory backends are built in a temporary directory,
+    and their build time is reported too. Each backend is also searched with
+    a selective filter, the article of a sampled chunk, which must return that
+    chunk first.
+    """
+    import tempfile
+
+    from sqlalchemy import func, select
+    from sqlalchemy.orm import Session
+
+    from ormModels import Chunk
+    from pydanticModels import SearchFilters
+    from retrieval import InMemoryBackend, PgVectorBackend
+    from sqlFunctions import create_connection
+
+    engine = create_connection(force_rebuild=False)
+    queries, exact = _sample_queries_and_exact_neighbours(engine, args.queries, args.k)
+    queries = [torch.tensor(query) for query in queries]
+    with Session(engine) as session:
+        filtered = session.execute(
+            select(Chunk.chunk_id, Chunk.article_id, Chunk.embedding)
+            .where(Chunk.embedding.is_not(None))
+            .order_by(func.random())
+            .limit(args.queries)
+        ).all()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.backends:
+            start = time.perf_counter()
+            if name == "pgvector":
+                backend = PgVectorBackend(engine)
+            else:
+                backend = InMemoryBackend(
+                    engine,
+                    directory=Path(directory) / name,
+                    method=name.split("-")[1],
+                    refresh_interval=0,
+                )
+            build_seconds = time.perf_counter() - start
+
+            recalls = [
+                _recall_at_k(
+                    [
+                        c.chunk_id
+                        for c in backend.search(query, top_k=args.k, max_distance=2.0)
+                    ],
+                    truth,
+                )
+                for query, truth in zip(queries, exact)
+            ]
+            filtered_hits = [
+                [
+                    c.chunk_id
+                    for c in backend.search(
+                        torch.tensor(embedding),
+                        top_k=args.k,
+                        max_distance=2.0,
+                        filters=SearchFilters(article_ids=[article_id]),
+                    )
+                ][:1]
+                == [chunk_id]
+                for chunk_id, article_id, embedding in filtered
+            ]
+            query_cycle = itertools.cycle(queries)
+            latency = _latency_ms(
+                lambda: backend.search(next(query_cycle), top_k=args.k), args.repeats
+            )
+            print(
+                f"{name}: build={build_seconds:.1f}s, "
+                f"recall@{args.k}={statistics.mean(recalls):.3f}, "
+                f"filtered={statistics.mean(filtered_hits):.3f}, latency={latency}"
+            )
+
+
+def benchmark_extraction(args: argparse.Namespace) -> None:
+    """
+    Extract each PDF in a fresh interpreter and report its wall time and
+    peak RSS, so the measurement is not skewed by earlier files or models.
+    """
+    script = (
+        "import json, resource, sys, time\n"
+        "from textExtraction import Document\n"
+        "baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+        "start = time.perf_counter()\n"
+        "for _ in range(int(sys.argv[2])):\n"
+        "    Document(sys.argv[1])\n"
+        "print(json.dumps({\n"
+        "    'seconds': (time.perf_counter() - start) / int(sys.argv[2]),\n"
+        "    'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,\n"
+        "    'extraction_rss_mib': (\n"
+        "        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline\n"
+        "    ) / 1024,\n"
+        "}))\n"
+    )
+
+    paths = args.paths or sorted(Path(CONFIG["SOURCES_DIR"]).glob("*.pdf"))
+    for path in paths:
+        output = subprocess.run(
+            [sys.executable, "-c", script, str(path), str(args.repeats)],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        result = json.loads(output)
+        print(
+            f"{Path(path).name}: {result['seconds'] * 1000:.1f} ms, "
+            f"peak RSS {result['peak_rss_mib']:.1f} MiB "
+            f"(+{result['extraction_rss_mib']:.1f} MiB during extraction)"
+        )
+
+
+def benchmark_chunking(args: argparse.Namespace) -> None:
+    """
+    Extract the source PDFs and compare the character splitter with the token
+    chunker: how many character chunks exceed the encoder's window, and how
+    many chunks (forward passes) and tokens per chunk each strategy produces.
+    """
+    from textExtraction import Document
+    from textProcessing import count_truncated_chunks, generate_token_chunks
+
+    paths = args.paths or sorted(Path(CONFIG["SOURCES_DIR"]).glob("*.pdf"))
+    articles = [article for path in paths for article in Document(path).articles]
+
+    truncation = count_truncated_chunks(articles, max_tokens=args.max_tokens)
+    print(
+        f"Character splitter: {truncation['chunks']} chunks, "
+        f"{truncation['truncated_chunks']} truncated "
+        f"({truncation['truncated_tokens']} tokens never embedded)"
+    )
+
+    lengths = [
+        len(chunk["input_ids"])
+        for article in articles
+        for chunk in generate_token_chunks(article, max_tokens=args.max_tokens)
+    ]
+    print(
+        f"Token chunker: {len(lengths)} chunks, "
+        f"mean {statistics.mean(lengths):.0f} tokens, max {max(lengths)} tokens"
+    )
+
+
+def benchmark_rerank(args: argparse.Namespace) -> None:
+    """
+    Rerank the retrieved chunks of each evaluation question with and without
+    the rerank cascade, and compare the cross-encoder pairs scored, the cascade
+    outcomes and how often the cascade keeps the same chunks as a full rerank.
+    """
+    from collections import Counter
+
+    from modelClient import embed_texts
+    from rerankCascade import RerankItem, rerank_candidates
+    from retrieval import get_retrieval_backend
+    from sqlFunctions import create_connection
+
+    engine = create_connection(force_rebuild=False)
+    backend = get_retrieval_backend(engine)
+    questions = [
+        test["question"] for test in _load_eval_questions(args.eval_file).values()
+    ]
+    embeddings = embed_texts(input_type="query", texts=questions)
+    items = [
+        RerankItem(question, embedding, backend.search(embedding, top_k=args.k))
+        for question, embedding in zip(questions, embeddings)
+    ]
+
+    results = {}
+    for cascade in (False, True):
+        start = time.perf_counter()
+        results[cascade] = [
+            rerank_candidates([item], backend, cascade=cascade)[0] for item in items
+        ]
+        seconds = (time.perf_counter() - start) / len(items)
+        pairs = [result.pairs for result in results[cascade]]
+        print(
+            f"{'Cascade' if cascade else 'Full'}: "
+            f"mean {statistics.mean(pairs):.1f} pairs, max {max(pairs)} pairs, "
+            f"{seconds * 1000:.0f} ms per query"
+        )
+
+    outcomes = Counter(result.outcome for result in results[True])
+    same = sum(
+        [c.chunk_id for c in full.chunks] == [c.chunk_id for c in cascade.chunks]
+        for full, cascade in zip(results[False], results[True])
+    )
+    print(f"Cascade outcomes: {dict(outcomes)}")
+    print(f"Same context as a full rerank: {same} of {len(items)} questions")
+
+
+def benchmark_cpu(args: argparse.Namespace) -> None:
+    """
+    Throughput of the models on cpu for a range of intra-op thread counts, with
+    the encoders uncompiled and compiled (see languageModels.CompiledEncoder):
+        - embed: queries per second through the query encoder.
+        - rerank: (query, chunk) pairs per second through the cross-encoder,
+            with chunk-length passages.
+        - generate (with --generate): generated tokens per second of the
+            in-process inference model. Run with DEVICE="cpu" and an
+            unquantized INFERENCE_MODEL, AWQ kernels need a GPU.
+    """
+    from languageModels import (
+        DEVICE,
+        get_generation_backend,
+        load_cross_encoder,
+        score_pairs,
+    )
+
+    tests = list(_load_eval_questions(args.eval_file).values())
+    questions = [test["question"] for test in tests]
+    # Long enough to be truncated to the encoders' 512 token window, like a chunk
+    passage = " ".join(test["sample_answer"] for test in tests)
+    queries = list(itertools.islice(itertools.cycle(questions), args.batch_size))
+    pairs = [(question, passage) for question in queries]
+
+    max_threads = os.cpu_count() or 1
+    thread_counts = args.threads or [n for n in (1, 2, 4, 8, 16) if n <= max_threads]
+    for compiled in (False, True):
+        query_encoder = load_query_encoder("torch", compiled=compiled)
+        cross_encoder = load_cross_encoder(compiled=compiled)
+        for num_threads in thread_counts:
+            torch.set_num_threads(num_threads)
+            embed = _latency_ms(
+                lambda: encode_texts(*query_encoder, queries), args.repeats
+            )
+            rerank = _latency_ms(
+                lambda: score_pairs(*cross_encoder, pairs), args.repeats
+            )
+            print(
+                f"{'Compiled' if compiled else 'Eager'} ({num_threads} threads): "
+                f"embed {len(queries) / embed['mean_ms'] * 1000:.1f} queries/s, "
+                f"rerank {len(pairs) / rerank['mean_ms'] * 1000:.1f} pairs/s"
+            )
+
+    if args.generate:
+        if DEVICE != "cpu":
+            print(f"Generation runs on {DEVICE}, set DEVICE='cpu' to benchmark cpu.")
+        backend = get_generation_backend()
+        backend.load()
+        prompts = questions[: args.batch_size]
+        for num_threads in thread_counts:
+            torch.set_num_threads(num_threads)
+            start = time.perf_counter()
+            generations = backend.generate(
+                prompts, enable_thinking=False, max_new_tokens=args.max_new_tokens
+            )
+            seconds = time.perf_counter() - start
+            tokens = sum(generation.completion_tokens for generation in generations)
+            print(
+                f"Generate ({num_threads} threads, {len(prompts)} prompts): "
+                f"{tokens / seconds:.1f} tokens/s"
+            )
+
+
+def _answer_scores(answers: List[str], references: List[str]) -> Dict[str, List]:
+    """
+    Score answers against reference answers with BLEU and ROUGE, as in
+    notebooks/controlled_testing_metrics.ipynb.
+
+    Returns:
+        Dict[str, List]: the BLEU and ROUGE score of each answer.
+    """
+    import asyncio
+
+    from ragas.dataset_schema import SingleTurnSample
+    from ragas.metrics import BleuScore, RougeScore
+
+    samples = [
+        SingleTurnSample(response=answer, reference=reference)
+        for answer, reference in zip(answers, references)
+    ]
+
+    async def score(scorer) -> List[float]:
+        return [await scorer.single_turn_ascore(sample) for sample in samples]
+
+    return {
+        "bleu": asyncio.run(score(BleuScore())),
+        "rouge": asyncio.run(score(RougeScore())),
+    }
+
+
+def benchmark_compression(args: argparse.Namespace) -> None:
+    """
+    Answer the evaluation questions with their full reranked context and with
+    the compressed context (see contextCompression.py), and compare the
+    context and prompt tokens, the generation time and the answer quality
+    against the sample answers. The questions are used as search queries.
+    """
+    from contextCompression import compress_contexts
+    from modelClient import embed_texts, generate_chat_responses_with_usage
+    from rerankCascade import RerankItem, rerank_candidates
+    from retrieval import get_retrieval_backend
+    from sqlFunctions import create_connection
+
+    engine = create_connection(force_rebuild=False)
+    backend = get_retrieval_backend(engine)
+    tests = list(_load_eval_questions(args.eval_file).values())
+    questions = [test["question"] for test in tests]
+    embeddings = embed_texts(input_type="query", texts=questions)
+    reranked = rerank_candidates(
+        [
+            RerankItem(question, embedding, backend.search(embedding, top_k=args.k))
+            for question, embedding in zip(questions, embeddings)
+        ],
+        backend,
+    )
+    contexts = [result.chunks for result in reranked]
+
+    start = time.perf_counter()
+    compressed = compress_contexts(questions, contexts, budget=args.budget)
+    compress_ms = (time.perf_counter() - start) / len(questions) * 1000
+    ratios = [
+        context.compressed_tokens / context.context_tokens
+        for context in compressed
+        if context.context_tokens
+    ]
+    print(
+        f"Compression: {statistics.mean(ratios):.2f} of the context tokens kept "
+        f"(min {min(ratios):.2f}), {compress_ms:.0f} ms per query"
+    )
+
+    variants = {
+        "Full": ["\n\n".join(chunk.text for chunk in chunks) for chunks in contexts],
+        "Compressed": [context.prompt() for context in compressed],
+    }
+    scores = {}
+    for name, prompts in variants.items():
+        start = time.perf_counter()
+        results = generate_chat_responses_with_usage(questions, prompts)
+        seconds = (time.perf_counter() - start) / len(questions)
+        scores[name] = _answer_scores(
+            [answer for answer, _ in results], [test["sample_answer"] for test in tests]
+        )
+        prompt_tokens = [usage["prompt_tokens"] or 0 for _, usage in results]
+        print(
+            f"{name}: mean {statistics.mean(prompt_tokens):.0f} prompt tokens, "
+            f"{seconds:.2f} s per answer, "
+            f"BLEU {statistics.mean(scores[name]['bleu']):.3f}, "
+            f"ROUGE {statistics.mean(scores[name]['rouge']):.3f}"
+        )
+
+    for metric in ("bleu", "rouge"):
+        deltas = [
+            compressed_score - full_score
+            for full_score, compressed_score in zip(
+                scores["Full"][metric], scores["Compressed"][metric]
+            )
+        ]
+        print(
+            f"{metric.upper()} delta (compressed - full): "
+            f"mean {statistics.mean(deltas):+.3f}, worst {min(deltas):+.3f}, "
+            f"{sum(delta < 0 for delta in deltas)} of {len(deltas)} questions worse"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="MedChat backend benchmarks.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    encoder = subparsers.add_parser(
+        "encoder", help="Query encoder backend parity, recall and latency."
+    )
+    encoder.add_argument("--backend", choices=["int8", "onnx"], default="int8")
+    encoder.add_argument("--eval-file", default="../../notebooks/eval_tests.json")
+    encoder.add_argument("--min-cosine", type=float, default=0.99)
+    encoder.add_argument("--recall", action="store_true")
+    encoder.add_argument("--k", type=int, default=10)
+    encoder.add_argument("--repeats", type=int, default=100)
+    encoder.set_defaults(func=benchmark_encoder)
+
+    vector_storage = subparsers.add_parser(
+        "vector-storage",
+        help="Index size, build time, recall and latency of each vector storage mode.",
+    )
+    vector_storage.add_argument(
+        "--modes", nargs="+", default=["vector", "halfvec", "binary"]
+    )
+    vector_storage.add_argument("--queries", type=int, default=100)
+    vector_storage.add_argument("--k", type=int, default=10)
+    vector_storage.set_defaults(func=benchmark_vector_storage)
+
+    retrieval = subparsers.add_parser(
+        "retrieval", help="Recall and latency of each retrieval backend."
+    )
+    retrieval.add_argument(
+        "--backends",
+        nargs="+",
+        choices=["pgvector", "memory-exact", "memory-hnsw"],
+        default=["pgvector", "memory-exact", "memory-hnsw"],
+    )
+    retrieval.add_argument("--queries", type=int, default=100)
+    retrieval.add_argument("--k", type=int, default=10)
+    retrieval.add_argument("--repeats", type=int, default=100)
+    retrieval.set_defaults(func=benchmark_retrieval)
+
+    extraction = subparsers.add_parser(
+        "extraction", help="Wall time and peak RSS of PDF text extraction."
+    )
+    extraction.add_argument(
+        "paths", nargs="*", help="PDFs to extract. Defaults to the sources directory."
+    )
+    extraction.add_argument("--repeats", type=int, default=5)
+    extraction.set_defaults(func=benchmark_extraction)
+
+    chunking = subparsers.add_parser(
+        "chunking", help="Truncated chunks of the character splitter vs the token chunker."
+    )
+    chunking.add_argument(
+        "paths", nargs="*", help="PDFs to chunk. Defaults to the sources directory."
+    )
+    chunking.add_argument("--max-tokens", type=int, default=CONFIG["CHUNK_MAX_TOKENS"])
+    chunking.set_defaults(func=benchmark_chunking)
+
+    rerank = subparsers.add_parser(
+        "rerank", help="Cross-encoder pairs and context of the rerank cascade vs a full rerank."
+    )
+    rerank.add_argument("--eval-file", default="../../notebooks/eval_tests.json")
+    rerank.add_argument("--k", type=int, default=CONFIG["RETRIEVAL_TOP_K"])
+    rerank.set_defaults(func=benchmark_rerank)
+
+    cpu = subparsers.add_parser(
+        "cpu", help="Embed, rerank and generate throughput on cpu, eager vs compiled."
+    )
+    cpu.add_argument("--eval-file", default="../../notebooks/eval_tests.json")
+    cpu.add_argument(
+        "--threads", type=int, nargs="+", help="Defaults to 1, 2, 4, 8 and 16."
+    )
+    cpu.add_argument("--batch-size", type=int, default=CONFIG["RETRIEVAL_TOP_K"])
+    cpu.add_argument("--repeats", type=int, default=20)
+    cpu.add_argument("--generate", action="store_true")
+    cpu.add_argument("--max-new-tokens", type=int, default=64)
+    cpu.set_defaults(func=benchmark_cpu)
+
+    compression = subparsers.add_parser(
+        "compression",
+        help="Context tokens and answer quality with and without context compression.",
+    )
+    compression.add_argument("--eval-file", default="../../notebooks/eval_tests.json")
+    compression.add_argument("--k", type=int, default=CONFIG["RETRIEVAL_TOP_K"])
+    compression.add_argument(
+        "--budget", type=int, default=CONFIG["COMPRESSION_TOKEN_BUDGET"]
+    )
+    compression.set_defaults(func=benchmark_compression)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
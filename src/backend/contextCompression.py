@@ -0,0 +1,191 @@
+import logging
+import re
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import toml
+
+from modelClient import rerank_pairs
+from ormModels import Chunk
+from textProcessing import get_chunk_tokenizer
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# A sentence ends with ., ! or ? followed by whitespace and a capital or a digit
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9])")
+# Marks the sentences dropped between two kept ones
+GAP = " ... "
+
+
+@dataclass
+class CompressedContext:
+    """
+    The context of one query, with only its most relevant sentences kept.
+
+    Attributes:
+        chunks (List[Chunk]): the reranked chunks, unchanged, for citation.
+        texts (List[str]): the kept sentences of each chunk in their original
+            order, empty if none of them was kept.
+        context_tokens (int): tokens of the chunks' sentences.
+        compressed_tokens (int): tokens of the kept sentences.
+    """
+
+    chunks: List[Chunk]
+    texts: List[str]
+    context_tokens: int
+    compressed_tokens: int
+
+    def prompt(self) -> str:
+        """
+        Get the context passed to the chat prompt: the kept sentences of each
+        chunk, one chunk per paragraph.
+
+        Returns:
+            str: the compressed context.
+        """
+        return "\n\n".join(text for text in self.texts if text)
+
+
+def split_sentences(
+    text: str, min_chars: int = CONFIG["COMPRESSION_MIN_SENTENCE_CHARS"]
+) -> List[str]:
+    """
+    Split a chunk into sentences. Line breaks left by PDF extraction are
+    joined, and fragments shorter than min_chars (e.g. "Fig. 2.") are joined
+    to the sentence before them.
+
+    Args:
+        text (str): the chunk text.
+        min_chars (int, optional): shortest sentence kept on its own.
+            Defaults to CONFIG["COMPRESSION_MIN_SENTENCE_CHARS"].
+
+    Returns:
+        List[str]: the sentences, in order.
+    """
+    sentences = []
+    for sentence in _SENTENCE_END.split(" ".join(text.split())):
+        if sentences and len(sentence) < min_chars:
+            sentences[-1] = f"{sentences[-1]} {sentence}"
+        else:
+            sentences.append(sentence)
+    return sentences
+
+
+def _select(scores: List[float], tokens: List[int], budget: int) -> List[bool]:
+    """
+    Keep the highest scoring sentences that fit in the token budget, or the
+    best sentence alone if none fits.
+    """
+    kept = [False] * len(scores)
+    used = 0
+    for index in sorted(range(len(scores)), key=lambda i: -scores[i]):
+        if used + tokens[index] <= budget:
+            kept[index] = True
+            used += tokens[index]
+    if scores and not any(kept):
+        kept[max(range(len(scores)), key=lambda i: scores[i])] = True
+    return kept
+
+
+def _join(sentences: List[Tuple[int, str]]) -> str:
+    # Consecutive kept sentences are joined with a space, gaps with GAP
+    text = ""
+    for position, (index, sentence) in enumerate(sentences):
+        if position:
+            text += " " if index == sentences[position - 1][0] + 1 else GAP
+        text += sentence
+    return text
+
+
+def compress_contexts(
+    queries: List[str],
+    contexts: List[List[Chunk]],
+    budget: int = CONFIG["COMPRESSION_TOKEN_BUDGET"],
+) -> List[CompressedContext]:
+    """
+    Compress the reranked context of each query: split its chunks into
+    sentences, score every (query, sentence) pair of every query with the
+    cross-encoder in one batched call, and keep the best sentences of each
+    context, in their original order, within a token budget. Contexts already
+    within the budget are kept whole and not scored. Tokens are counted with
+    the chunk tokenizer.
+
+    Args:
+        queries (List[str]): the search queries.
+        contexts (List[List[Chunk]]): the reranked chunks of each query.
+        budget (int, optional): tokens kept per context.
+            Defaults to CONFIG["COMPRESSION_TOKEN_BUDGET"].
+
+    Returns:
+        List[CompressedContext]: the compressed context of each query, in order.
+    """
+    tokenizer = get_chunk_tokenizer()
+
+    # (chunk index, sentence) of every sentence of each context
+    sentences = [
+        [
+            (position, sentence)
+            for position, chunk in enumerate(chunks)
+            for sentence in split_sentences(chunk.text)
+        ]
+        for chunks in contexts
+    ]
+    flat = [sentence for context in sentences for _, sentence in context]
+    lengths = [
+        len(ids)
+        for ids in (
+            tokenizer(flat, add_special_tokens=False, verbose=False)["input_ids"]
+            if flat
+            else []
+        )
+    ]
+    tokens, offset = [], 0
+    for context in sentences:
+        tokens.append(lengths[offset : offset + len(context)])
+        offset += len(context)
+
+    # Score the sentences of the contexts over the budget, in one call
+    over_budget = [i for i, counts in enumerate(tokens) if sum(counts) > budget]
+    pairs = [
+        (queries[i], sentence) for i in over_budget for _, sentence in sentences[i]
+    ]
+    flat_scores = rerank_pairs(pairs).tolist() if pairs else []
+    scores, offset = {}, 0
+    for i in over_budget:
+        scores[i] = flat_scores[offset : offset + len(sentences[i])]
+        offset += len(sentences[i])
+
+    compressed = []
+    for i, chunks in enumerate(contexts):
+        kept = (
+            _select(scores[i], tokens[i], budget)
+            if i in scores
+            else [True] * len(sentences[i])
+        )
+        texts = []
+        for position in range(len(chunks)):
+            texts.append(
+                _join(
+                    [
+                        (index, sentence)
+                        for index, (chunk, sentence) in enumerate(sentences[i])
+                        if chunk == position and kept[index]
+                    ]
+                )
+            )
+        compressed.append(
+            CompressedContext(
+                chunks=chunks,
+                texts=texts,
+                context_tokens=sum(tokens[i]),
+                compressed_tokens=sum(
+                    count for count, keep in zip(tokens[i], kept) if keep
+                ),
+            )
+        )
+        logger.info(
+            f"Compressed context {i} from {compressed[-1].context_tokens} to "
+            f"{compressed[-1].compressed_tokens} tokens."
+        )
+    return compressed
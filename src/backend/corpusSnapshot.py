@@ -0,0 +1,496 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional
+
+import numpy as np
+import toml
+from sqlalchemy import Engine, insert, select
+from sqlalchemy.orm import Session
+
+from ormModels import Article, Chunk, ChunkArticle, ChunkSignature, File
+from sqlFunctions import get_files
+from textProcessing import file_hash
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the layout of a snapshot changes
+FORMAT_VERSION = 1
+EMBEDDING_DIM = 768
+EMBEDDINGS_FILE = "embeddings.f16"
+MANIFEST_FILE = "manifest.json"
+# Snapshot tables in insertion order, and the columns exported from each.
+# Ids are exported to link the rows, new ones are assigned on import.
+TABLES = {
+    "files": (
+        File,
+        [
+            "file_id",
+            "file_path",
+            "filename",
+            "file_type",
+            "created_at",
+            "modified_at",
+            "content_hash",
+        ],
+    ),
+    "articles": (
+        Article,
+        ["article_id", "file_id", "start_page", "end_page", "title", "authors", "body"],
+    ),
+    "chunks": (Chunk, ["chunk_id", "article_id", "text"]),
+    "chunk_articles": (ChunkArticle, ["chunk_id", "article_id"]),
+    "chunk_signatures": (ChunkSignature, ["chunk_id", "content_hash", "minhash"]),
+}
+
+
+@lru_cache
+def encoder_version(model: str = CONFIG["ARTICLE_EMBEDDING_MODEL"]) -> Dict[str, Any]:
+    """
+    Identify the article encoder and chunking settings that produced the
+    embeddings of a corpus. Embeddings of a snapshot are only reused by a
+    deployment with the same version.
+
+    Args:
+        model (str, optional): the article encoder.
+            Defaults to CONFIG["ARTICLE_EMBEDDING_MODEL"].
+
+    Returns:
+        Dict[str, Any]: the model, a SHA-256 of its config and weight files (its
+            name if it is not a local directory) and the chunking settings.
+    """
+    digest = hashlib.sha256()
+    directory = Path(model)
+    files = sorted(
+        path
+        for pattern in ("config.json", "*.safetensors", "*.bin")
+        for path in (directory.glob(pattern) if directory.is_dir() else [])
+    )
+    for path in files:
+        digest.update(path.name.encode())
+        digest.update(file_hash(path).encode())
+    return {
+        "model": directory.name,
+        "model_hash": digest.hexdigest() if files else directory.name,
+        "chunker": CONFIG["CHUNKER"],
+        "chunk_max_tokens": CONFIG["CHUNK_MAX_TOKENS"],
+        "chunk_overlap_tokens": CONFIG["CHUNK_OVERLAP_TOKENS"],
+    }
+
+
+def _arrow_schema(table: str) -> Any:
+    import pyarrow as pa
+
+    arrow_types = {
+        int: pa.int64(),
+        str: pa.string(),
+        bytes: pa.binary(),
+        datetime: pa.timestamp("us"),
+    }
+    orm, columns = TABLES[table]
+    return pa.schema(
+        [
+            (name, arrow_types[orm.__table__.columns[name].type.python_type])
+            for name in columns
+        ]
+    )
+
+
+def _export_table(
+    session: Session,
+    table: str,
+    directory: Path,
+    batch_size: int,
+    embeddings: Optional[BinaryIO] = None,
+) -> int:
+    """
+    Write the rows of a table to a zstd compressed Parquet file. The chunks'
+    embeddings are appended to the raw float16 embeddings file, in chunk order.
+
+    Returns:
+        int: number of rows written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    orm, columns = TABLES[table]
+    schema = _arrow_schema(table)
+    key = orm.__table__.primary_key.columns.values()
+    selected = [orm.__table__.columns[name] for name in columns]
+    if table == "chunks":
+        selected.append(Chunk.embedding)
+
+    result = session.execute(
+        select(*selected).order_by(*key).execution_options(yield_per=batch_size)
+    )
+    rows = 0
+    with pq.ParquetWriter(
+        directory / f"{table}.parquet", schema, compression="zstd"
+    ) as writer:
+        for batch in result.partitions():
+            writer.write_table(
+                pa.Table.from_pylist(
+                    [dict(zip(columns, row)) for row in batch], schema=schema
+                )
+            )
+            if table == "chunks":
+                # Chunks without an embedding are written as NaN rows
+                np.asarray(
+                    [
+                        row[-1] if row[-1] is not None else [np.nan] * EMBEDDING_DIM
+                        for row in batch
+                    ],
+                    dtype=np.float16,
+                ).tofile(embeddings)
+            rows += len(batch)
+    return rows
+
+
+def export_snapshot(
+    engine: Engine,
+    snapshot_dir: Path = Path(CONFIG["SNAPSHOT_DIR"]),
+    batch_size: int = CONFIG["SNAPSHOT_BATCH_SIZE"],
+) -> Path:
+    """
+    Export the ingested corpus (files, articles, chunks, their article links
+    and duplicate signatures) to a new snapshot directory:
+        - one zstd compressed Parquet file per table.
+        - embeddings.f16: the chunk embeddings as a raw row-major float16 array
+            of shape (chunks, EMBEDDING_DIM), in the order of chunks.parquet.
+        - manifest.json: the format version, the encoder version (see
+            encoder_version), row counts, the SHA-256 of each data file and
+            the content hash of each source file.
+    The snapshot is written under a temporary name and renamed once complete.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        snapshot_dir (Path, optional): where to create the snapshot.
+            Defaults to Path(CONFIG["SNAPSHOT_DIR"]).
+        batch_size (int, optional): rows read and written at once.
+            Defaults to CONFIG["SNAPSHOT_BATCH_SIZE"].
+
+    Returns:
+        Path: the snapshot directory.
+    """
+    backfill_file_hashes(engine)
+
+    path = snapshot_dir / f"snapshot-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    temporary = path.with_name(f"{path.name}.tmp")
+    temporary.mkdir(parents=True)
+
+    counts = {}
+    # REPEATABLE READ, so every table is read from the same state of the corpus
+    with Session(engine) as session, open(temporary / EMBEDDINGS_FILE, "wb") as file:
+        session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        for table in TABLES:
+            counts[table] = _export_table(
+                session, table, temporary, batch_size, embeddings=file
+            )
+            logger.info(f"Exported {counts[table]} {table}.")
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "created_at": datetime.now().isoformat(),
+        "encoder": encoder_version(),
+        "embedding_dim": EMBEDDING_DIM,
+        "embedding_dtype": "float16",
+        "counts": counts,
+        "checksums": {
+            name: file_hash(temporary / name)
+            for name in [*(f"{table}.parquet" for table in TABLES), EMBEDDINGS_FILE]
+        },
+        "files": {
+            file.filename: file.content_hash
+            for file in get_files(engine)
+            if file.content_hash is not None
+        },
+    }
+    with open(temporary / MANIFEST_FILE, "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    os.replace(temporary, path)
+    logger.info(f"Exported snapshot to {path}.")
+    return path
+
+
+def backfill_file_hashes(engine: Engine) -> int:
+    """
+    Hash the source files ingested before files had a content hash, where
+    they still exist.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+
+    Returns:
+        int: number of files hashed.
+    """
+    hashed = 0
+    with Session(engine) as session:
+        for file in session.scalars(select(File).where(File.content_hash.is_(None))):
+            if os.path.exists(file.file_path):
+                file.content_hash = file_hash(file.file_path)
+                hashed += 1
+        session.commit()
+    return hashed
+
+
+def read_manifest(path: Path) -> Dict[str, Any]:
+    """
+    Read and check the manifest of a snapshot.
+
+    Args:
+        path (Path): the snapshot directory.
+
+    Raises:
+        ValueError: if the snapshot format is not supported.
+
+    Returns:
+        Dict[str, Any]: the manifest, see export_snapshot.
+    """
+    with open(path / MANIFEST_FILE) as file:
+        manifest = json.load(file)
+    if manifest["format_version"] != FORMAT_VERSION:
+        raise ValueError(
+            f"Snapshot format {manifest['format_version']} is not supported, "
+            f"expected {FORMAT_VERSION}."
+        )
+    return manifest
+
+
+def _verify_checksums(path: Path, manifest: Dict[str, Any]) -> None:
+    for name, checksum in manifest["checksums"].items():
+        if file_hash(path / name) != checksum:
+            raise ValueError(f"Snapshot file {path / name} is corrupt.")
+
+
+def _read_table(
+    path: Path, table: str, batch_size: int
+) -> Iterator[List[Dict[str, Any]]]:
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path / f"{table}.parquet").iter_batches(batch_size):
+        yield batch.to_pylist()
+
+
+def _files_to_import(
+    engine: Engine, files: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Keep the snapshot files not ingested yet whose source, if present, still
+    has the content hash recorded in the snapshot. Changed sources are left
+    to the regular ingestion.
+    """
+    existing = get_files(engine)
+    filenames = {file.filename for file in existing}
+    hashes = {file.content_hash for file in existing if file.content_hash}
+
+    selected = []
+    for file in files:
+        if file["filename"] in filenames or file["content_hash"] in hashes:
+            continue
+        if os.path.exists(file["file_path"]) and (
+            file["content_hash"] is None
+            or file_hash(file["file_path"]) != file["content_hash"]
+        ):
+            logger.info(f"Skipping {file['filename']}, its source has changed.")
+            continue
+        selected.append(file)
+    return selected
+
+
+def _insert(session: Session, key: Any, rows: List[Dict[str, Any]]) -> List[int]:
+    # Insert the rows of key's table, returning their new ids in row order
+    return session.scalars(
+        insert(key.class_).returning(key, sort_by_parameter_order=True), rows
+    ).all()
+
+
+def _import_rows(
+    session: Session,
+    path: Path,
+    manifest: Dict[str, Any],
+    files: List[Dict[str, Any]],
+    batch_size: int,
+    counts: Dict[str, int],
+) -> None:
+    """
+    Insert the files, and the articles, chunks, links and signatures that
+    belong to them, with new ids. Counts the rows inserted per table.
+    """
+    # Snapshot ids to the ids of the inserted rows
+    file_ids = dict(
+        zip(
+            [file.pop("file_id") for file in files],
+            _insert(session, File.file_id, files),
+        )
+    )
+    counts["files"] = len(file_ids)
+
+    article_ids = {}
+    for batch in _read_table(path, "articles", batch_size):
+        batch = [article for article in batch if article["file_id"] in file_ids]
+        for article in batch:
+            article["file_id"] = file_ids[article["file_id"]]
+        if batch:
+            old_ids = [article.pop("article_id") for article in batch]
+            article_ids.update(
+                zip(old_ids, _insert(session, Article.article_id, batch))
+            )
+    counts["articles"] = len(article_ids)
+
+    # Read in batches, the whole array does not need to fit in memory
+    embeddings = (
+        np.memmap(
+            path / EMBEDDINGS_FILE,
+            dtype=np.float16,
+            mode="r",
+            shape=(manifest["counts"]["chunks"], manifest["embedding_dim"]),
+        )
+        if manifest["counts"]["chunks"]
+        else np.empty((0, manifest["embedding_dim"]), dtype=np.float16)
+    )
+    chunk_ids, offset = {}, 0
+    for batch in _read_table(path, "chunks", batch_size):
+        vectors = embeddings[offset : offset + len(batch)].astype(np.float32)
+        offset += len(batch)
+        selected = []
+        for chunk, vector in zip(batch, vectors):
+            if chunk["article_id"] in article_ids:
+                chunk["article_id"] = article_ids[chunk["article_id"]]
+                chunk["embedding"] = None if np.isnan(vector).any() else vector
+                selected.append(chunk)
+        if selected:
+            old_ids = [chunk.pop("chunk_id") for chunk in selected]
+            chunk_ids.update(zip(old_ids, _insert(session, Chunk.chunk_id, selected)))
+    counts["chunks"] = len(chunk_ids)
+
+    # The links and signatures of the imported chunks, with their new ids
+    ids = {"chunk_id": chunk_ids, "article_id": article_ids}
+    for table in ("chunk_articles", "chunk_signatures"):
+        orm, _ = TABLES[table]
+        for batch in _read_table(path, table, batch_size):
+            rows = [
+                {
+                    name: ids[name][value] if name in ids else value
+                    for name, value in row.items()
+                }
+                for row in batch
+                if all(row[name] in ids[name] for name in ids if name in row)
+            ]
+            if rows:
+                session.execute(insert(orm), rows)
+                counts[table] += len(rows)
+
+
+def import_snapshot(
+    engine: Engine,
+    path: Path = Path(CONFIG["SNAPSHOT_IMPORT_PATH"]),
+    batch_size: int = CONFIG["SNAPSHOT_BATCH_SIZE"],
+) -> Dict[str, int]:
+    """
+    Bulk load the corpus of a snapshot, so its sources are not extracted and
+    embedded again. Nothing is imported if the snapshot was embedded with
+    another encoder or chunking settings (see encoder_version). Files already
+    ingested, and files whose source has changed since the export, are
+    skipped. New ids are assigned to the imported rows.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        path (Path, optional): the snapshot directory.
+            Defaults to Path(CONFIG["SNAPSHOT_IMPORT_PATH"]).
+        batch_size (int, optional): rows read and inserted at once.
+            Defaults to CONFIG["SNAPSHOT_BATCH_SIZE"].
+
+    Raises:
+        ValueError: if the snapshot format is not supported or a file is corrupt.
+
+    Returns:
+        Dict[str, int]: number of rows imported per table.
+    """
+    manifest = read_manifest(path)
+    counts = {table: 0 for table in TABLES}
+    if manifest["encoder"] != encoder_version():
+        logger.warning(
+            f"Snapshot {path} was embedded with {manifest['encoder']}, not "
+            f"{encoder_version()}. Its sources will be ingested from scratch."
+        )
+        return counts
+    _verify_checksums(path, manifest)
+
+    files = [row for batch in _read_table(path, "files", batch_size) for row in batch]
+    files = _files_to_import(engine, files)
+    if not files:
+        logger.info(f"Every file of snapshot {path} is already ingested.")
+        return counts
+
+    # One transaction, so an interrupted import leaves no files without their
+    # chunks behind: those would be skipped by every later import and ingestion
+    with Session(engine) as session:
+        with session.begin():
+            _import_rows(session, path, manifest, files, batch_size, counts)
+
+    logger.info(f"Imported snapshot {path}: {counts}.")
+    return counts
+
+
+def prune_snapshots(
+    snapshot_dir: Path = Path(CONFIG["SNAPSHOT_DIR"]), keep: int = 3
+) -> List[Path]:
+    """
+    Delete all but the newest snapshots, and any left incomplete.
+
+    Args:
+        snapshot_dir (Path, optional): the snapshots directory.
+            Defaults to Path(CONFIG["SNAPSHOT_DIR"]).
+        keep (int, optional): number of snapshots kept. Defaults to 3.
+
+    Returns:
+        List[Path]: the deleted snapshots.
+    """
+    snapshots = sorted(snapshot_dir.glob("snapshot-*"))
+    complete = [path for path in snapshots if path.suffix != ".tmp"]
+    deleted = [path for path in snapshots if path.suffix == ".tmp"]
+    deleted += complete[: max(len(complete) - keep, 0)]
+    for path in deleted:
+        shutil.rmtree(path)
+    return deleted
+
+
+def main() -> None:
+    from sqlFunctions import create_connection
+
+    parser = argparse.ArgumentParser(
+        description="Export the ingested corpus to a snapshot, or bulk load one."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser("export", help="Write a new snapshot.")
+    export.add_argument("--snapshot-dir", type=Path, default=CONFIG["SNAPSHOT_DIR"])
+    export.add_argument(
+        "--keep", type=int, help="Delete all but this many newest snapshots."
+    )
+
+    load = subparsers.add_parser("import", help="Bulk load a snapshot.")
+    load.add_argument("path", type=Path)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    engine = create_connection(force_rebuild=False)
+
+    if args.command == "export":
+        print(export_snapshot(engine, snapshot_dir=args.snapshot_dir))
+        if args.keep is not None:
+            prune_snapshots(args.snapshot_dir, keep=args.keep)
+    else:
+        print(import_snapshot(engine, path=args.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+import hashlib
+import logging
+import re
+import threading
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import toml
+from sqlalchemy import Engine, func, select
+from sqlalchemy.orm import Session
+
+from ormModels import Chunk, ChunkArticle, ChunkSignature
+from sqlFunctions import insert_data
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# Mersenne prime modulus of the MinHash permutations, so that a * x + b
+# fits in 64 bits for 31 bit shingle hashes
+_PRIME = (1 << 31) - 1
+
+
+def normalise_text(text: str) -> str:
+    """
+    Lowercase the text and collapse whitespace, so chunks extracted from
+    differently laid out copies of a paper compare equal.
+    """
+    return " ".join(text.lower().split())
+
+
+def content_hash(text: str) -> str:
+    """
+    SHA-256 hex digest of the normalised text, identifying exact duplicates.
+    """
+    return hashlib.sha256(normalise_text(text).encode()).hexdigest()
+
+
+class ChunkDeduplicator:
+    """
+    Finds chunks that repeat, exactly or nearly, a chunk seen before, so only
+    the first (canonical) copy is embedded and stored.
+
+    Exact duplicates share the SHA-256 hash of their normalised text. Near
+    duplicates are found with MinHash and locality sensitive hashing (LSH): each
+    chunk's set of word shingles is summarised by num_perm MinHash values, split
+    into bands. Chunks sharing any band are candidates, and a candidate is a
+    duplicate if the share of equal MinHash values (an estimate of the Jaccard
+    similarity of their shingles) is at least threshold.
+
+    Canonical chunks are identified by their content hash. Thread safe, so
+    the chunk workers of the ingestion pipeline can share one instance.
+    """
+
+    def __init__(
+        self,
+        threshold: float = CONFIG["DEDUP_THRESHOLD"],
+        shingle_size: int = CONFIG["DEDUP_SHINGLE_SIZE"],
+        num_perm: int = CONFIG["DEDUP_NUM_PERM"],
+        bands: int = CONFIG["DEDUP_BANDS"],
+        seed: int = 0,
+    ):
+        if num_perm % bands:
+            raise ValueError("DEDUP_NUM_PERM must be a multiple of DEDUP_BANDS.")
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands = bands
+        self.rows = num_perm // bands
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)
+
+        self._lock = threading.Lock()
+        self._hashes = set()
+        self._signatures: Dict[str, np.ndarray] = {}
+        self._buckets: Dict[Tuple[int, bytes], List[str]] = {}
+
+        # (canonical content hash, article_id) of the duplicates found and
+        # not linked to their canonical chunk yet
+        self.duplicates: List[Tuple[str, int]] = []
+        self.counts = {"unique": 0, "exact": 0, "near": 0, "linked": 0}
+
+    def signature(self, text: str) -> np.ndarray:
+        """
+        MinHash signature of the word shingles of a text.
+
+        Args:
+            text (str): the chunk text.
+
+        Returns:
+            np.ndarray: num_perm uint32 MinHash values.
+        """
+        words = re.findall(r"\w+", text.lower())
+        n = self.shingle_size
+        shingles = {
+            " ".join(words[i : i + n]) for i in range(max(len(words) - n + 1, 1))
+        }
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode()) % _PRIME for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        permuted = (np.outer(hashes, self._a) + self._b) % _PRIME
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        return [
+            (band, signature[band * self.rows : (band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    def _register(self, key: str, signature: np.ndarray) -> None:
+        self._hashes.add(key)
+        self._signatures[key] = signature
+        for band_key in self._band_keys(signature):
+            self._buckets.setdefault(band_key, []).append(key)
+
+    def _find_near_duplicate(self, signature: np.ndarray) -> Optional[str]:
+        candidates = {
+            key
+            for band_key in self._band_keys(signature)
+            for key in self._buckets.get(band_key, ())
+        }
+        best, best_similarity = None, self.threshold
+        for key in candidates:
+            similarity = float(np.mean(self._signatures[key] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = key, similarity
+        return best
+
+    def check(self, chunk: Dict[str, Any]) -> bool:
+        """
+        Check whether a chunk duplicates one seen before. A duplicate is recorded
+        in duplicates against its canonical chunk. Otherwise the chunk becomes
+        canonical, and its "content_hash" and "minhash" are added to it.
+
+        Args:
+            chunk (Dict[str, Any]): chunk data with "article_id" and "text".
+
+        Returns:
+            bool: whether the chunk is a duplicate.
+        """
+        key = content_hash(chunk["text"])
+
+        with self._lock:
+            if key in self._hashes:
+                self.duplicates.append((key, chunk["article_id"]))
+                self.counts["exact"] += 1
+                return True
+
+        signature = self.signature(chunk["text"])
+        with self._lock:
+            # Another worker may have registered the same text meanwhile
+            canonical = key if key in self._hashes else None
+            if canonical is None:
+                canonical = self._find_near_duplicate(signature)
+            if canonical is not None:
+                self.duplicates.append((canonical, chunk["article_id"]))
+                self.counts["exact" if canonical == key else "near"] += 1
+                return True
+
+            self._register(key, signature)
+            self.counts["unique"] += 1
+
+        chunk["content_hash"] = key
+        chunk["minhash"] = signature.tobytes()
+        return False
+
+    def load(self, engine: Engine) -> None:
+        """
+        Register the chunks already in the database. Chunks stored before
+        deduplication was enabled get their signatures and article links
+        computed first.
+
+        Args:
+            engine (Engine): SQLAlchemy engine for database operations.
+        """
+        with Session(engine) as session:
+            missing = session.execute(
+                select(Chunk.chunk_id, Chunk.article_id, Chunk.text)
+                .outerjoin(ChunkSignature, Chunk.chunk_id == ChunkSignature.chunk_id)
+                .where(ChunkSignature.chunk_id.is_(None))
+                .order_by(Chunk.chunk_id)
+            ).all()
+        if missing:
+            logger.info(f"Computing deduplication signatures of {len(missing)} chunks.")
+            insert_data(
+                engine,
+                ChunkSignature,
+                [
+                    {
+                        "chunk_id": chunk_id,
+                        "content_hash": content_hash(text),
+                        "minhash": self.signature(text).tobytes(),
+                    }
+                    for chunk_id, _, text in missing
+                ],
+            )
+            link_articles(
+                engine, [(chunk_id, article_id) for chunk_id, article_id, _ in missing]
+            )
+
+        with Session(engine) as session:
+            rows = session.execute(
+                select(ChunkSignature.content_hash, ChunkSignature.minhash)
+                .order_by(ChunkSignature.chunk_id)
+                .execution_options(yield_per=10000)
+            )
+            with self._lock:
+                for key, minhash in rows:
+                    if key not in self._hashes:
+                        self._register(key, np.frombuffer(minhash, dtype=np.uint32))
+        logger.info(f"Loaded {len(self._hashes)} canonical chunks for deduplication.")
+
+    def link_duplicates(self, engine: Engine) -> int:
+        """
+        Link the articles of the duplicates found to their canonical chunks,
+        for the canonical chunks inserted so far. Duplicates of chunks not
+        inserted yet are kept for a later call. Run after every insert of
+        chunks, so links are stored as soon as possible and survive a failed
+        ingestion.
+
+        Args:
+            engine (Engine): SQLAlchemy engine for database operations.
+
+        Returns:
+            int: number of links added.
+        """
+        with self._lock:
+            duplicates = list(self.duplicates)
+        if not duplicates:
+            return 0
+
+        with Session(engine) as session:
+            # Chunks stored before deduplication may share a hash, use the first
+            chunk_ids = dict(
+                session.execute(
+                    select(ChunkSignature.content_hash, func.min(ChunkSignature.chunk_id))
+                    .where(ChunkSignature.content_hash.in_({key for key, _ in duplicates}))
+                    .group_by(ChunkSignature.content_hash)
+                ).all()
+            )
+        added = link_articles(
+            engine,
+            [
+                (chunk_ids[key], article_id)
+                for key, article_id in duplicates
+                if key in chunk_ids
+            ],
+        )
+
+        with self._lock:
+            # Duplicates found meanwhile were appended after the ones handled here
+            self.duplicates = [
+                (key, article_id)
+                for key, article_id in duplicates
+                if key not in chunk_ids
+            ] + self.duplicates[len(duplicates) :]
+            self.counts["linked"] += added
+        return added
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the number of unique, exact duplicate and near duplicate chunks seen,
+        and of the links added from duplicates to their canonical chunks.
+
+        Returns:
+            Dict[str, int]: chunk counts.
+        """
+        with self._lock:
+            return dict(self.counts)
+
+
+def link_articles(engine: Engine, links: List[Tuple[int, int]]) -> int:
+    """
+    Record that chunks appear in articles, skipping links that already exist.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        links (List[Tuple[int, int]]): (chunk_id, article_id) pairs.
+
+    Returns:
+        int: number of links added.
+    """
+    links = set(links)
+    if not links:
+        return 0
+
+    with Session(engine) as session:
+        existing = {
+            tuple(row)
+            for row in session.execute(
+                select(ChunkArticle.chunk_id, ChunkArticle.article_id).where(
+                    ChunkArticle.chunk_id.in_({chunk_id for chunk_id, _ in links})
+                )
+            )
+        }
+    new_links = sorted(links - existing)
+    if new_links:
+        insert_data(
+            engine,
+            ChunkArticle,
+            [
+                {"chunk_id": chunk_id, "article_id": article_id}
+                for chunk_id, article_id in new_links
+            ],
+        )
+    return len(new_links)
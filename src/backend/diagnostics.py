@@ -0,0 +1,235 @@
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List
+
+import toml
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# Top allocations of the latest run of each pipeline stage while tracemalloc traces
+_STAGE_ALLOCATIONS: Dict[str, Dict[str, Any]] = {}
+_STAGE_ALLOCATIONS_LOCK = threading.Lock()
+
+
+def process_memory() -> Dict[str, Any]:
+    """
+    Get the resident set size of this process, now and at its peak.
+
+    Returns:
+        Dict[str, Any]: the pid, "rss_bytes" and "peak_rss_bytes".
+    """
+    with open("/proc/self/statm") as statm:
+        rss_pages = int(statm.read().split()[1])
+    return {
+        "pid": os.getpid(),
+        "rss_bytes": rss_pages * os.sysconf("SC_PAGE_SIZE"),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def start_tracemalloc(frames: int = CONFIG["DEBUG_TRACEMALLOC_FRAMES"]) -> None:
+    """
+    Start tracing Python allocations, so each pipeline stage records its top
+    allocations. Tracing slows every allocation down, only enable it while
+    investigating.
+
+    Args:
+        frames (int, optional): frames kept per allocation traceback.
+            Defaults to CONFIG["DEBUG_TRACEMALLOC_FRAMES"].
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        logger.warning(f"Started tracemalloc with {frames} frames per allocation.")
+
+
+def stop_tracemalloc() -> None:
+    """
+    Stop tracing Python allocations and forget the recorded stage allocations.
+    """
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+        logger.warning("Stopped tracemalloc.")
+    with _STAGE_ALLOCATIONS_LOCK:
+        _STAGE_ALLOCATIONS.clear()
+
+
+@contextmanager
+def trace_allocations(stage: str) -> Iterator[None]:
+    """
+    Record the allocations made during the body of the with block as the
+    latest allocations of a stage, when tracemalloc is tracing. Allocations of
+    concurrent requests land in whichever stage is running.
+
+    Args:
+        stage (str): the pipeline stage.
+    """
+    if not tracemalloc.is_tracing():
+        yield
+        return
+
+    before = tracemalloc.take_snapshot()
+    yield
+    after = tracemalloc.take_snapshot()
+
+    differences = after.compare_to(before, "lineno")
+    top = [
+        {
+            "location": str(difference.traceback[0]),
+            "size_diff_bytes": difference.size_diff,
+            "count_diff": difference.count_diff,
+        }
+        for difference in differences[: CONFIG["DEBUG_TOP_ALLOCATIONS"]]
+    ]
+    with _STAGE_ALLOCATIONS_LOCK:
+        _STAGE_ALLOCATIONS[stage] = {
+            "at": datetime.now().isoformat(),
+            "size_diff_bytes": sum(d.size_diff for d in differences),
+            "top": top,
+        }
+
+
+def allocation_stats() -> Dict[str, Any]:
+    """
+    Get the tracemalloc state and the top allocations of each stage.
+
+    Returns:
+        Dict[str, Any]: whether tracemalloc is tracing, the traced memory now
+            and at its peak, and the latest allocations of each stage.
+    """
+    tracing = tracemalloc.is_tracing()
+    current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+    with _STAGE_ALLOCATIONS_LOCK:
+        stages = dict(_STAGE_ALLOCATIONS)
+    return {
+        "tracing": tracing,
+        "traced_bytes": current,
+        "peak_traced_bytes": peak,
+        "stages": stages,
+    }
+
+
+def _folded_stack(frame: Any) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def sample_stacks(
+    seconds: float, interval: float = CONFIG["DEBUG_PROFILE_INTERVAL"]
+) -> str:
+    """
+    Sample the Python stack of every thread of this process for a number of
+    seconds, and return them in the folded format read by flamegraph.pl,
+    speedscope and inferno: one "frame;frame;frame count" line per stack.
+    Time spent in C code (e.g. CUDA kernels) shows up in the Python frame
+    that called it.
+
+    Args:
+        seconds (float): how long to sample, capped at DEBUG_PROFILE_MAX_SECONDS.
+        interval (float, optional): seconds between samples.
+            Defaults to CONFIG["DEBUG_PROFILE_INTERVAL"].
+
+    Returns:
+        str: the folded stacks, most frequent first.
+    """
+    seconds = min(seconds, CONFIG["DEBUG_PROFILE_MAX_SECONDS"])
+    sampler = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks: Counter = Counter()
+
+    logger.warning(f"Sampling stacks for {seconds}s every {interval}s.")
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == sampler:
+                continue
+            thread = names.get(ident) or f"thread-{ident}"
+            stacks[f"{thread};{_folded_stack(frame)}"] += 1
+        time.sleep(interval)
+        # Pick up threads started while sampling
+        if len(names) != threading.active_count():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def profile_filename(process: str) -> str:
+    """
+    Name of a downloaded profile.
+
+    Args:
+        process (str): the sampled process.
+
+    Returns:
+        str: e.g. "profile-api-20250601-120000.folded".
+    """
+    return f"profile-{process}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+
+
+def _device_stats(torch: Any) -> List[Dict[str, Any]]:
+    devices = []
+    if not torch.cuda.is_available():
+        return devices
+    for index in range(torch.cuda.device_count()):
+        stats = torch.cuda.memory_stats(index)
+        devices.append(
+            {
+                "device": f"cuda:{index}",
+                "allocated_bytes": stats.get("allocated_bytes.all.current", 0),
+                "peak_allocated_bytes": stats.get("allocated_bytes.all.peak", 0),
+                "reserved_bytes": stats.get("reserved_bytes.all.current", 0),
+                "peak_reserved_bytes": stats.get("reserved_bytes.all.peak", 0),
+                "alloc_retries": stats.get("num_alloc_retries", 0),
+                "ooms": stats.get("num_ooms", 0),
+                "total_bytes": torch.cuda.get_device_properties(index).total_memory,
+            }
+        )
+    return devices
+
+
+def model_memory(torch: Any, models: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Get the process memory, the torch allocator statistics of each CUDA device
+    and the parameter and buffer memory of each loaded torch model.
+
+    Args:
+        torch (Any): the torch module.
+        models (Dict[str, Any]): loaded models by name. Models that are not
+            torch modules (ONNX sessions, HTTP clients) are reported without sizes.
+
+    Returns:
+        Dict[str, Any]: "process", "devices" and "models".
+    """
+    sizes = {}
+    for name, model in models.items():
+        if not hasattr(model, "parameters"):
+            sizes[name] = {"type": type(model).__name__}
+            continue
+        tensors = [*model.parameters(), *model.buffers()]
+        devices = sorted({str(tensor.device) for tensor in tensors})
+        sizes[name] = {
+            "type": type(model).__name__,
+            "parameters": sum(p.numel() for p in model.parameters()),
+            "bytes": sum(t.numel() * t.element_size() for t in tensors),
+            "devices": devices,
+        }
+    return {
+        "process": process_memory(),
+        "devices": _device_stats(torch),
+        "models": sizes,
+    }
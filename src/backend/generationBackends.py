@@ -0,0 +1,347 @@
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+import toml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+THINK_END = "</think>"
+THINK_START = "<think>"
+
+
+@dataclass
+class Generation:
+    """
+    One generated response.
+
+    Attributes:
+        text (str): the response, without the thinking content.
+        thinking (str): the thinking content, empty if thinking was disabled.
+            The in-process backend only decodes it for requests whose debug
+            payloads are sampled.
+        completion_tokens (int): number of tokens generated, thinking included.
+        first_token_seconds (Optional[float]): seconds until the first token
+            arrived, None if the backend does not stream.
+        prompt_tokens (Optional[int]): number of prompt tokens, chat template
+            included, None if unknown.
+        thinking_tokens (Optional[int]): number of generated tokens up to the
+            end of the thinking, None if unknown.
+    """
+
+    text: str
+    thinking: str
+    completion_tokens: int
+    first_token_seconds: Optional[float] = None
+    prompt_tokens: Optional[int] = None
+    thinking_tokens: Optional[int] = None
+
+    def usage(self) -> Dict[str, Optional[int]]:
+        """
+        Get the prompt, thinking and answer token counts.
+
+        Returns:
+            Dict[str, Optional[int]]: "prompt_tokens", "thinking_tokens" and
+                "answer_tokens".
+        """
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "thinking_tokens": self.thinking_tokens,
+            "answer_tokens": (
+                self.completion_tokens - self.thinking_tokens
+                if self.thinking_tokens is not None
+                else None
+            ),
+        }
+
+
+def split_thinking(text: str) -> Tuple[str, str]:
+    """
+    Split generated text at the last </think> tag, like the in-process model
+    splits its output ids at the last </think> token.
+
+    Args:
+        text (str): the generated text.
+
+    Returns:
+        Tuple[str, str]: the thinking content and the response.
+    """
+    thinking, tag, response = text.rpartition(THINK_END)
+    if not tag:
+        return "", text.strip()
+    thinking = thinking.strip()
+    if thinking.startswith(THINK_START):
+        thinking = thinking[len(THINK_START) :]
+    return thinking.strip(), response.strip()
+
+
+class GenerationBackend(ABC):
+    """
+    Generates chat responses to prompts. Implemented in-process on the
+    Hugging Face model (languageModels.HFGenerationBackend) and over HTTP on an
+    OpenAI compatible inference server (OpenAIGenerationBackend).
+    """
+
+    name: str
+
+    @abstractmethod
+    def load(self) -> Any:
+        """
+        Load the model, or check that the inference server serves it.
+        """
+
+    @abstractmethod
+    def generate(
+        self, prompts: List[str], enable_thinking: bool, max_new_tokens: int
+    ) -> List[Generation]:
+        """
+        Generate a response to each prompt.
+
+        Args:
+            prompts (List[str]): the prompts, sent as single user messages.
+            enable_thinking (bool): let the model think before answering.
+            max_new_tokens (int): maximum tokens generated per prompt.
+
+        Returns:
+            List[Generation]: the response to each prompt, in input order.
+        """
+
+    def close(self) -> None:
+        """
+        Release the backend's connections or memory.
+        """
+
+
+class OpenAIGenerationBackend(GenerationBackend):
+    """
+    Client of an OpenAI compatible /v1/chat/completions endpoint, such as
+    vLLM or the llama.cpp server.
+
+    Requests share a pool of keep-alive connections. Connection errors and
+    429/5xx responses are retried with exponential backoff (honouring
+    Retry-After) before any token is received; a stream that breaks midway is
+    not retried, as its tokens were already paid for. Responses are streamed,
+    so the read timeout bounds the gap between tokens rather than the whole
+    generation, and the prompts of a batch are sent concurrently for the
+    server to batch them.
+    """
+
+    name = "openai"
+
+    def __init__(
+        self,
+        url: str = CONFIG["GENERATION_API_URL"],
+        model: str = CONFIG["GENERATION_API_MODEL"],
+        api_key: Optional[str] = os.environ.get("GENERATION_API_KEY"),
+        concurrency: int = CONFIG["GENERATION_API_CONCURRENCY"],
+        connect_timeout: float = CONFIG["GENERATION_API_CONNECT_TIMEOUT"],
+        read_timeout: float = CONFIG["GENERATION_API_READ_TIMEOUT"],
+        retries: int = CONFIG["GENERATION_API_RETRIES"],
+    ):
+        self.url = url.rstrip("/")
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET", "POST"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        self.session = requests.Session()
+        self.session.mount(
+            self.url,
+            HTTPAdapter(
+                pool_connections=1, pool_maxsize=concurrency, max_retries=retry
+            ),
+        )
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="generation"
+        )
+
+    def load(self) -> List[str]:
+        """
+        Check that the inference server is up and serves the configured model.
+
+        Raises:
+            RuntimeError: if the model is not among the served models.
+
+        Returns:
+            List[str]: the served model ids.
+        """
+        response = self.session.get(f"{self.url}/v1/models", timeout=self.timeout)
+        response.raise_for_status()
+        served = [model["id"] for model in response.json()["data"]]
+        if self.model not in served:
+            raise RuntimeError(
+                f"Inference server at {self.url} does not serve '{self.model}' "
+                f"(it serves {served})."
+            )
+        return served
+
+    def _complete(
+        self, prompt: str, enable_thinking: bool, max_new_tokens: int
+    ) -> Generation:
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_new_tokens,
+            "temperature": CONFIG["TEMPERATURE"] if CONFIG["DO_SAMPLE"] else 0.0,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+            # Qwen3 chat template switch, passed through by vLLM and llama.cpp
+            "chat_template_kwargs": {"enable_thinking": enable_thinking},
+        }
+        start = time.perf_counter()
+        first_token_seconds = None
+        content, reasoning, usage, chunks = [], [], None, 0
+
+        with self.session.post(
+            f"{self.url}/v1/chat/completions",
+            json=payload,
+            timeout=self.timeout,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            # Server-sent events, one "data: <json>" line per chunk
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                usage = event.get("usage") or usage
+                for choice in event.get("choices", []):
+                    delta = choice.get("delta", {})
+                    # Servers with a reasoning parser send the thinking separately
+                    text = delta.get("content") or ""
+                    thought = delta.get("reasoning_content") or ""
+                    if text or thought:
+                        if first_token_seconds is None:
+                            first_token_seconds = time.perf_counter() - start
+                        content.append(text)
+                        reasoning.append(thought)
+                        chunks += 1
+
+        thinking, text = split_thinking("".join(content))
+        thinking = "".join(reasoning).strip() or thinking
+        usage = usage or {}
+        completion_tokens = usage.get("completion_tokens", chunks)
+        thinking_tokens = (usage.get("completion_tokens_details") or {}).get(
+            "reasoning_tokens"
+        )
+        if thinking_tokens is None:
+            # Estimate from the share of chunks up to the end of the thinking
+            end = "".join(content).rfind(THINK_END)
+            end = end + len(THINK_END) if end >= 0 else 0
+            offset, thinking_chunks = 0, 0
+            for piece, thought in zip(content, reasoning):
+                if thought or offset < end:
+                    thinking_chunks += 1
+                offset += len(piece)
+            thinking_tokens = (
+                round(thinking_chunks * completion_tokens / chunks) if chunks else 0
+            )
+        return Generation(
+            text=text,
+            thinking=thinking,
+            completion_tokens=completion_tokens,
+            first_token_seconds=first_token_seconds,
+            prompt_tokens=usage.get("prompt_tokens"),
+            thinking_tokens=thinking_tokens,
+        )
+
+    def generate(
+        self, prompts: List[str], enable_thinking: bool, max_new_tokens: int
+    ) -> List[Generation]:
+        return list(
+            self.executor.map(
+                lambda prompt: self._complete(prompt, enable_thinking, max_new_tokens),
+                prompts,
+            )
+        )
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+class GenerationStats:
+    """
+    Counts generate calls, prompts, generated tokens and errors, and keeps
+    recent latencies, the same way for every backend.
+    """
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._counts = {"calls": 0, "prompts": 0, "errors": 0, "completion_tokens": 0}
+        self._seconds = 0.0
+        self._latencies = deque(maxlen=window)
+        self._first_tokens = deque(maxlen=window)
+
+    def record(self, seconds: float, generations: List[Generation]) -> None:
+        with self._lock:
+            self._counts["calls"] += 1
+            self._counts["prompts"] += len(generations)
+            self._counts["completion_tokens"] += sum(
+                g.completion_tokens for g in generations
+            )
+            self._seconds += seconds
+            self._latencies.append(seconds)
+            self._first_tokens.extend(
+                g.first_token_seconds
+                for g in generations
+                if g.first_token_seconds is not None
+            )
+
+    def record_error(self) -> None:
+        with self._lock:
+            self._counts["errors"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the generation counts, throughput and recent latency percentiles.
+
+        Returns:
+            Dict[str, Any]: generation statistics of this process.
+        """
+
+        def percentile(values: List[float], q: float) -> Optional[float]:
+            values = sorted(values)
+            if not values:
+                return None
+            return round(values[min(int(len(values) * q), len(values) - 1)], 3)
+
+        with self._lock:
+            return {
+                "backend": CONFIG["GENERATION_BACKEND"],
+                **self._counts,
+                "tokens_per_s": (
+                    round(self._counts["completion_tokens"] / self._seconds, 1)
+                    if self._seconds
+                    else None
+                ),
+                "latency_p50_s": percentile(self._latencies, 0.5),
+                "latency_p95_s": percentile(self._latencies, 0.95),
+                "first_token_p50_s": percentile(self._first_tokens, 0.5),
+                "first_token_p95_s": percentile(self._first_tokens, 0.95),
+            }
+
+
+GENERATION_STATS = GenerationStats()
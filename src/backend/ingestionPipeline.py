@@ -0,0 +1,361 @@
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import Engine, insert
+from sqlalchemy.orm import Session
+import toml
+
+from deduplication import ChunkDeduplicator
+from modelClient import embed_texts, hold_article_encoder, release_article_encoder
+from ormModels import Article as ArticleORM, Chunk, ChunkArticle, ChunkSignature, File
+from sqlFunctions import insert_data
+from textProcessing import process_articles, process_files
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stage's input
+_DONE = object()
+
+# The pipeline that is running or ran last, reported by ingestion_stats
+_LAST_PIPELINE: Optional["IngestionPipeline"] = None
+
+
+@dataclass
+class StageStats:
+    """
+    Items processed and time spent working (not waiting on a queue) by one stage.
+    """
+
+    name: str
+    workers: int = 1
+    items: int = 0
+    busy_seconds: float = 0.0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, items: int, seconds: float) -> None:
+        with self._lock:
+            self.items += items
+            self.busy_seconds += seconds
+
+    def as_dict(self) -> Dict[str, Any]:
+        if self.started_at is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.finished_at or time.perf_counter()) - self.started_at
+        return {
+            "workers": self.workers,
+            "items": self.items,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "items_per_second": round(self.items / elapsed, 2) if elapsed else 0.0,
+            # Share of the stage's worker time spent working rather than waiting
+            "utilisation": (
+                round(self.busy_seconds / (elapsed * self.workers), 3)
+                if elapsed
+                else 0.0
+            ),
+        }
+
+
+class IngestionPipeline:
+    """
+    Streaming ingestion of new files. Each stage runs in its own thread(s) and
+    hands its output to the next one through a bounded queue, so extraction,
+    chunking, embedding and inserts overlap instead of running one after another:
+
+        extract (1 thread): parse each file and insert its articles.
+        chunk (tokenizer_workers threads): chunk and tokenize each article,
+            dropping chunks that duplicate an earlier one (see deduplication.py).
+        encode (1 thread): embed chunks in batches of batch_size.
+        write (1 thread): insert each embedded batch.
+
+    Bounded queues keep memory flat: a stage that runs ahead blocks until the
+    next one catches up. The first error stops every stage and is re-raised by run.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        batch_size: int = CONFIG["INGESTION_BATCH_SIZE"],
+        queue_size: int = CONFIG["INGESTION_QUEUE_SIZE"],
+        tokenizer_workers: int = CONFIG["INGESTION_TOKENIZER_WORKERS"],
+        log_interval: float = CONFIG["INGESTION_LOG_INTERVAL"],
+        deduplicate: bool = CONFIG["DEDUP_CHUNKS"],
+    ):
+        self.engine = engine
+        self.deduplicator = ChunkDeduplicator() if deduplicate else None
+        self.batch_size = batch_size
+        self.tokenizer_workers = tokenizer_workers
+        self.log_interval = log_interval
+
+        self.queues: Dict[str, queue.Queue] = {
+            "articles": queue.Queue(maxsize=queue_size),
+            "chunks": queue.Queue(maxsize=queue_size),
+            # Holds batches, so bound it in batches too
+            "embedded": queue.Queue(maxsize=max(queue_size // batch_size, 1)),
+        }
+        self.max_depths = {name: 0 for name in self.queues}
+        self.stages = {
+            "extract": StageStats("extract"),
+            "chunk": StageStats("chunk", workers=tokenizer_workers),
+            "encode": StageStats("encode"),
+            "write": StageStats("write"),
+        }
+
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._finished = threading.Event()
+
+    def _put(self, name: str, item: Any) -> None:
+        """
+        Put an item on a queue, giving up if the pipeline is stopped meanwhile.
+        """
+        while not self._stop.is_set():
+            try:
+                self.queues[name].put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            self.max_depths[name] = max(self.max_depths[name], self.queues[name].qsize())
+            return
+
+    def _get(self, name: str) -> Any:
+        """
+        Get an item from a queue, returning _DONE if the pipeline is stopped meanwhile.
+        """
+        while not self._stop.is_set():
+            try:
+                return self.queues[name].get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _run_stage(self, name: str, func: Callable[[], None]) -> None:
+        """
+        Run a stage's loop, recording its start and end and stopping
+        the whole pipeline if it fails.
+        """
+        stats = self.stages[name]
+        if stats.started_at is None:
+            stats.started_at = time.perf_counter()
+        try:
+            func()
+        except BaseException as e:
+            logger.exception(f"Ingestion stage '{name}' failed.")
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+        finally:
+            stats.finished_at = time.perf_counter()
+
+    def _extract(self, files: List[File]) -> None:
+        for file in files:
+            if self._stop.is_set():
+                return
+            start = time.perf_counter()
+            article_data = process_files([file])
+            articles = (
+                insert_data(self.engine, ArticleORM, article_data)
+                if article_data
+                else []
+            )
+            self.stages["extract"].record(len(articles), time.perf_counter() - start)
+
+            for article in articles:
+                self._put("articles", article)
+
+        for _ in range(self.tokenizer_workers):
+            self._put("articles", _DONE)
+
+    def _chunk(self) -> None:
+        while (article := self._get("articles")) is not _DONE:
+            start = time.perf_counter()
+            chunks = process_articles([article], self.deduplicator)
+            self.stages["chunk"].record(len(chunks), time.perf_counter() - start)
+
+            for chunk in chunks:
+                self._put("chunks", chunk)
+
+        self._put("chunks", _DONE)
+
+    def _encode(self) -> None:
+        remaining_workers = self.tokenizer_workers
+        while remaining_workers:
+            # Fill a batch, or take what is left once every chunk worker is done
+            batch = []
+            while remaining_workers and len(batch) < self.batch_size:
+                chunk = self._get("chunks")
+                if chunk is _DONE:
+                    if self._stop.is_set():
+                        return
+                    remaining_workers -= 1
+                else:
+                    batch.append(chunk)
+            if not batch:
+                break
+
+            start = time.perf_counter()
+            input_ids = [chunk.pop("input_ids", None) for chunk in batch]
+            embeddings = embed_texts(
+                input_type="article",
+                texts=[chunk["text"] for chunk in batch],
+                input_ids=input_ids if CONFIG["CHUNKER"] == "token" else None,
+            )
+            for chunk, embedding in zip(batch, embeddings):
+                chunk["embedding"] = embedding
+            self.stages["encode"].record(len(batch), time.perf_counter() - start)
+
+            self._put("embedded", batch)
+
+        self._put("embedded", _DONE)
+
+    def _write(self) -> None:
+        while (batch := self._get("embedded")) is not _DONE:
+            start = time.perf_counter()
+            signatures = [
+                (chunk.pop("content_hash", None), chunk.pop("minhash", None))
+                for chunk in batch
+            ]
+            # Chunks, their links and signatures are stored together or not at all
+            with Session(self.engine) as session:
+                chunks = session.execute(
+                    insert(Chunk).returning(
+                        Chunk.chunk_id, Chunk.article_id, sort_by_parameter_order=True
+                    ),
+                    batch,
+                ).all()
+                session.execute(
+                    insert(ChunkArticle),
+                    [
+                        {"chunk_id": chunk_id, "article_id": article_id}
+                        for chunk_id, article_id in chunks
+                    ],
+                )
+                if self.deduplicator is not None:
+                    session.execute(
+                        insert(ChunkSignature),
+                        [
+                            {"chunk_id": chunk_id, "content_hash": key, "minhash": minhash}
+                            for (chunk_id, _), (key, minhash) in zip(chunks, signatures)
+                        ],
+                    )
+                session.commit()
+            if self.deduplicator is not None:
+                # Link the duplicates of the chunks inserted so far
+                self.deduplicator.link_duplicates(self.engine)
+            self.stages["write"].record(len(batch), time.perf_counter() - start)
+
+    def _log_stats(self) -> None:
+        while not self._finished.wait(self.log_interval):
+            logger.info(f"Ingestion progress: {self.stats()}")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the throughput and utilisation of every stage, the depth of
+        every queue and the number of duplicate chunks dropped. The stage with the highest utilisation is the bottleneck:
+        the stages before it fill their output queue and block, the stages
+        after it drain their input queue and wait.
+
+        Returns:
+            Dict[str, Any]: per-stage stats, per-queue depths and the bottleneck stage.
+        """
+        stages = {name: stats.as_dict() for name, stats in self.stages.items()}
+        return {
+            "running": not self._finished.is_set(),
+            "duplicates": (
+                self.deduplicator.stats() if self.deduplicator is not None else None
+            ),
+            "stages": stages,
+            "queues": {
+                name: {
+                    "depth": q.qsize(),
+                    "max_depth": self.max_depths[name],
+                    "capacity": q.maxsize,
+                }
+                for name, q in self.queues.items()
+            },
+            "bottleneck": max(stages, key=lambda name: stages[name]["utilisation"]),
+        }
+
+    def run(self, files: List[File]) -> Dict[str, Any]:
+        """
+        Ingest the files, returning once every chunk is inserted.
+
+        Args:
+            files (List[File]): the File rows to ingest.
+
+        Raises:
+            BaseException: the first error raised by any stage.
+
+        Returns:
+            Dict[str, Any]: the final pipeline stats, see stats.
+        """
+        global _LAST_PIPELINE
+        _LAST_PIPELINE = self
+
+        threads = [
+            threading.Thread(
+                target=self._run_stage, args=("extract", lambda: self._extract(files))
+            ),
+            *(
+                threading.Thread(target=self._run_stage, args=("chunk", self._chunk))
+                for _ in range(self.tokenizer_workers)
+            ),
+            threading.Thread(target=self._run_stage, args=("encode", self._encode)),
+            threading.Thread(target=self._run_stage, args=("write", self._write)),
+        ]
+        monitor = threading.Thread(target=self._log_stats, daemon=True)
+
+        if self.deduplicator is not None:
+            self.deduplicator.load(self.engine)
+
+        # Keep the encoder loaded for the whole run instead of once per batch
+        hold_article_encoder()
+        try:
+            monitor.start()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self._finished.set()
+            release_article_encoder()
+
+        # Link the duplicates found after their canonical chunk's batch was
+        # written, also if the run failed
+        if self.deduplicator is not None:
+            try:
+                self.deduplicator.link_duplicates(self.engine)
+            except Exception:
+                if self._error is None:
+                    raise
+                logger.exception("Failed to link duplicates after a failed run.")
+            logger.info(
+                f"Linked {self.deduplicator.stats()['linked']} duplicate chunks "
+                "to their canonical chunks."
+            )
+
+        if self._error is not None:
+            raise self._error
+
+        stats = self.stats()
+        logger.info(f"Ingestion finished: {stats}")
+        return stats
+
+
+def ingestion_stats() -> Dict[str, Any]:
+    """
+    Get the stats of the running or last ingestion pipeline in this process.
+
+    Returns:
+        Dict[str, Any]: see IngestionPipeline.stats, or an empty dict
+            if no ingestion ran in this process.
+    """
+    if _LAST_PIPELINE is None:
+        return {}
+    return _LAST_PIPELINE.stats()
@@ -0,0 +1,404 @@
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Literal, Optional, Tuple, Type
+
+import toml
+from sqlalchemy import Engine, case, delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from ormModels import (
+    KpiDaily,
+    KpiHourly,
+    KpiRollup,
+    KpiUser,
+    Message,
+    MessageContext,
+    Session,
+)
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# Rollup table of each granularity
+Granularity = Literal["hour", "day"]
+ROLLUPS: Dict[str, Type[KpiRollup]] = {"hour": KpiHourly, "day": KpiDaily}
+COUNTERS = [
+    column.key
+    for column in KpiHourly.__table__.columns
+    if column.key != "bucket_start"
+]
+
+
+def _bucket_start(timestamp: datetime, granularity: Granularity) -> datetime:
+    bucket = timestamp.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        bucket = bucket.replace(hour=0)
+    return bucket
+
+
+def _add(
+    session: SQLAlchemySession, deltas: List[Tuple[datetime, Dict[str, float]]]
+) -> None:
+    """
+    Add counter deltas to the hourly and daily buckets of their timestamps,
+    creating buckets as needed, with one upsert per table.
+
+    Args:
+        session (SQLAlchemySession): the session to write in. Not committed.
+        deltas (List[Tuple[datetime, Dict[str, float]]]): timestamps and the
+            amounts to add to each counter.
+    """
+    for granularity, table in ROLLUPS.items():
+        buckets: Dict[datetime, Dict[str, float]] = defaultdict(
+            lambda: dict.fromkeys(COUNTERS, 0)
+        )
+        for timestamp, delta in deltas:
+            bucket = buckets[_bucket_start(timestamp, granularity)]
+            for name, value in delta.items():
+                bucket[name] += value
+        if not buckets:
+            continue
+
+        # Sorted, so concurrent writers lock buckets in the same order
+        stmt = insert(table).values(
+            [
+                {"bucket_start": bucket_start, **counters}
+                for bucket_start, counters in sorted(buckets.items())
+            ]
+        )
+        session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["bucket_start"],
+                set_={
+                    name: getattr(table, name) + getattr(stmt.excluded, name)
+                    for name in COUNTERS
+                },
+            )
+        )
+
+
+def _message_delta(message: Message, context_chunks: int) -> Dict[str, float]:
+    delta = {
+        "messages": 1,
+        "context_chunks": context_chunks,
+        "messages_with_context": int(context_chunks > 0),
+    }
+    if message.is_good is not None:
+        delta.update(feedback=1, good_feedback=int(message.is_good))
+    if message.response_at and message.received_at:
+        delta.update(
+            responses=1,
+            response_seconds=(message.response_at - message.received_at).total_seconds(),
+        )
+    if message.context_retreived_at and message.received_at:
+        delta.update(
+            retrievals=1,
+            retrieval_seconds=(
+                message.context_retreived_at - message.received_at
+            ).total_seconds(),
+        )
+    if message.response_at and message.context_retreived_at:
+        delta.update(
+            generations=1,
+            generation_seconds=(
+                message.response_at - message.context_retreived_at
+            ).total_seconds(),
+        )
+    return delta
+
+
+def _write(engine: Engine, deltas: List[Tuple[datetime, Dict[str, float]]]) -> None:
+    # The rollups must never fail the request that feeds them
+    try:
+        with SQLAlchemySession(engine) as session:
+            _add(session, deltas)
+            session.commit()
+    except Exception:
+        logger.exception(
+            "Failed to update the KPI rollups, rebuild them with "
+            "'python kpiRollups.py'."
+        )
+
+
+def record_messages(
+    engine: Engine, messages: List[Message], context_chunks: List[int]
+) -> None:
+    """
+    Add newly logged messages to the KPI rollups.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        messages (List[Message]): the inserted messages.
+        context_chunks (List[int]): number of context chunks of each message.
+    """
+    _write(
+        engine,
+        [
+            (message.received_at, _message_delta(message, chunks))
+            for message, chunks in zip(messages, context_chunks)
+        ],
+    )
+
+
+def record_feedback(
+    session: SQLAlchemySession,
+    received_at: datetime,
+    previous: Optional[bool],
+    is_good: bool,
+) -> None:
+    """
+    Add feedback on a message to the KPI rollups, replacing any earlier
+    feedback on the same message. Runs in the transaction that updates the
+    message, with its row locked, so concurrent feedback on one message
+    is counted once.
+
+    Args:
+        session (SQLAlchemySession): the session updating the message. Not committed.
+        received_at (datetime): when the message was received.
+        previous (Optional[bool]): the message's feedback before, if any.
+        is_good (bool): the new feedback.
+    """
+    delta = {"good_feedback": int(is_good) - int(bool(previous))}
+    if previous is None:
+        delta["feedback"] = 1
+    # In a savepoint, so a failed update doesn't fail the feedback
+    try:
+        with session.begin_nested():
+            _add(session, [(received_at, delta)])
+    except Exception:
+        logger.exception(
+            "Failed to update the KPI rollups, rebuild them with "
+            "'python kpiRollups.py'."
+        )
+
+
+def record_session(engine: Engine, session: Session) -> None:
+    """
+    Add a new session, and its user if they are new, to the KPI rollups.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        session (Session): the inserted session.
+    """
+    try:
+        with SQLAlchemySession(engine) as db_session:
+            new_user = db_session.execute(
+                insert(KpiUser)
+                .values(user_id=session.user_id, first_seen=session.created_at)
+                .on_conflict_do_nothing()
+                .returning(KpiUser.user_id)
+            ).first()
+            _add(
+                db_session,
+                [(session.created_at, {"sessions": 1, "new_users": int(bool(new_user))})],
+            )
+            db_session.commit()
+    except Exception:
+        logger.exception(
+            "Failed to update the KPI rollups, rebuild them with "
+            "'python kpiRollups.py'."
+        )
+
+
+def rebuild_kpi_rollups(engine: Engine, only_if_empty: bool = False) -> bool:
+    """
+    Recompute the KPI rollups from the messages, message_context and sessions
+    tables. This is the only function that scans them: it backfills the rollups
+    of a database that predates them, or repairs rollups that drifted.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        only_if_empty (bool, optional): do nothing if the rollups have any rows.
+            Defaults to False.
+
+    Returns:
+        bool: whether the rollups were rebuilt.
+    """
+    with SQLAlchemySession(engine) as session:
+        if only_if_empty and session.scalar(select(func.count()).select_from(KpiDaily)):
+            return False
+
+        for table in (*ROLLUPS.values(), KpiUser):
+            session.execute(delete(table))
+
+        # Aggregate per hour in SQL, the daily buckets are added up from these
+        hour = func.date_trunc("hour", Message.received_at)
+        chunk_counts = (
+            select(
+                MessageContext.message_id,
+                func.count().label("chunks"),
+            )
+            .group_by(MessageContext.message_id)
+            .subquery()
+        )
+        chunks = func.coalesce(chunk_counts.c.chunks, 0)
+
+        def seconds(end, start):
+            return func.coalesce(func.sum(func.extract("epoch", end - start)), 0)
+
+        rows = session.execute(
+            select(
+                hour,
+                func.count(),
+                func.count(Message.is_good),
+                func.count().filter(Message.is_good.is_(True)),
+                func.count(Message.response_at - Message.received_at),
+                seconds(Message.response_at, Message.received_at),
+                func.count(Message.context_retreived_at - Message.received_at),
+                seconds(Message.context_retreived_at, Message.received_at),
+                func.count(Message.response_at - Message.context_retreived_at),
+                seconds(Message.response_at, Message.context_retreived_at),
+                func.sum(chunks),
+                func.sum(case((chunks > 0, 1), else_=0)),
+            )
+            .outerjoin(chunk_counts, Message.message_id == chunk_counts.c.message_id)
+            .where(Message.received_at.is_not(None))
+            .group_by(hour)
+        ).all()
+        deltas = [
+            (
+                row[0],
+                dict(
+                    zip(
+                        [
+                            "messages",
+                            "feedback",
+                            "good_feedback",
+                            "responses",
+                            "response_seconds",
+                            "retrievals",
+                            "retrieval_seconds",
+                            "generations",
+                            "generation_seconds",
+                            "context_chunks",
+                            "messages_with_context",
+                        ],
+                        [value or 0 for value in row[1:]],
+                    )
+                ),
+            )
+            for row in rows
+        ]
+
+        first_sessions = (
+            select(Session.user_id, func.min(Session.created_at).label("first_seen"))
+            .where(Session.created_at.is_not(None))
+            .group_by(Session.user_id)
+            .subquery()
+        )
+        for user_id, first_seen in session.execute(select(first_sessions)):
+            session.add(KpiUser(user_id=user_id, first_seen=first_seen))
+            deltas.append((first_seen, {"new_users": 1}))
+
+        session_hour = func.date_trunc("hour", Session.created_at)
+        for bucket_start, sessions in session.execute(
+            select(session_hour, func.count())
+            .where(Session.created_at.is_not(None))
+            .group_by(session_hour)
+        ):
+            deltas.append((bucket_start, {"sessions": sessions}))
+
+        _add(session, deltas)
+        session.commit()
+
+    logger.info(f"Rebuilt the KPI rollups from {len(rows)} hours of messages.")
+    return True
+
+
+def _ratio(numerator: float, denominator: float) -> Optional[float]:
+    return round(numerator / denominator, 4) if denominator else None
+
+
+def _kpis(counters: Dict[str, float]) -> Dict[str, Any]:
+    return {
+        "messages": int(counters["messages"]),
+        "sessions": int(counters["sessions"]),
+        "new_users": int(counters["new_users"]),
+        "good_feedback_rate": _ratio(counters["good_feedback"], counters["feedback"]),
+        "feedback_rate": _ratio(counters["feedback"], counters["messages"]),
+        "avg_response_seconds": _ratio(
+            counters["response_seconds"], counters["responses"]
+        ),
+        "avg_retrieval_seconds": _ratio(
+            counters["retrieval_seconds"], counters["retrievals"]
+        ),
+        "avg_generation_seconds": _ratio(
+            counters["generation_seconds"], counters["generations"]
+        ),
+        "avg_chunks_per_message": _ratio(
+            counters["context_chunks"], counters["messages"]
+        ),
+        "context_coverage": _ratio(
+            counters["messages_with_context"], counters["messages"]
+        ),
+        "avg_messages_per_session": _ratio(counters["messages"], counters["sessions"]),
+    }
+
+
+def get_kpis(
+    engine: Engine,
+    granularity: Granularity = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    """
+    Get the user interaction KPIs of each hour or day in a time range, and of
+    the whole range, from the rollup tables.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        granularity (Granularity, optional): "hour" or "day". Defaults to "day".
+        start (Optional[datetime], optional): first bucket to include.
+            Defaults to 30 days (hourly: 2 days) before end.
+        end (Optional[datetime], optional): include buckets starting before this.
+            Defaults to now.
+
+    Returns:
+        Dict[str, Any]: the KPIs of the range ("total") and of each bucket,
+            and the average sessions per user of all time.
+    """
+    table = ROLLUPS[granularity]
+    end = end or datetime.now()
+    start = start or end - timedelta(days=2 if granularity == "hour" else 30)
+
+    with SQLAlchemySession(engine) as session:
+        rows = session.scalars(
+            select(table)
+            .where(table.bucket_start >= _bucket_start(start, granularity))
+            .where(table.bucket_start < end)
+            .order_by(table.bucket_start)
+        ).all()
+        users = session.scalar(select(func.count()).select_from(KpiUser))
+        all_sessions = session.scalar(select(func.sum(KpiDaily.sessions))) or 0
+
+    totals = dict.fromkeys(COUNTERS, 0)
+    buckets = []
+    for row in rows:
+        counters = {name: getattr(row, name) for name in COUNTERS}
+        for name, value in counters.items():
+            totals[name] += value
+        buckets.append({"bucket_start": row.bucket_start, **_kpis(counters)})
+
+    return {
+        "granularity": granularity,
+        "start": start,
+        "end": end,
+        "total": _kpis(totals),
+        "buckets": buckets,
+        # Since the first session, not only in this range
+        "avg_sessions_per_user": _ratio(all_sessions, users),
+    }
+
+
+def main() -> None:
+    # Rebuild the rollups from the message log, scanning the raw tables
+    from sqlFunctions import create_connection
+
+    logging.basicConfig(level=logging.INFO)
+    rebuild_kpi_rollups(create_connection(force_rebuild=False))
+
+
+if __name__ == "__main__":
+    main()
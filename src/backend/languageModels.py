@@ -1,6 +1,15 @@
+import importlib.util
+import inspect
 import logging
 import json
-from typing import List, Literal
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List, Literal, Optional, Tuple
 
 from transformers import (
     AutoTokenizer,
@@ -11,32 +20,523 @@ from transformers import (
 import torch
 import toml
 
+from diagnostics import model_memory
+from generationBackends import (
+    GENERATION_STATS,
+    Generation,
+    GenerationBackend,
+    OpenAIGenerationBackend,
+)
+from requestLogging import debug_enabled, debug_payload
+
 logger = logging.getLogger(__name__)
 CONFIG = toml.load("config.toml")
 PROMPTS = json.load(open("prompts.json"))
 
-# Load inference model
-INFERENCE_TOKENIZER = AutoTokenizer.from_pretrained(CONFIG["INFERENCE_MODEL"])
-INFERENCE_MODEL = AutoModelForCausalLM.from_pretrained(
-    CONFIG["INFERENCE_MODEL"],
-    device_map=CONFIG["DEVICE_MAP"],
-    attn_implementation="flash_attention_2",
-)
-logger.info("Inference model loaded successfully.")
+# Models are loaded lazily on first use, or all at once (in parallel) via load_models
+_MODELS: Dict[str, Tuple[Any, Any]] = {}
+_LOAD_LOCKS = defaultdict(threading.Lock)
+# Times the CUDA caching allocator was made to return its unused blocks
+_CACHE_RELEASES = {"count": 0}
+MODEL_STATUS: Dict[str, Dict[str, Any]] = {
+    name: {"state": "pending", "seconds": None, "error": None}
+    for name in ("inference", "query_encoder", "cross_encoder", "warmup")
+}
 
-# Load query embedding model
-QUERY_EMBEDDING_TOKENIZER = AutoTokenizer.from_pretrained(
-    CONFIG["QUERY_EMBEDDING_MODEL"]
-)
-QUERY_EMBEDDING_MODEL = AutoModel.from_pretrained(CONFIG["QUERY_EMBEDDING_MODEL"])
 
-# Load cross-encoder model
-CROSS_ENCODER_TOKENIZER = AutoTokenizer.from_pretrained(CONFIG["CROSS_ENCODER_MODEL"])
-CROSS_ENCODER_MODEL = AutoModelForSequenceClassification.from_pretrained(
-    CONFIG["CROSS_ENCODER_MODEL"]
-)
+def _resolve_device(device: str = CONFIG["DEVICE"]) -> str:
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+
+# Device of the inference model and the article encoder
+DEVICE = _resolve_device()
+
+
+def _attention_implementation(
+    device: str = DEVICE, implementation: str = CONFIG["ATTENTION_IMPLEMENTATION"]
+) -> str:
+    """
+    Get the attention kernel of the inference model. FlashAttention 2 only
+    runs on CUDA, so "auto" falls back to PyTorch's scaled dot product
+    attention on cpu, or when flash-attn is not installed.
+    """
+    if implementation != "auto":
+        return implementation
+    if device == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+        return "flash_attention_2"
+    return "sdpa"
+
+
+def configure_threads(
+    intra_op: int = CONFIG["TORCH_INTRA_OP_THREADS"],
+    inter_op: int = CONFIG["TORCH_INTER_OP_THREADS"],
+) -> None:
+    """
+    Set the number of torch threads used within one op and across independent
+    ops. A value of 0 keeps torch's default. The inter-op pool can only be
+    sized before its first use, later calls leave it as it is.
+
+    Args:
+        intra_op (int, optional): intra-op threads.
+            Defaults to CONFIG["TORCH_INTRA_OP_THREADS"].
+        inter_op (int, optional): inter-op threads.
+            Defaults to CONFIG["TORCH_INTER_OP_THREADS"].
+    """
+    if intra_op > 0:
+        torch.set_num_threads(intra_op)
+    if inter_op > 0:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            logger.warning("The torch inter-op thread pool is already running.")
+    logger.info(
+        f"torch runs {torch.get_num_threads()} intra-op and "
+        f"{torch.get_num_interop_threads()} inter-op threads on {DEVICE}."
+    )
+
+
+configure_threads()
+
+
+def _load_inference_model() -> Tuple[Any, Any]:
+    if CONFIG["GENERATION_BACKEND"] != "hf":
+        # Generation runs on an inference server, only check that it serves the model
+        return None, get_generation_backend().load()
+
+    tokenizer = AutoTokenizer.from_pretrained(CONFIG["INFERENCE_MODEL"])
+    model = AutoModelForCausalLM.from_pretrained(
+        CONFIG["INFERENCE_MODEL"],
+        device_map=DEVICE,
+        attn_implementation=_attention_implementation(),
+    )
+    return tokenizer, model
+
+
+class OnnxEncoder:
+    """
+    Wraps an ONNX Runtime session so it can be called like a transformers encoder.
+    """
+
+    def __init__(self, path: os.PathLike, num_threads: int):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            str(path), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
 
-logger.info("Embedding and cross-encoder models loaded successfully.")
+    def __call__(self, **inputs) -> SimpleNamespace:
+        feeds = {
+            name: tensor.numpy()
+            for name, tensor in inputs.items()
+            if name in self.input_names
+        }
+        (last_hidden_state,) = self.session.run(["last_hidden_state"], feeds)
+        return SimpleNamespace(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+
+def _bucket(size: int, buckets: List[int]) -> Optional[int]:
+    return next((bucket for bucket in sorted(buckets) if bucket >= size), None)
+
+
+class CompiledEncoder:
+    """
+    Wraps a transformers encoder or cross-encoder compiled with torch.compile.
+    Compiled graphs are specialised to their input shapes, so inputs are padded
+    up to the next of a few static batch and sequence buckets: each bucket
+    compiles once, instead of every new padded length recompiling. The padding
+    is masked out of attention and sliced off the outputs, so they match the
+    uncompiled model's. Inputs larger than the largest bucket run uncompiled.
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        pad_token_id: int,
+        batch_buckets: List[int] = CONFIG["COMPILE_BATCH_BUCKETS"],
+        sequence_buckets: List[int] = CONFIG["COMPILE_SEQUENCE_BUCKETS"],
+    ):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.batch_buckets = sorted(batch_buckets)
+        self.sequence_buckets = sorted(sequence_buckets)
+        import torch._dynamo
+
+        # One graph per bucket, above the default recompilation limit of 8
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit,
+            len(self.batch_buckets) * len(self.sequence_buckets),
+        )
+        self.compiled = torch.compile(model, dynamic=False)
+
+    def __call__(self, **inputs) -> SimpleNamespace:
+        batch, length = inputs["input_ids"].shape
+        padded_batch = _bucket(batch, self.batch_buckets)
+        padded_length = _bucket(length, self.sequence_buckets)
+        if padded_batch is None or padded_length is None:
+            return self.model(**inputs)
+
+        padded = {
+            name: torch.nn.functional.pad(
+                tensor,
+                (0, padded_length - length, 0, padded_batch - batch),
+                value=self.pad_token_id if name == "input_ids" else 0,
+            )
+            for name, tensor in inputs.items()
+        }
+        outputs = self.compiled(**padded)
+        if getattr(outputs, "logits", None) is not None:
+            return SimpleNamespace(logits=outputs.logits[:batch])
+        return SimpleNamespace(
+            last_hidden_state=outputs.last_hidden_state[:batch, :length]
+        )
+
+    def warmup(self, batch_size: int = 1) -> None:
+        """
+        Compile the graph of every sequence bucket for a batch size.
+
+        Args:
+            batch_size (int, optional): the batch size. Defaults to 1.
+        """
+        device = next(self.model.parameters()).device
+        for length in self.sequence_buckets:
+            shape = (_bucket(batch_size, self.batch_buckets) or batch_size, length)
+            with torch.no_grad():
+                self(
+                    input_ids=torch.full(shape, self.pad_token_id, device=device),
+                    token_type_ids=torch.zeros(shape, dtype=torch.long, device=device),
+                    attention_mask=torch.ones(shape, dtype=torch.long, device=device),
+                )
+
+    def parameters(self) -> Iterator[Any]:
+        return self.model.parameters()
+
+    def buffers(self) -> Iterator[Any]:
+        return self.model.buffers()
+
+
+def _compile(tokenizer: Any, model: Any, compiled: bool) -> Any:
+    if not compiled:
+        return model
+    return CompiledEncoder(model, tokenizer.pad_token_id)
+
+
+# Queries the ONNX export is checked against the fp32 encoder with
+PARITY_QUERIES = [
+    "What is the first-line treatment for type 2 diabetes?",
+    "Side effects of long-term proton pump inhibitor use",
+    "ACE inhibitors",
+    "How does the BRCA1 mutation affect breast cancer risk in men and women?",
+]
+
+
+def check_encoder_parity(
+    tokenizer: Any,
+    model: Any,
+    reference: Any,
+    texts: List[str] = PARITY_QUERIES,
+    min_cosine: float = CONFIG["QUERY_ENCODER_PARITY_MIN_COSINE"],
+) -> Dict[str, float]:
+    """
+    Check that an encoder embeds texts like a reference encoder.
+
+    Args:
+        tokenizer (Any): the tokenizer of both encoders.
+        model (Any): the encoder to check.
+        reference (Any): the reference encoder.
+        texts (List[str], optional): texts to embed, batched so that padding
+            and the attention mask are exercised. Defaults to PARITY_QUERIES.
+        min_cosine (float, optional): lowest cosine similarity allowed between
+            the two embeddings of a text.
+            Defaults to CONFIG["QUERY_ENCODER_PARITY_MIN_COSINE"].
+
+    Raises:
+        RuntimeError: if any text's embeddings are less similar than min_cosine.
+
+    Returns:
+        Dict[str, float]: the lowest cosine similarity and the largest absolute
+            difference between the embeddings.
+    """
+    expected = encode_texts(tokenizer, reference, texts)
+    actual = encode_texts(tokenizer, model, texts)
+    parity = {
+        "min_cosine": torch.nn.functional.cosine_similarity(expected, actual, dim=1)
+        .min()
+        .item(),
+        "max_abs_diff": (expected - actual).abs().max().item(),
+    }
+    if parity["min_cosine"] < min_cosine:
+        raise RuntimeError(
+            f"Encoder embeddings differ from the reference: {parity}, "
+            f"expected a cosine similarity of at least {min_cosine}."
+        )
+    return parity
+
+
+def export_query_encoder_onnx(path: os.PathLike) -> None:
+    """
+    Export the fp32 query encoder to ONNX with dynamic batch and sequence axes,
+    and check its embeddings against the fp32 encoder (see check_encoder_parity).
+    An export that fails the check is deleted.
+
+    Args:
+        path (os.PathLike): where to write the .onnx file.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(CONFIG["QUERY_EMBEDDING_MODEL"])
+    model = AutoModel.from_pretrained(CONFIG["QUERY_EMBEDDING_MODEL"]).eval()
+    inputs = tokenizer(["onnx export"], return_tensors="pt")
+    # The inputs are passed by position, so they must follow the order of the
+    # forward signature (input_ids, attention_mask, token_type_ids), not the
+    # tokenizer's
+    input_names = [
+        name for name in inspect.signature(model.forward).parameters if name in inputs
+    ]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    torch.onnx.export(
+        model,
+        args=tuple(inputs[name] for name in input_names),
+        f=str(path),
+        input_names=input_names,
+        output_names=["last_hidden_state"],
+        dynamic_axes=dynamic_axes,
+        opset_version=17,
+    )
+    try:
+        parity = check_encoder_parity(
+            tokenizer, OnnxEncoder(path, CONFIG["QUERY_ENCODER_THREADS"]), model
+        )
+    except Exception:
+        os.remove(path)
+        raise
+    logger.info(f"Exported query encoder to {path}, parity with fp32: {parity}.")
+
+
+def load_query_encoder(
+    backend: Literal["torch", "int8", "onnx"] = CONFIG["QUERY_ENCODER_BACKEND"],
+    num_threads: int = CONFIG["QUERY_ENCODER_THREADS"],
+    compiled: bool = CONFIG["COMPILE_ENCODERS"],
+) -> Tuple[Any, Any]:
+    """
+    Load the query encoder with the given inference backend.
+        - "torch": the fp32 transformers model.
+        - "int8": the transformers model with int8 dynamic quantization of its
+            linear layers, which hold nearly all of its weights and compute.
+        - "onnx": an ONNX Runtime session, exported from the fp32 model on first use.
+
+    Args:
+        backend (Literal["torch", "int8", "onnx"], optional): the inference backend.
+            Defaults to CONFIG["QUERY_ENCODER_BACKEND"].
+        num_threads (int, optional): intra-op threads for the ONNX Runtime session.
+            Defaults to CONFIG["QUERY_ENCODER_THREADS"].
+        compiled (bool, optional): compile the "torch" backend, see
+            CompiledEncoder. Defaults to CONFIG["COMPILE_ENCODERS"].
+
+    Returns:
+        Tuple[Any, Any]: the tokenizer and the encoder.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(CONFIG["QUERY_EMBEDDING_MODEL"])
+
+    if backend == "onnx":
+        if not os.path.exists(CONFIG["QUERY_ENCODER_ONNX_PATH"]):
+            export_query_encoder_onnx(CONFIG["QUERY_ENCODER_ONNX_PATH"])
+        return tokenizer, OnnxEncoder(CONFIG["QUERY_ENCODER_ONNX_PATH"], num_threads)
+
+    model = AutoModel.from_pretrained(CONFIG["QUERY_EMBEDDING_MODEL"]).eval()
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    elif backend != "torch":
+        raise ValueError(
+            "Invalid query encoder backend. Must be 'torch', 'int8' or 'onnx'."
+        )
+    else:
+        model = _compile(tokenizer, model, compiled)
+
+    return tokenizer, model
+
+
+def load_cross_encoder(
+    compiled: bool = CONFIG["COMPILE_ENCODERS"],
+) -> Tuple[Any, Any]:
+    """
+    Load the cross-encoder.
+
+    Args:
+        compiled (bool, optional): compile it, see CompiledEncoder.
+            Defaults to CONFIG["COMPILE_ENCODERS"].
+
+    Returns:
+        Tuple[Any, Any]: the tokenizer and the cross-encoder.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(CONFIG["CROSS_ENCODER_MODEL"])
+    model = AutoModelForSequenceClassification.from_pretrained(
+        CONFIG["CROSS_ENCODER_MODEL"]
+    ).eval()
+    return tokenizer, _compile(tokenizer, model, compiled)
+
+
+def _load_article_encoder() -> Tuple[Any, Any]:
+    tokenizer = AutoTokenizer.from_pretrained(CONFIG["ARTICLE_EMBEDDING_MODEL"])
+    model = AutoModel.from_pretrained(
+        CONFIG["ARTICLE_EMBEDDING_MODEL"], device_map=DEVICE
+    ).eval()
+    return tokenizer, model
+
+
+MODEL_LOADERS: Dict[str, Callable[[], Tuple[Any, Any]]] = {
+    "inference": _load_inference_model,
+    "query_encoder": load_query_encoder,
+    "cross_encoder": load_cross_encoder,
+}
+
+
+def get_model(name: str) -> Tuple[Any, Any]:
+    """
+    Get a model and its tokenizer, loading them on first use.
+    Concurrent callers wait for a single load instead of loading twice.
+
+    Args:
+        name (str): the model to get, one of MODEL_LOADERS.
+
+    Returns:
+        Tuple[Any, Any]: the tokenizer and the model.
+    """
+    if name in _MODELS:
+        return _MODELS[name]
+
+    with _LOAD_LOCKS[name]:
+        if name not in _MODELS:
+            MODEL_STATUS[name].update(state="loading", error=None)
+            start = time.perf_counter()
+            try:
+                _MODELS[name] = MODEL_LOADERS[name]()
+            except Exception as e:
+                MODEL_STATUS[name].update(state="failed", error=str(e))
+                raise
+            MODEL_STATUS[name].update(
+                state="ready", seconds=round(time.perf_counter() - start, 3)
+            )
+            logger.info(f"Model '{name}' loaded in {MODEL_STATUS[name]['seconds']}s.")
+
+    return _MODELS[name]
+
+
+def load_models() -> None:
+    """
+    Load all models in parallel. Loading is mostly disk reads and weight
+    initialisation, both of which release the GIL, so threads overlap well.
+    Failures are recorded in MODEL_STATUS and logged rather than raised.
+    """
+    with ThreadPoolExecutor(max_workers=len(MODEL_LOADERS)) as executor:
+        futures = {executor.submit(get_model, name): name for name in MODEL_LOADERS}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                logger.error(
+                    f"Failed to load model '{futures[future]}': {future.exception()}"
+                )
+
+
+def hold_article_encoder() -> None:
+    """
+    Keep the article encoder loaded across embed_texts calls until
+    release_article_encoder is called. Used during ingestion, which embeds
+    many small batches, so the encoder is not reloaded for every batch.
+    """
+    with _LOAD_LOCKS["article_encoder"]:
+        if "article_encoder" not in _MODELS:
+            # Only compiled while held, compiling for a single batch doesn't pay off
+            tokenizer, model = _load_article_encoder()
+            _MODELS["article_encoder"] = tokenizer, _compile(
+                tokenizer, model, CONFIG["COMPILE_ENCODERS"]
+            )
+            logger.info("Holding the article encoder in memory.")
+
+
+def release_article_encoder() -> None:
+    """
+    Unload the article encoder held by hold_article_encoder.
+    """
+    with _LOAD_LOCKS["article_encoder"]:
+        if _MODELS.pop("article_encoder", None) is not None:
+            logger.info("Released the article encoder.")
+    if DEVICE == "cuda":
+        torch.cuda.empty_cache()
+
+
+def warmup() -> None:
+    """
+    Run one dummy embed, rerank and generate call so that kernel selection,
+    JIT compilation and allocator growth happen before the first real request.
+    """
+    MODEL_STATUS["warmup"].update(state="loading", error=None)
+    start = time.perf_counter()
+    try:
+        embed_texts(input_type="query", texts=["warmup"])
+        rerank_chunks(query="warmup", chunks=["warmup"])
+        # Compile every sequence bucket of the compiled encoders
+        rerank_batch = min(CONFIG["RETRIEVAL_TOP_K"], CONFIG["RERANK_BATCH_SIZE"])
+        for name, batch_size in (("query_encoder", 1), ("cross_encoder", rerank_batch)):
+            _, model = get_model(name)
+            if isinstance(model, CompiledEncoder):
+                model.warmup(batch_size)
+        generate_text("warmup", enable_thinking=False, max_new_tokens=1)
+    except Exception as e:
+        MODEL_STATUS["warmup"].update(state="failed", error=str(e))
+        logger.error(f"Model warmup failed: {e}")
+        return
+    MODEL_STATUS["warmup"].update(
+        state="ready", seconds=round(time.perf_counter() - start, 3)
+    )
+    logger.info(f"Model warmup finished in {MODEL_STATUS['warmup']['seconds']}s.")
+
+
+def _release_cached_memory() -> None:
+    """
+    Return the CUDA allocator's cached blocks to the driver, only when more
+    than CUDA_CACHE_RELEASE_BYTES of them are unused. Releasing after every
+    call would make the next call allocate its memory afresh.
+    """
+    if not torch.cuda.is_available():
+        return
+    unused = torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    if unused > CONFIG["CUDA_CACHE_RELEASE_BYTES"]:
+        torch.cuda.empty_cache()
+        _CACHE_RELEASES["count"] += 1
+
+
+def memory_stats() -> Dict[str, Any]:
+    """
+    Get the memory of the model process: its RSS, the torch allocator
+    statistics of each CUDA device and the parameter memory of each loaded model.
+
+    Returns:
+        Dict[str, Any]: see diagnostics.model_memory, and the number of
+            times cached CUDA memory was released.
+    """
+    return {
+        **model_memory(torch, {name: model for name, (_, model) in _MODELS.items()}),
+        "cache_releases": _CACHE_RELEASES["count"],
+    }
+
+
+def model_status() -> Dict[str, Dict[str, Any]]:
+    """
+    Get the loading state and load duration of every model.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: state ("pending", "loading", "ready" or "failed"),
+            load duration in seconds and error message for each model.
+    """
+    return {name: dict(status) for name, status in MODEL_STATUS.items()}
 
 
 def generate_text(
@@ -45,24 +545,128 @@ def generate_text(
     max_new_tokens: int = CONFIG["MAX_NEW_TOKENS"],
 ) -> str:
 
-    # Apply chat template to the prompt
-    messages = [{"role": "user", "content": prompt}]
-    text = INFERENCE_TOKENIZER.apply_chat_template(
-        messages,
-        tokenize=False,
-        add_generation_prompt=True,
-        enable_thinking=enable_thinking,
-    )
-    model_inputs = INFERENCE_TOKENIZER([text], return_tensors="pt").to(
-        INFERENCE_MODEL.device
-    )
+    return generate_texts(
+        [prompt], enable_thinking=enable_thinking, max_new_tokens=max_new_tokens
+    )[0]
 
-    # Generate text using the inference model
-    generated_ids = INFERENCE_MODEL.generate(
-        **model_inputs, max_new_tokens=max_new_tokens
-    )
-    output_ids = generated_ids[0][len(model_inputs.input_ids[0]) :].tolist()
 
+def generate_texts(
+    prompts: List[str],
+    enable_thinking: bool = True,
+    max_new_tokens: int = CONFIG["MAX_NEW_TOKENS"],
+    batch_size: int = CONFIG["GENERATION_BATCH_SIZE"],
+) -> List[str]:
+    """
+    Generate a response to each prompt with the GENERATION_BACKEND, batch_size
+    prompts per backend call. The thinking content is logged for requests
+    whose debug payloads are sampled (see requestLogging.debug_enabled), and
+    every call is counted in the generation stats.
+
+    Args:
+        prompts (List[str]): the prompts to respond to.
+        enable_thinking (bool, optional): let the model think before answering.
+            Defaults to True.
+        max_new_tokens (int, optional): maximum tokens generated per prompt.
+            Defaults to CONFIG["MAX_NEW_TOKENS"].
+        batch_size (int, optional): prompts per backend call.
+            Defaults to CONFIG["GENERATION_BATCH_SIZE"].
+
+    Returns:
+        List[str]: the response to each prompt, without the thinking content.
+    """
+    generations = _generate(prompts, enable_thinking, max_new_tokens, batch_size)
+    return [generation.text for generation in generations]
+
+
+def _generate(
+    prompts: List[str], enable_thinking: bool, max_new_tokens: int, batch_size: int
+) -> List[Generation]:
+    backend = get_generation_backend()
+
+    results = []
+    for start in range(0, len(prompts), batch_size):
+        batch_start = time.perf_counter()
+        try:
+            generations = backend.generate(
+                prompts[start : start + batch_size], enable_thinking, max_new_tokens
+            )
+        except Exception:
+            GENERATION_STATS.record_error()
+            raise
+        GENERATION_STATS.record(time.perf_counter() - batch_start, generations)
+
+        for generation in generations:
+            # If debugging is enabled, log the thinking content too
+            debug_payload(logger, "Thinking content", lambda: generation.thinking)
+            results.append(generation)
+
+    return results
+
+
+class HFGenerationBackend(GenerationBackend):
+    """
+    Generates with the in-process Hugging Face INFERENCE_MODEL. Prompts are
+    left padded so that every sequence in a batch ends where generation starts.
+    """
+
+    name = "hf"
+
+    def load(self) -> Tuple[Any, Any]:
+        return get_model("inference")
+
+    def generate(
+        self, prompts: List[str], enable_thinking: bool, max_new_tokens: int
+    ) -> List[Generation]:
+        tokenizer, model = get_model("inference")
+
+        # Apply chat template to the prompts
+        texts = [
+            tokenizer.apply_chat_template(
+                [{"role": "user", "content": prompt}],
+                tokenize=False,
+                add_generation_prompt=True,
+                enable_thinking=enable_thinking,
+            )
+            for prompt in prompts
+        ]
+        tokenizer.padding_side = "left"
+        model_inputs = tokenizer(texts, padding=True, return_tensors="pt").to(
+            model.device
+        )
+
+        # Generate text using the inference model
+        generated_ids = model.generate(**model_inputs, max_new_tokens=max_new_tokens)
+        generations = [
+            _decode_response(tokenizer, output, prompt_tokens)
+            for output, prompt_tokens in zip(
+                generated_ids[:, model_inputs.input_ids.shape[1] :].tolist(),
+                model_inputs.attention_mask.sum(dim=1).tolist(),
+            )
+        ]
+
+        # Remove inputs and outputs to free up memory
+        del generated_ids
+        del model_inputs
+        _release_cached_memory()
+
+        return generations
+
+
+def _decode_response(
+    tokenizer: Any, output_ids: List[int], prompt_tokens: Optional[int] = None
+) -> Generation:
+    """
+    Split the generated tokens at the end of the thinking process and decode both parts.
+
+    Args:
+        tokenizer (Any): the inference model's tokenizer.
+        output_ids (List[int]): the generated token ids, without the prompt.
+        prompt_tokens (Optional[int], optional): number of prompt tokens,
+            without padding. Defaults to None.
+
+    Returns:
+        Generation: the response text and thinking content.
+    """
     # Identify end of the thinking process
     try:
         # rindex finding 151668 (</think>)
@@ -70,86 +674,155 @@ def generate_text(
     except ValueError:
         index = 0
 
-    # Decode the response text (after the thinking process)
-    resp = INFERENCE_TOKENIZER.decode(
-        output_ids[index:], skip_special_tokens=True
-    ).strip("\n")
+    return Generation(
+        # Decode the response text (after the thinking process)
+        text=tokenizer.decode(output_ids[index:], skip_special_tokens=True).strip("\n"),
+        # Only decoded when it will be logged, it can be longer than the response
+        thinking=(
+            tokenizer.decode(output_ids[:index], skip_special_tokens=True).strip("\n")
+            if debug_enabled(logger)
+            else ""
+        ),
+        # Sequences that finished early are padded to the longest one
+        completion_tokens=sum(
+            token != tokenizer.pad_token_id for token in output_ids
+        ),
+        prompt_tokens=prompt_tokens,
+        thinking_tokens=index,
+    )
+
+
+_GENERATION_BACKEND: Optional[GenerationBackend] = None
+
+
+def get_generation_backend() -> GenerationBackend:
+    """
+    Get the generation backend selected by GENERATION_BACKEND: "hf" for the
+    in-process model, "openai" for an OpenAI compatible inference server.
+
+    Returns:
+        GenerationBackend: the shared generation backend.
+    """
+    global _GENERATION_BACKEND
+    with _LOAD_LOCKS["generation_backend"]:
+        if _GENERATION_BACKEND is None:
+            backends = {"hf": HFGenerationBackend, "openai": OpenAIGenerationBackend}
+            _GENERATION_BACKEND = backends[CONFIG["GENERATION_BACKEND"]]()
+    return _GENERATION_BACKEND
 
-    # If debugging is enabled, log the thinking content too
-    if logger.isEnabledFor(logging.DEBUG):
-        thinking_content = INFERENCE_TOKENIZER.decode(
-            output_ids[:index], skip_special_tokens=True
-        ).strip("\n")
-        logger.debug(f"Thinking content: {thinking_content}")
 
-    # Remove inputs and outputs to free up memory
-    del output_ids
-    del model_inputs
-    torch.cuda.empty_cache()
+def generation_stats() -> Dict[str, Any]:
+    """
+    Get the generate call, prompt, token and error counts and recent latencies.
 
-    return resp
+    Returns:
+        Dict[str, Any]: see generationBackends.GenerationStats.stats.
+    """
+    return GENERATION_STATS.stats()
 
 
 def embed_texts(
-    input_type: Literal["article", "query"], texts: List[str]
+    input_type: Literal["article", "query"],
+    texts: List[str],
+    input_ids: Optional[List[List[int]]] = None,
 ) -> torch.tensor:
     """
     Generate embeddings for the input texts.
     If input_type is 'query', uses the query embedding model and tokenizer, runs on cpu.
     If input_type is 'article', uses the article embedding model, which is loaded dynamically
-        on cuda to save memory. Model is deleted after use to free up memory.
+        on DEVICE to save memory. Model is deleted after use to free up memory,
+        unless it is held by hold_article_encoder.
 
     Args:
         input_type (Literal['article', 'query']): Type of input, either 'query' or 'article'.
             Determines which model and tokenizer to use for embedding.
         texts (List[str]): List of input texts to embed.
+        input_ids (Optional[List[List[int]]], optional): token ids of the texts,
+            without special tokens. If given, the texts are not tokenized again.
+            Defaults to None.
 
     Returns:
         torch.tensor: Embeddings for the input texts with shape (input_length, embedding_dim).
     """
 
+    held_encoder = _MODELS.get("article_encoder")
     if input_type == "query":
-        tokenizer = QUERY_EMBEDDING_TOKENIZER
-        model = QUERY_EMBEDDING_MODEL
+        tokenizer, model = get_model("query_encoder")
     elif input_type == "article":
-        # Load article embedding model
-        ARTICLE_EMBEDDING_TOKENIZER = AutoTokenizer.from_pretrained(
-            CONFIG["ARTICLE_EMBEDDING_MODEL"]
-        )
-        ARTICLE_EMBEDDING_MODEL = AutoModel.from_pretrained(
-            CONFIG["ARTICLE_EMBEDDING_MODEL"], device_map=CONFIG["DEVICE_MAP"]
-        )
-        tokenizer = ARTICLE_EMBEDDING_TOKENIZER
-        model = ARTICLE_EMBEDDING_MODEL
+        # Load article embedding model, unless it is held for ingestion
+        tokenizer, model = held_encoder or _load_article_encoder()
     else:
         raise ValueError("Invalid input type. Must be 'query' or 'article'.")
 
-    inputs = tokenizer(
+    embeddings = encode_texts(
+        tokenizer,
+        model,
         texts,
-        padding=True,
-        truncation=True,
-        return_tensors="pt",
-        max_length=512,
+        device=DEVICE if input_type == "article" else None,
+        input_ids=input_ids,
     )
 
-    if input_type == "article":
-        inputs = inputs.to("cuda")
+    # If input_type is 'article', delete the model and tokenizer to free up memory
+    if input_type == "article" and held_encoder is None:
+        del model
+        del tokenizer
+        if DEVICE == "cuda":
+            torch.cuda.empty_cache()
+
+    return embeddings
+
+
+def encode_texts(
+    tokenizer: Any,
+    model: Any,
+    texts: List[str],
+    device: Optional[str] = None,
+    input_ids: Optional[List[List[int]]] = None,
+) -> torch.tensor:
+    """
+    Embed texts with an encoder by mean pooling its last hidden state.
+
+    Args:
+        tokenizer (Any): the encoder's tokenizer.
+        model (Any): the encoder, a transformers model or an OnnxEncoder.
+        texts (List[str]): List of input texts to embed.
+        device (Optional[str], optional): device to move the inputs to.
+            Defaults to None, which keeps them on cpu.
+        input_ids (Optional[List[List[int]]], optional): token ids of the texts,
+            without special tokens. If given, they are used instead of tokenizing
+            the texts. Defaults to None.
+
+    Returns:
+        torch.tensor: Embeddings for the input texts with shape (input_length, embedding_dim).
+    """
+    if input_ids is not None:
+        inputs = tokenizer.pad(
+            {
+                "input_ids": [
+                    tokenizer.build_inputs_with_special_tokens(ids[:510])
+                    for ids in input_ids
+                ]
+            },
+            padding=True,
+            return_tensors="pt",
+        )
+    else:
+        inputs = tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            return_tensors="pt",
+            max_length=512,
+        )
+
+    if device is not None:
+        inputs = inputs.to(device)
 
     with torch.no_grad():
         outputs = model(**inputs)
 
     # Use the last hidden state as the embedding
-    embeddings = outputs.last_hidden_state.mean(dim=1).cpu()
-
-    # If input_type is 'article', delete the model and tokenizer to free up memory
-    if input_type == "article":
-        del ARTICLE_EMBEDDING_MODEL
-        del ARTICLE_EMBEDDING_TOKENIZER
-    del outputs
-    del inputs
-    torch.cuda.empty_cache()
-
-    return embeddings
+    return outputs.last_hidden_state.mean(dim=1).cpu()
 
 
 def rerank_chunks(query: str, chunks: List[str]) -> torch.tensor:
@@ -164,40 +837,149 @@ def rerank_chunks(query: str, chunks: List[str]) -> torch.tensor:
         torch.tensor: Scores for each chunk based on relevance the query.
             Higher scores indicate more relevant chunks.
     """
+    return rerank_pairs([(query, chunk) for chunk in chunks])
 
-    encoded = CROSS_ENCODER_TOKENIZER(
-        [[query, chunk] for chunk in chunks],
-        truncation=True,
-        padding=True,
-        return_tensors="pt",
-        max_length=512,
-    )
 
-    logits = CROSS_ENCODER_MODEL(**encoded).logits.squeeze(dim=1)
+def rerank_pairs(
+    pairs: List[Tuple[str, str]],
+    batch_size: int = CONFIG["RERANK_BATCH_SIZE"],
+) -> torch.tensor:
+    """
+    Score (query, chunk) pairs with the cross-encoder, batch_size pairs per
+    forward pass. Pairs of different queries can be mixed freely.
+
+    Args:
+        pairs (List[Tuple[str, str]]): the (query, chunk) pairs to score.
+        batch_size (int, optional): pairs per forward pass.
+            Defaults to CONFIG["RERANK_BATCH_SIZE"].
 
-    return logits
+    Returns:
+        torch.tensor: the relevance score of each pair, with shape (len(pairs),).
+    """
+    return score_pairs(*get_model("cross_encoder"), pairs, batch_size=batch_size)
 
 
-def generate_search_query(query: str, chat_history: str) -> str:
+def score_pairs(
+    tokenizer: Any,
+    model: Any,
+    pairs: List[Tuple[str, str]],
+    batch_size: int = CONFIG["RERANK_BATCH_SIZE"],
+) -> torch.tensor:
+    """
+    Score (query, chunk) pairs with a cross-encoder, batch_size pairs per
+    forward pass.
+
+    Args:
+        tokenizer (Any): the cross-encoder's tokenizer.
+        model (Any): the cross-encoder, a transformers model or a CompiledEncoder.
+        pairs (List[Tuple[str, str]]): the (query, chunk) pairs to score.
+        batch_size (int, optional): pairs per forward pass.
+            Defaults to CONFIG["RERANK_BATCH_SIZE"].
+
+    Returns:
+        torch.tensor: the relevance score of each pair, with shape (len(pairs),).
+    """
+    scores = []
+    for start in range(0, len(pairs), batch_size):
+        encoded = tokenizer(
+            [list(pair) for pair in pairs[start : start + batch_size]],
+            truncation=True,
+            padding=True,
+            return_tensors="pt",
+            max_length=512,
+        )
+
+        with torch.no_grad():
+            scores.append(model(**encoded).logits.squeeze(dim=1))
+
+    return torch.cat(scores) if scores else torch.empty(0)
+
+
+def _search_prompt(query: str, chat_history: str) -> str:
 
     sys_prompt = PROMPTS["system_prompt"]
     search_prompt = PROMPTS["search_prompt"].format(
         chat_history=chat_history, question=query
     )
 
-    prompt = f"{sys_prompt}\n\n{search_prompt}"
+    return f"{sys_prompt}\n\n{search_prompt}"
+
+
+def _chat_prompt(query: str, context: str) -> str:
+
+    sys_prompt = PROMPTS["system_prompt"]
+    chat_prompt = PROMPTS["chat_prompt"].format(question=query, context=context)
+
+    return f"{sys_prompt}\n\n{chat_prompt}"
+
+
+def generate_search_query(query: str, chat_history: str) -> str:
 
     return generate_text(
-        prompt,
+        _search_prompt(query, chat_history),
         enable_thinking=False,
     )
 
 
 def generate_chat_response(query: str, context: str) -> str:
 
-    sys_prompt = PROMPTS["system_prompt"]
-    chat_prompt = PROMPTS["chat_prompt"].format(question=query, context=context)
+    return generate_text(_chat_prompt(query, context), enable_thinking=True)
+
+
+def generate_search_queries(queries: List[str], chat_histories: List[str]) -> List[str]:
+    """
+    Batched generate_search_query.
 
-    prompt = f"{sys_prompt}\n\n{chat_prompt}"
+    Args:
+        queries (List[str]): the user queries.
+        chat_histories (List[str]): the chat history of each query.
+
+    Returns:
+        List[str]: the search query of each query.
+    """
+    return generate_texts(
+        [_search_prompt(q, h) for q, h in zip(queries, chat_histories)],
+        enable_thinking=False,
+    )
 
-    return generate_text(prompt, enable_thinking=True)
+
+def generate_chat_responses_with_usage(
+    queries: List[str], contexts: List[str]
+) -> List[Tuple[str, Dict[str, Optional[int]]]]:
+    """
+    generate_chat_responses, also returning the token counts of each response.
+
+    Args:
+        queries (List[str]): the search queries.
+        contexts (List[str]): the retrieved context of each query.
+
+    Returns:
+        List[Tuple[str, Dict[str, Optional[int]]]]: the response to each query
+            and its prompt, thinking and answer token counts.
+    """
+    return [
+        (generation.text, generation.usage())
+        for generation in _generate(
+            [_chat_prompt(q, c) for q, c in zip(queries, contexts)],
+            enable_thinking=True,
+            max_new_tokens=CONFIG["MAX_NEW_TOKENS"],
+            batch_size=CONFIG["GENERATION_BATCH_SIZE"],
+        )
+    ]
+
+
+def generate_chat_responses(queries: List[str], contexts: List[str]) -> List[str]:
+    """
+    Batched generate_chat_response.
+
+    Args:
+        queries (List[str]): the search queries.
+        contexts (List[str]): the retrieved context of each query.
+
+    Returns:
+        List[str]: the response to each query.
+    """
+    return generate_texts(
+        [_chat_prompt(q, c) for q, c in zip(queries, contexts)],
+        enable_thinking=True,
+    )
@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+
+@dataclass
+class RequestRecord:
+    """
+    Outcome of one request made during a load test.
+    """
+
+    endpoint: str
+    started_at: float
+    seconds: float
+    status_code: Optional[int]
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.status_code == 200
+
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    if len(values) == 1:
+        return {"p50": values[0], "p95": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def summarise(records: List[RequestRecord], elapsed: float) -> Dict[str, Any]:
+    """
+    Summarise the requests of one load level.
+
+    Args:
+        records (List[RequestRecord]): the requests made.
+        elapsed (float): duration of the load level in seconds.
+
+    Returns:
+        Dict[str, Any]: per endpoint request count, error rate, status code counts
+            and p50/p95/p99 latency of successful requests in seconds, plus the
+            throughput of answered chat queries per second.
+    """
+    endpoints = {}
+    for endpoint in sorted({r.endpoint for r in records}):
+        endpoint_records = [r for r in records if r.endpoint == endpoint]
+        status_codes: Dict[str, int] = {}
+        for r in endpoint_records:
+            key = str(r.status_code) if r.status_code is not None else "no response"
+            status_codes[key] = status_codes.get(key, 0) + 1
+        latencies = _percentiles([r.seconds for r in endpoint_records if r.ok])
+        endpoints[endpoint] = {
+            "requests": len(endpoint_records),
+            "error_rate": round(
+                sum(not r.ok for r in endpoint_records) / len(endpoint_records), 4
+            ),
+            "status_codes": status_codes,
+            **{
+                f"{name}_s": round(value, 3) if value is not None else None
+                for name, value in latencies.items()
+            },
+        }
+
+    answered = sum(r.ok for r in records if r.endpoint == "/chat_response")
+    return {
+        "elapsed_s": round(elapsed, 1),
+        "chat_throughput_per_s": round(answered / elapsed, 3) if elapsed else 0.0,
+        "error_rate": (
+            round(sum(not r.ok for r in records) / len(records), 4) if records else 0.0
+        ),
+        "endpoints": endpoints,
+    }
+
+
+def find_saturation(
+    levels: List[Dict[str, Any]], slo_p95: float, max_error_rate: float
+) -> Dict[str, Any]:
+    """
+    Find the first load level at which the backend is saturated: the chat
+    p95 latency exceeds the SLO, the error rate exceeds its limit, or throughput
+    grows by less than 10% over the previous level.
+
+    Args:
+        levels (List[Dict[str, Any]]): the "load" and summary of each level,
+            in increasing load order.
+        slo_p95 (float): p95 latency objective for /chat_response in seconds.
+        max_error_rate (float): highest acceptable error rate.
+
+    Returns:
+        Dict[str, Any]: the saturating load and why, and the highest load
+            that met the objectives.
+    """
+    sustainable = None
+    for i, level in enumerate(levels):
+        chat = level["summary"]["endpoints"].get("/chat_response", {})
+        reasons = []
+        if chat.get("p95_s") is None or chat["p95_s"] > slo_p95:
+            reasons.append(f"chat p95 above {slo_p95}s")
+        if level["summary"]["error_rate"] > max_error_rate:
+            reasons.append(f"error rate above {max_error_rate}")
+        if i > 0:
+            previous = levels[i - 1]["summary"]["chat_throughput_per_s"]
+            if level["summary"]["chat_throughput_per_s"] < previous * 1.1:
+                reasons.append("throughput stopped growing")
+
+        if reasons:
+            return {
+                "saturated_at": level["load"],
+                "reasons": reasons,
+                "max_sustainable_load": sustainable,
+            }
+        sustainable = level["load"]
+
+    return {"saturated_at": None, "reasons": [], "max_sustainable_load": sustainable}
+
+
+class LoadTest:
+    """
+    Replays questions against the backend as multi-turn user sessions: each
+    session starts a chat session, asks several questions with the growing chat
+    history (as the frontend does), and sometimes submits feedback on an answer.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        questions: List[str],
+        turns: int,
+        think_time: float,
+        feedback_rate: float,
+        rng: random.Random,
+    ):
+        self.client = client
+        self.questions = questions
+        self.turns = turns
+        self.think_time = think_time
+        self.feedback_rate = feedback_rate
+        self.rng = rng
+        self.records: List[RequestRecord] = []
+
+    async def _post(self, endpoint: str, payload: Dict[str, Any]) -> Optional[Any]:
+        """
+        Post a request and record its outcome.
+
+        Returns:
+            Optional[Any]: the decoded response body, or None if the request failed.
+        """
+        start = time.perf_counter()
+        try:
+            response = await self.client.post(endpoint, json=payload)
+        except httpx.HTTPError as e:
+            self.records.append(
+                RequestRecord(
+                    endpoint,
+                    start,
+                    time.perf_counter() - start,
+                    None,
+                    f"{type(e).__name__}: {e}",
+                )
+            )
+            return None
+
+        record = RequestRecord(
+            endpoint, start, time.perf_counter() - start, response.status_code
+        )
+        body = None
+        if response.status_code != 200:
+            record.error = response.text[:200]
+        else:
+            try:
+                body = response.json()
+            except ValueError as e:
+                record.error = f"Invalid JSON response: {e}"
+        self.records.append(record)
+        return body
+
+    async def run_session(self, user_id: int) -> None:
+        session_id = await self._post("/start_session", {"user_id": user_id})
+        if session_id is None:
+            return
+
+        history = []
+        for _ in range(self.turns):
+            question = self.rng.choice(self.questions)
+            history.append(f"user: {question}")
+            result = await self._post(
+                "/chat_response",
+                {
+                    "query": question,
+                    "chat_history": "\n\n".join(history),
+                    "session_id": session_id,
+                },
+            )
+            if result is None:
+                return
+            history.append(f"assistant: {result['response']}")
+
+            if self.rng.random() < self.feedback_rate:
+                await self._post(
+                    "/submit_feedback",
+                    {
+                        "message_id": result["message_id"],
+                        "is_good": self.rng.random() < 0.5,
+                    },
+                )
+            if self.think_time:
+                await asyncio.sleep(self.rng.expovariate(1 / self.think_time))
+
+    async def closed_loop(self, concurrency: int, duration: float) -> None:
+        """
+        Keep concurrency users busy: each starts a new session as soon as
+        the previous one ends, until duration has passed.
+        """
+        deadline = time.perf_counter() + duration
+
+        async def user(user_id: int) -> None:
+            while time.perf_counter() < deadline:
+                await self.run_session(user_id)
+
+        await asyncio.gather(*(user(i) for i in range(concurrency)))
+
+    async def open_loop(self, rate: float, duration: float) -> None:
+        """
+        Start new sessions at random (Poisson) arrival times with the given
+        mean rate per second for duration seconds, however slowly the backend
+        answers, and wait for every started session to end.
+        """
+        deadline = time.perf_counter() + duration
+        sessions = []
+        user_id = 0
+        while time.perf_counter() < deadline:
+            sessions.append(asyncio.create_task(self.run_session(user_id)))
+            user_id += 1
+            await asyncio.sleep(self.rng.expovariate(rate))
+        await asyncio.gather(*sessions)
+
+
+async def run_levels(args: argparse.Namespace) -> Dict[str, Any]:
+    with open(args.eval_file) as file:
+        questions = [test["question"] for test in json.load(file).values()]
+
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    levels = []
+    async with httpx.AsyncClient(
+        base_url=args.url, timeout=args.timeout, limits=limits
+    ) as client:
+        for load in args.levels:
+            test = LoadTest(
+                client, questions, args.turns, args.think_time, args.feedback_rate, rng
+            )
+            start = time.perf_counter()
+            if args.mode == "closed":
+                await test.closed_loop(int(load), args.duration)
+            else:
+                await test.open_loop(load, args.duration)
+            summary = summarise(test.records, time.perf_counter() - start)
+            levels.append({"load": load, "summary": summary})
+
+            chat = summary["endpoints"].get("/chat_response", {})
+            print(
+                f"{args.mode} load {load}: "
+                f"{summary['chat_throughput_per_s']} chats/s, "
+                f"chat p50/p95/p99 = {chat.get('p50_s')}/{chat.get('p95_s')}/"
+                f"{chat.get('p99_s')} s, error rate {summary['error_rate']}"
+            )
+
+    return {
+        "mode": args.mode,
+        "levels": levels,
+        "saturation": find_saturation(levels, args.slo_p95, args.max_error_rate),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Replay questions against a running backend as concurrent multi-turn "
+            "sessions and report latency percentiles, throughput, error rate "
+            "and the saturation point."
+        )
+    )
+    parser.add_argument("--url", default="http://localhost:5050")
+    parser.add_argument("--eval-file", default="../../notebooks/eval_tests.json")
+    parser.add_argument(
+        "--mode",
+        choices=["closed", "open"],
+        default="closed",
+        help="closed: levels are concurrent users. open: levels are sessions/s.",
+    )
+    parser.add_argument("--levels", nargs="+", type=float, default=[1, 2, 4, 8, 16])
+    parser.add_argument("--duration", type=float, default=60, help="Seconds per level.")
+    parser.add_argument("--turns", type=int, default=3, help="Questions per session.")
+    parser.add_argument("--think-time", type=float, default=2.0)
+    parser.add_argument("--feedback-rate", type=float, default=0.3)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--slo-p95", type=float, default=30.0)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the full report to this JSON file.")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_levels(args))
+    saturation = report["saturation"]
+    if saturation["saturated_at"] is None:
+        print(f"Not saturated up to {args.mode} load {args.levels[-1]}.")
+    else:
+        print(
+            f"Saturated at {args.mode} load {saturation['saturated_at']} "
+            f"({', '.join(saturation['reasons'])}). "
+            f"Highest load meeting objectives: {saturation['max_sustainable_load']}."
+        )
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,71 @@
+import fcntl
+import hmac
 import logging
+import os
+import threading
+import time
 from collections import defaultdict
 from contextlib import asynccontextmanager
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple
 
 import toml
-from fastapi import FastAPI, Request, status
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, status
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 from fastapi.exceptions import RequestValidationError
 from fastapi.encoders import jsonable_encoder
 from sqlalchemy import select
 from sqlalchemy.orm import Session as SQLAlchemySession
 from sqlalchemy.exc import NoResultFound
 
+from requestLogging import configure_logging, correlation, set_session
+
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    filename=f"logs/{datetime.now().strftime('%d-%m-%Y_%H')}.log",
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    filemode="w",
+configure_logging(filename=f"logs/{datetime.now().strftime('%d-%m-%Y_%H')}.log")
+
+from diagnostics import (
+    allocation_stats,
+    process_memory,
+    profile_filename,
+    sample_stacks,
+    start_tracemalloc,
+    stop_tracemalloc,
 )
-
+from modelClient import (
+    generation_stats,
+    load_models,
+    memory_stats,
+    model_server_available,
+    model_status,
+    sample_stacks as sample_model_stacks,
+    start_model_server,
+    warmup,
+)
+from admission import ADMISSION, AdmissionRejected, DeadlineExceeded
+from corpusSnapshot import import_snapshot
+from ingestionPipeline import ingestion_stats
+from kpiRollups import (
+    Granularity,
+    get_kpis,
+    rebuild_kpi_rollups,
+    record_feedback,
+    record_session,
+)
+from messageLog import start_maintenance
 from ormModels import Session, Message
-from pydanticModels import ChatQuery, ChatResponse, SessionRequest, FeedbackRequest
-from rag import rag
+from pydanticModels import (
+    ChatQuery,
+    ChatQueryBatch,
+    ChatResponse,
+    ChatResponseBatch,
+    SessionRequest,
+    FeedbackRequest,
+)
+from rag import rag, rag_batch
+from requestTrace import slowest_requests
+from retrieval import close_retrieval_backend, get_retrieval_backend
+from speculativeRetrieval import SPECULATION_STATS
 from sqlFunctions import create_connection, insert_data
 from textProcessing import process_directory
 
@@ -31,6 +73,219 @@ from textProcessing import process_directory
 CONFIG = toml.load("config.toml")
 
 
+# Startup state of each component, reported by /healthz and /readyz
+STARTUP_STATUS: Dict[str, Dict[str, Any]] = {
+    name: {"state": "pending", "seconds": None, "error": None}
+    for name in ("model_server", "database", "snapshot", "ingestion", "retrieval")
+}
+READY_STATES = ("ready", "skipped")
+ENGINE = None
+MODEL_SERVER = None
+# Stops the message log maintenance thread of the primary worker
+MESSAGE_LOG_MAINTENANCE = None
+# The primary worker's open PRIMARY_LOCK file, holding its lock until it exits
+_PRIMARY_LOCK_FILE = None
+_IS_READY = False
+
+
+def _run_startup_step(name: str, func: Callable, *args, **kwargs) -> Any:
+    """
+    Run a startup step, recording its state and duration in STARTUP_STATUS.
+
+    Args:
+        name (str): the component the step starts.
+        func (Callable): the function to run.
+        *args, **kwargs: arguments passed to func.
+
+    Returns:
+        Any: the return value of func.
+    """
+    STARTUP_STATUS[name].update(state="loading", error=None)
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        STARTUP_STATUS[name].update(state="failed", error=str(e))
+        raise
+    STARTUP_STATUS[name].update(
+        state="ready", seconds=round(time.perf_counter() - start, 3)
+    )
+    return result
+
+
+def _load_models() -> None:
+    """
+    Load all models in parallel, then run a warmup pass through each of them.
+    """
+    load_models()
+    warmup()
+
+
+def _take_primary_lock() -> Tuple[bool, bool]:
+    """
+    Try to become the primary worker by taking PRIMARY_LOCK without waiting.
+    The lock is held until this worker exits, so a worker restarted by uvicorn
+    takes it over. The lock file records the uvicorn supervisor (this worker's
+    parent) that the database was set up under, see _mark_initialized.
+
+    Returns:
+        Tuple[bool, bool]: whether this worker is the primary, and whether the
+            database was already set up under the running supervisor.
+    """
+    global _PRIMARY_LOCK_FILE
+
+    lock_file = open(CONFIG["PRIMARY_LOCK"], "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False, True
+
+    _PRIMARY_LOCK_FILE = lock_file
+    lock_file.seek(0)
+    return True, lock_file.read().strip() == str(os.getppid())
+
+
+def _mark_initialized() -> None:
+    # Record that the database was set up under the running supervisor, so a
+    # restarted primary does not rebuild it or ingest again
+    _PRIMARY_LOCK_FILE.seek(0)
+    _PRIMARY_LOCK_FILE.truncate()
+    _PRIMARY_LOCK_FILE.write(str(os.getppid()))
+    _PRIMARY_LOCK_FILE.flush()
+
+
+def startup() -> None:
+    """
+    Start the model server, connect to the database and ingest new sources.
+    Runs in a background thread so the API can answer health checks meanwhile.
+
+    Workers start one at a time, under the startup lock. The first one becomes
+    the primary (see _take_primary_lock): it (re)builds the database, ingests
+    sources, and runs the KPI backfill and message log maintenance for as
+    long as it runs. A primary restarted by uvicorn takes over the maintenance,
+    but does not rebuild or ingest again. The model server is launched by
+    whichever worker finds it missing, and the others attach to it.
+    """
+    global ENGINE, MODEL_SERVER, MESSAGE_LOG_MAINTENANCE
+
+    try:
+        with open(CONFIG["STARTUP_LOCK"], "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            is_primary, initialized = _take_primary_lock()
+            setup = is_primary and not initialized
+
+            starts_server = CONFIG["USE_MODEL_SERVER"] and not model_server_available()
+            if starts_server:
+                MODEL_SERVER = _run_startup_step("model_server", start_model_server)
+            else:
+                STARTUP_STATUS["model_server"].update(state="skipped")
+
+            # Load models while the database is set up and sources are ingested.
+            # Without the model server, every worker holds its own models.
+            if starts_server or not CONFIG["USE_MODEL_SERVER"]:
+                threading.Thread(target=_load_models, daemon=True).start()
+
+            # Create engine
+            ENGINE = _run_startup_step(
+                "database",
+                create_connection,
+                force_rebuild=CONFIG["FORCE_REBUILD"] and setup,
+            )
+
+            # Backfill the KPI rollups of a database that predates them, and
+            # keep creating and archiving the message log's monthly partitions
+            if is_primary:
+                rebuild_kpi_rollups(ENGINE, only_if_empty=True)
+                MESSAGE_LOG_MAINTENANCE = start_maintenance(ENGINE)
+
+            # Bulk load the corpus of a snapshot, so ingestion skips its files
+            if setup and CONFIG["SNAPSHOT_IMPORT_PATH"]:
+                _run_startup_step("snapshot", import_snapshot, ENGINE)
+            else:
+                STARTUP_STATUS["snapshot"].update(state="skipped")
+
+            # Process sources directory
+            if setup:
+                _run_startup_step(
+                    "ingestion",
+                    process_directory,
+                    directory=Path(CONFIG["SOURCES_DIR"]),
+                    engine=ENGINE,
+                )
+                _mark_initialized()
+            else:
+                STARTUP_STATUS["ingestion"].update(state="skipped")
+
+            # Build or load the retrieval backend once the chunks are in
+            _run_startup_step("retrieval", get_retrieval_backend, ENGINE)
+    except Exception:
+        logger.exception("Startup failed.")
+
+
+def component_status() -> Dict[str, Dict[str, Any]]:
+    """
+    Get the state and startup duration of every component, including each model.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: state, duration in seconds and error per component.
+    """
+    components = {name: dict(status) for name, status in STARTUP_STATUS.items()}
+
+    if components["model_server"]["state"] in READY_STATES:
+        try:
+            components.update(model_status())
+        except Exception as e:
+            components["models"] = {"state": "failed", "seconds": None, "error": str(e)}
+    else:
+        components["models"] = {"state": "pending", "seconds": None, "error": None}
+
+    return components
+
+
+def require_ready() -> None:
+    """
+    Dependency rejecting requests until every component is ready.
+
+    Raises:
+        HTTPException: 503 if the backend is still starting or startup failed.
+    """
+    global _IS_READY
+    if _IS_READY:
+        return
+
+    components = component_status()
+    if all(c["state"] in READY_STATES for c in components.values()):
+        _IS_READY = True
+        return
+
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Backend is starting up.",
+        headers={"Retry-After": "10"},
+    )
+
+
+def require_debug(x_debug_token: Optional[str] = Header(None)) -> None:
+    """
+    Dependency guarding the /debug endpoints: they only exist when
+    DEBUG_ENDPOINTS is set, and need the X-Debug-Token header to match the
+    DEBUG_TOKEN environment variable when it is set.
+
+    Raises:
+        HTTPException: 404 if the endpoints are disabled, 403 if the token is wrong.
+    """
+    if not CONFIG["DEBUG_ENDPOINTS"]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    token = os.environ.get("DEBUG_TOKEN")
+    if token and not hmac.compare_digest(token, x_debug_token or ""):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid debug token."
+        )
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
@@ -43,24 +298,32 @@ async def lifespan(app: FastAPI):
             lifespan.
     """
     # Startup events
-
-    # Create engine
-    global ENGINE
-    ENGINE = create_connection()
-
-    # Process sources directory
-    process_directory(
-        directory=Path(CONFIG["SOURCES_DIR"]),
-        engine=ENGINE,
-    )
+    threading.Thread(target=startup, daemon=True).start()
 
     yield
     # Shutdown events
+    close_retrieval_backend()
+    if MESSAGE_LOG_MAINTENANCE is not None:
+        MESSAGE_LOG_MAINTENANCE.set()
+    # The model server is left running for the other workers. It exits with
+    # the uvicorn supervisor, see start_model_server.
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+@app.middleware("http")
+async def correlation_middleware(request: Request, call_next: Callable) -> Response:
+    """
+    Tag every log line of a request with its id, taken from the X-Request-ID
+    header or generated, and return the id in the same header.
+    """
+    with correlation(request_id=request.headers.get("X-Request-ID")) as request_id:
+        response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
 @app.exception_handler(RequestValidationError)
 async def custom_form_validation_error(
     request: Request, exc: RequestValidationError
@@ -92,12 +355,244 @@ async def custom_form_validation_error(
     )
 
 
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(
+    request: Request, exc: AdmissionRejected
+) -> JSONResponse:
+    """
+    Tells callers to back off when the admission queue is full.
+    """
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(
+    request: Request, exc: DeadlineExceeded
+) -> JSONResponse:
+    """
+    Reports requests abandoned because their deadline passed.
+    """
+    return JSONResponse(
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+        content={"detail": str(exc)},
+    )
+
+
+def _deadline(timeout: Optional[float]) -> float:
+    """
+    Get the time.monotonic() deadline of a request, from the X-Request-Timeout
+    header sent by the caller or ADMISSION_DEFAULT_TIMEOUT.
+    """
+    return time.monotonic() + (timeout or CONFIG["ADMISSION_DEFAULT_TIMEOUT"])
+
+
 #####################
 # Endpoints
 #####################
 
 
-@app.post("/start_session")
+@app.get("/healthz")
+def healthz() -> JSONResponse:
+    """
+    Liveness probe. Succeeds while the backend is starting or ready,
+    and fails only if a component failed to start.
+
+    Returns:
+        JSONResponse: overall status and per-component state and durations.
+    """
+    components = component_status()
+    failed = any(c["state"] == "failed" for c in components.values())
+    ready = all(c["state"] in READY_STATES for c in components.values())
+
+    return JSONResponse(
+        status_code=(
+            status.HTTP_503_SERVICE_UNAVAILABLE if failed else status.HTTP_200_OK
+        ),
+        content={
+            "status": "failed" if failed else "ready" if ready else "starting",
+            "components": components,
+        },
+    )
+
+
+@app.get("/readyz")
+def readyz() -> JSONResponse:
+    """
+    Readiness probe. Succeeds only once every component is ready to serve requests.
+
+    Returns:
+        JSONResponse: overall status and per-component state and durations.
+    """
+    components = component_status()
+    ready = all(c["state"] in READY_STATES for c in components.values())
+
+    return JSONResponse(
+        status_code=(
+            status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+        content={
+            "status": "ready" if ready else "not ready",
+            "components": components,
+        },
+    )
+
+
+@app.get("/metrics/ingestion")
+def ingestion_metrics() -> Dict[str, Any]:
+    """
+    Throughput and utilisation of each ingestion stage and the depth of the
+    queues between them, for the ingestion running in (or last run by) this worker.
+
+    Returns:
+        Dict[str, Any]: see ingestionPipeline.IngestionPipeline.stats.
+    """
+    return ingestion_stats()
+
+
+@app.get("/metrics/admission")
+def admission_metrics() -> Dict[str, Any]:
+    """
+    Queue depth per priority class, running requests, admitted, rejected and
+    expired request counts, and recent queue wait times of this worker.
+
+    Returns:
+        Dict[str, Any]: see admission.AdmissionController.stats.
+    """
+    return ADMISSION.stats()
+
+
+@app.get("/metrics/generation")
+def generation_metrics() -> Dict[str, Any]:
+    """
+    Generate call, prompt, token and error counts, throughput and recent
+    latency and time to first token percentiles of the generation backend.
+
+    Returns:
+        Dict[str, Any]: see generationBackends.GenerationStats.stats.
+    """
+    return generation_stats()
+
+
+@app.get("/metrics/speculation")
+def speculation_metrics() -> Dict[str, Any]:
+    """
+    Speculative retrieval outcome counts, hit rate and the retrieval time it
+    hid behind query rewriting, since this API worker started.
+
+    Returns:
+        Dict[str, Any]: see speculativeRetrieval.SpeculationStats.stats.
+    """
+    return SPECULATION_STATS.stats()
+
+
+@app.get("/debug/memory", dependencies=[Depends(require_debug)])
+def debug_memory() -> Dict[str, Any]:
+    """
+    Memory of this API worker and of the model process: RSS, torch allocator
+    statistics of each CUDA device, parameter memory of each loaded model and
+    the top Python allocations of each pipeline stage while tracemalloc traces.
+
+    Returns:
+        Dict[str, Any]: "api_worker" and "models" memory.
+    """
+    return {
+        "api_worker": {**process_memory(), "tracemalloc": allocation_stats()},
+        "models": memory_stats(),
+    }
+
+
+@app.post("/debug/tracemalloc", dependencies=[Depends(require_debug)])
+def debug_tracemalloc(enable: bool) -> Dict[str, Any]:
+    """
+    Start or stop tracing the Python allocations of this API worker. While
+    tracing, each pipeline stage records its top allocations, reported by
+    /debug/memory.
+
+    Args:
+        enable (bool): start (true) or stop (false) tracing.
+
+    Returns:
+        Dict[str, Any]: see diagnostics.allocation_stats.
+    """
+    if enable:
+        start_tracemalloc()
+    else:
+        stop_tracemalloc()
+    return allocation_stats()
+
+
+@app.get("/debug/profile", dependencies=[Depends(require_debug)])
+def debug_profile(
+    seconds: float = 10, process: Literal["api", "models"] = "api"
+) -> PlainTextResponse:
+    """
+    Sample the Python stacks of this API worker or of the model process for a
+    number of seconds, and download them as folded stacks for flamegraph.pl,
+    speedscope or inferno.
+
+    Args:
+        seconds (float): how long to sample, up to DEBUG_PROFILE_MAX_SECONDS.
+            Defaults to 10.
+        process (str): "api" (this worker, default) or "models".
+
+    Returns:
+        PlainTextResponse: the folded stacks, as an attachment.
+    """
+    if process == "api":
+        stacks = sample_stacks(seconds)
+    else:
+        stacks = sample_model_stacks(seconds)
+    return PlainTextResponse(
+        stacks,
+        headers={
+            "Content-Disposition": f'attachment; filename="{profile_filename(process)}"'
+        },
+    )
+
+
+@app.get("/metrics/kpis", dependencies=[Depends(require_ready)])
+def kpi_metrics(
+    granularity: Granularity = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    """
+    User interaction KPIs per hour or day, read from the rollup tables so the
+    message log is never scanned. See documentation/evaluation.md.
+
+    Args:
+        granularity (str): "hour" or "day". Defaults to "day".
+        start (Optional[datetime]): first bucket. Defaults to 30 days (2 days
+            for hours) before end.
+        end (Optional[datetime]): end of the range. Defaults to now.
+
+    Returns:
+        Dict[str, Any]: see kpiRollups.get_kpis.
+    """
+    return jsonable_encoder(get_kpis(ENGINE, granularity, start, end))
+
+
+@app.get("/metrics/slow_requests", dependencies=[Depends(require_ready)])
+def slow_requests(limit: int = 20, hours: float = 24) -> List[Dict[str, Any]]:
+    """
+    The slowest recent chat requests, with the duration of each pipeline
+    stage, token counts, candidate and rerank counts, cache hits and queue wait.
+
+    Args:
+        limit (int): number of requests. Defaults to 20.
+        hours (float): how far back to look. Defaults to 24.
+
+    Returns:
+        List[Dict[str, Any]]: see requestTrace.slowest_requests.
+    """
+    return jsonable_encoder(slowest_requests(ENGINE, limit=limit, hours=hours))
+
+
+@app.post("/start_session", dependencies=[Depends(require_ready)])
 def start_session(request: SessionRequest) -> int:
 
     session_data = {
@@ -110,30 +605,79 @@ def start_session(request: SessionRequest) -> int:
         table=Session,
         data=session_data,
     )[0]
+    set_session(session.session_id)
     logger.info(f"Session started: {session}")
+    record_session(ENGINE, session)
 
     return session.session_id
 
 
-@app.post("/chat_response")
-def chat_response(request: ChatQuery) -> ChatResponse:
+@app.post("/chat_response", dependencies=[Depends(require_ready)])
+def chat_response(
+    request: ChatQuery,
+    x_priority: Literal["interactive", "bulk"] = Header("interactive"),
+    x_request_timeout: Optional[float] = Header(None),
+) -> ChatResponse:
     """
-    Generate a response to a chat query.
+    Generate a response to a chat query. The request waits for a slot in the
+    admission queue first, see admission.AdmissionController.
 
     Args:
         request (ChatQuery): the query to respond to
+        x_priority (str): priority class, "interactive" (default) or "bulk"
+        x_request_timeout (Optional[float]): seconds the caller will wait
+            for the response. Defaults to ADMISSION_DEFAULT_TIMEOUT.
 
     Returns:
         ChatResponse: the model's response and any retrieved
             context.
     """
-
-    resp = rag(request=request, engine=ENGINE)
+    set_session(request.session_id)
+    deadline = _deadline(x_request_timeout)
+    with ADMISSION.admit(priority=x_priority, deadline=deadline) as queue_seconds:
+        resp = rag(
+            request=request,
+            engine=ENGINE,
+            deadline=deadline,
+            queue_seconds=queue_seconds,
+        )
 
     return resp
 
 
-@app.post("/submit_feedback")
+@app.post("/chat_response_batch", dependencies=[Depends(require_ready)])
+def chat_response_batch(
+    request: ChatQueryBatch,
+    x_priority: Literal["interactive", "bulk"] = Header("bulk"),
+    x_request_timeout: Optional[float] = Header(None),
+) -> ChatResponseBatch:
+    """
+    Generate responses to many chat queries, running each pipeline stage
+    batched across them. Meant for evaluation and bulk workloads, so it is
+    admitted with "bulk" priority by default.
+
+    Args:
+        request (ChatQueryBatch): the queries to respond to
+        x_priority (str): priority class, "interactive" or "bulk" (default)
+        x_request_timeout (Optional[float]): seconds the caller will wait
+            for the response. Defaults to ADMISSION_DEFAULT_TIMEOUT.
+
+    Returns:
+        ChatResponseBatch: the response or error of each query, in input order.
+    """
+    deadline = _deadline(x_request_timeout)
+    with ADMISSION.admit(priority=x_priority, deadline=deadline) as queue_seconds:
+        results = rag_batch(
+            requests=request.queries,
+            engine=ENGINE,
+            deadline=deadline,
+            queue_seconds=queue_seconds,
+        )
+
+    return ChatResponseBatch(results=results)
+
+
+@app.post("/submit_feedback", dependencies=[Depends(require_ready)])
 def submit_feedback(request: FeedbackRequest) -> JSONResponse:
     """
     Submit feedback for a chat response.
@@ -143,9 +687,27 @@ def submit_feedback(request: FeedbackRequest) -> JSONResponse:
     """
     try:
         with SQLAlchemySession(ENGINE) as session:
-            stmt = select(Message).where(Message.message_id == request.message_id)
-            message = session.execute(stmt).scalars().one()
+            # Feedback is usually on a recent message, so look in the recent
+            # partitions of the message log before searching all of them. The
+            # row stays locked until the rollups are updated, so concurrent
+            # feedback on it sees the previous feedback.
+            stmt = (
+                select(Message)
+                .where(Message.message_id == request.message_id)
+                .with_for_update()
+            )
+            recent = datetime.now() - timedelta(days=CONFIG["MESSAGE_HOT_DAYS"])
+            message = session.execute(
+                stmt.where(Message.received_at >= recent)
+            ).scalar_one_or_none()
+            if message is None:
+                message = session.execute(stmt).scalars().one()
+            previous = message.is_good
             message.is_good = request.is_good
+            if message.received_at is not None:
+                record_feedback(
+                    session, message.received_at, previous, request.is_good
+                )
             session.commit()
         return JSONResponse(
             status_code=status.HTTP_200_OK,
@@ -0,0 +1,404 @@
+import logging
+import os
+import re
+import threading
+from datetime import date, datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import toml
+from sqlalchemy import Engine, inspect, text
+from sqlalchemy.orm import Session
+
+from ormModels import Base
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# The message log tables, partitioned by month on the message's received_at.
+# message_context and message_traces reference messages, so they are archived
+# and dropped first.
+PARTITIONED_TABLES = ("message_context", "message_traces", "messages")
+# The tables that existed before partitioning, see migrate_unpartitioned
+_UNPARTITIONED_TABLES = ("message_context", "messages")
+_PARTITION_NAME = re.compile(r"^(?P<table>\w+)_(?P<year>\d{4})_(?P<month>\d{2})$")
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _month_start(timestamp: datetime) -> date:
+    return date(timestamp.year, timestamp.month, 1)
+
+
+def _partition_name(table: str, month: date) -> str:
+    return f"{table}_{month.year:04d}_{month.month:02d}"
+
+
+def list_partitions(engine: Engine, table: str) -> List[Tuple[str, date]]:
+    """
+    List the monthly partitions of a message log table, oldest first.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        table (str): "messages" or "message_context".
+
+    Returns:
+        List[Tuple[str, date]]: the name and month of each partition.
+    """
+    with Session(engine) as session:
+        names = session.scalars(
+            text(
+                "SELECT child.relname FROM pg_inherits "
+                "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+                "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+                "WHERE parent.relname = :table"
+            ),
+            {"table": table},
+        ).all()
+
+    partitions = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match and match["table"] == table:
+            partitions.append((name, date(int(match["year"]), int(match["month"]), 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def _create_month(session: Session, month: date) -> None:
+    """
+    Create the partitions of a month, unless they exist. Rows of the month
+    already in the default partitions are moved into them: Postgres refuses to
+    create a partition while the default partition holds rows belonging to it.
+    """
+    missing = [
+        table
+        for table in reversed(PARTITIONED_TABLES)
+        if session.scalar(
+            text("SELECT to_regclass(:name)"), {"name": _partition_name(table, month)}
+        )
+        is None
+    ]
+    if not missing:
+        return
+
+    bounds = {"start": month, "end": _add_months(month, 1)}
+    in_month = "received_at >= :start AND received_at < :end"
+    moved = [
+        table
+        for table in missing
+        if session.scalar(
+            text(f"SELECT EXISTS (SELECT 1 FROM {table}_default WHERE {in_month})"),
+            bounds,
+        )
+    ]
+    for table in moved:
+        session.execute(
+            text(
+                f"CREATE TEMPORARY TABLE moved_{table} ON COMMIT DROP AS "
+                f"SELECT * FROM {table}_default WHERE {in_month}"
+            ),
+            bounds,
+        )
+    # Referencing rows first, then the messages they reference
+    for table in reversed(moved):
+        session.execute(text(f"DELETE FROM {table}_default WHERE {in_month}"), bounds)
+
+    for table in missing:
+        session.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {_partition_name(table, month)} "
+                f"PARTITION OF {table} FOR VALUES "
+                f"FROM ('{month.isoformat()}') "
+                f"TO ('{_add_months(month, 1).isoformat()}')"
+            )
+        )
+    for table in moved:
+        session.execute(text(f"INSERT INTO {table} SELECT * FROM moved_{table}"))
+    if moved:
+        logger.info(f"Moved the rows of {month:%Y-%m} out of the default partitions.")
+
+
+def ensure_partitions(
+    engine: Engine,
+    start: Optional[datetime] = None,
+    months_ahead: int = CONFIG["MESSAGE_PARTITIONS_AHEAD"],
+) -> None:
+    """
+    Create a default partition of each message log table, catching rows outside
+    the monthly partitions, and the monthly partitions from the month of start
+    to months_ahead months after the current one. Every month with rows in
+    the default partitions also gets its partitions, and the rows are moved
+    there, so they are archived like any other.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        start (Optional[datetime], optional): the first month to create.
+            Defaults to the current month.
+        months_ahead (int, optional): months to create after the current one.
+            Defaults to CONFIG["MESSAGE_PARTITIONS_AHEAD"].
+    """
+    month = _month_start(start or datetime.now())
+    last = _add_months(_month_start(datetime.now()), months_ahead)
+
+    with Session(engine) as session:
+        for table in reversed(PARTITIONED_TABLES):
+            session.execute(
+                text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+            )
+        session.commit()
+
+        months = set()
+        while month <= last:
+            months.add(month)
+            month = _add_months(month, 1)
+        for table in PARTITIONED_TABLES:
+            months.update(
+                _month_start(timestamp)
+                for timestamp in session.scalars(
+                    text(
+                        "SELECT DISTINCT date_trunc('month', received_at) "
+                        f"FROM {table}_default"
+                    )
+                )
+            )
+
+        # One transaction per month, so a failed move leaves the others done
+        for month in sorted(months):
+            _create_month(session, month)
+            session.commit()
+
+
+def _export_partition(session: Session, table: str, partition: str, path: Path) -> int:
+    """
+    Write the rows of a partition to a zstd compressed Parquet file.
+    The file is written under a temporary name and renamed once complete.
+
+    Returns:
+        int: number of rows written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {
+        int: pa.int64(),
+        str: pa.string(),
+        float: pa.float64(),
+        bool: pa.bool_(),
+        datetime: pa.timestamp("us"),
+    }
+    columns = Base.metadata.tables[table].columns
+    schema = pa.schema(
+        [(column.name, arrow_types[column.type.python_type]) for column in columns]
+    )
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix(".parquet.tmp")
+
+    result = session.execute(
+        text(f"SELECT {', '.join(schema.names)} FROM {partition}").execution_options(
+            yield_per=10000
+        )
+    )
+    rows = 0
+    with pq.ParquetWriter(temporary, schema, compression="zstd") as writer:
+        for batch in result.partitions():
+            writer.write_table(
+                pa.Table.from_pylist(
+                    [dict(zip(schema.names, row)) for row in batch], schema=schema
+                )
+            )
+            rows += len(batch)
+
+    if pq.ParquetFile(temporary).metadata.num_rows != rows:
+        raise RuntimeError(f"Archive of {partition} is incomplete.")
+    os.replace(temporary, path)
+    return rows
+
+
+def archive_partitions(
+    engine: Engine,
+    retention_months: int = CONFIG["MESSAGE_RETENTION_MONTHS"],
+    archive_dir: Path = Path(CONFIG["MESSAGE_ARCHIVE_DIR"]),
+) -> Dict[str, int]:
+    """
+    Export the partitions older than retention_months to Parquet files in
+    archive_dir (archive_dir/<table>/<YYYY-MM>.parquet), then drop them.
+    A partition is only dropped once its file is completely written.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        retention_months (int, optional): months of messages kept in Postgres,
+            including the current one. Defaults to CONFIG["MESSAGE_RETENTION_MONTHS"].
+        archive_dir (Path, optional): directory of the archive files.
+            Defaults to CONFIG["MESSAGE_ARCHIVE_DIR"].
+
+    Returns:
+        Dict[str, int]: rows archived per partition.
+    """
+    cutoff = _add_months(_month_start(datetime.now()), -(retention_months - 1))
+    archived = {}
+    for table in PARTITIONED_TABLES:
+        for partition, month in list_partitions(engine, table):
+            if month >= cutoff:
+                continue
+            with Session(engine) as session:
+                rows = _export_partition(
+                    session,
+                    table,
+                    partition,
+                    archive_dir / table / f"{month.year:04d}-{month.month:02d}.parquet",
+                )
+                session.execute(text(f"ALTER TABLE {table} DETACH PARTITION {partition}"))
+                session.execute(text(f"DROP TABLE {partition}"))
+                session.commit()
+            archived[partition] = rows
+            logger.info(f"Archived {rows} rows of {partition} and dropped it.")
+    return archived
+
+
+def maintain_message_log(engine: Engine) -> None:
+    """
+    Create the upcoming monthly partitions and archive the expired ones.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+    """
+    ensure_partitions(engine)
+    archive_partitions(engine)
+
+
+def start_maintenance(
+    engine: Engine, interval: float = CONFIG["MESSAGE_MAINTENANCE_INTERVAL"]
+) -> threading.Event:
+    """
+    Run maintain_message_log now and then every interval seconds, in a daemon thread.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        interval (float, optional): seconds between runs.
+            Defaults to CONFIG["MESSAGE_MAINTENANCE_INTERVAL"].
+
+    Returns:
+        threading.Event: set it to stop the thread.
+    """
+    stop = threading.Event()
+
+    def run() -> None:
+        while True:
+            try:
+                maintain_message_log(engine)
+            except Exception:
+                logger.exception("Message log maintenance failed.")
+            if stop.wait(interval):
+                return
+
+    threading.Thread(target=run, daemon=True).start()
+    return stop
+
+
+def migrate_unpartitioned(engine: Engine) -> bool:
+    """
+    Rename the message log tables of a database created before they were
+    partitioned, so create_all creates the partitioned tables in their place.
+    Their rows are copied over by copy_unpartitioned.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+
+    Returns:
+        bool: whether the tables were renamed.
+    """
+    with Session(engine) as session:
+        kind = session.scalar(
+            text("SELECT relkind FROM pg_class WHERE relname = 'messages'")
+        )
+        if kind != "r":
+            return False
+
+        logger.info("Renaming the unpartitioned message log tables.")
+        for table in _UNPARTITIONED_TABLES:
+            session.execute(text(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned"))
+            session.execute(
+                text(
+                    f"ALTER TABLE {table}_unpartitioned "
+                    f"RENAME CONSTRAINT {table}_pkey TO {table}_unpartitioned_pkey"
+                )
+            )
+        session.execute(
+            text(
+                "ALTER SEQUENCE messages_message_id_seq "
+                "RENAME TO messages_unpartitioned_message_id_seq"
+            )
+        )
+        session.commit()
+    return True
+
+
+def copy_unpartitioned(engine: Engine) -> None:
+    """
+    Copy the rows of the tables renamed by migrate_unpartitioned into the
+    partitioned tables, and drop them. Runs in one transaction, so an
+    interrupted copy is simply retried at the next startup.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+    """
+    if not inspect(engine).has_table("messages_unpartitioned"):
+        return
+
+    with Session(engine) as session:
+        first = session.scalar(
+            text("SELECT min(received_at) FROM messages_unpartitioned")
+        )
+    ensure_partitions(engine, start=first)
+
+    # received_at is part of the primary key now, so it cannot be null. Rows
+    # without any timestamp go to the 1970-01 partition and are archived.
+    received_at = "coalesce(received_at, response_at, TIMESTAMP '1970-01-01')"
+    with Session(engine) as session:
+        copied = session.execute(
+            text(
+                "INSERT INTO messages (message_id, received_at, session_id, query, "
+                "search_query, context_retreived_at, response_at, response, is_good) "
+                f"SELECT message_id, {received_at}, session_id, query, search_query, "
+                "context_retreived_at, response_at, response, is_good "
+                "FROM messages_unpartitioned"
+            )
+        ).rowcount
+        session.execute(
+            text(
+                "INSERT INTO message_context (message_id, received_at, chunk_id) "
+                f"SELECT message_context.message_id, {received_at}, chunk_id "
+                "FROM message_context_unpartitioned message_context "
+                "JOIN messages_unpartitioned USING (message_id)"
+            )
+        )
+        session.execute(
+            text(
+                "SELECT setval('messages_message_id_seq', "
+                "greatest((SELECT max(message_id) FROM messages), 1))"
+            )
+        )
+        session.execute(text("DROP TABLE message_context_unpartitioned"))
+        session.execute(text("DROP TABLE messages_unpartitioned"))
+        session.commit()
+    logger.info(f"Copied {copied} messages into the partitioned message log.")
+
+    # Give the rows that landed in the default partitions their own partition
+    ensure_partitions(engine)
+
+
+def main() -> None:
+    # Create upcoming partitions and archive expired ones, as the backend
+    # does every MESSAGE_MAINTENANCE_INTERVAL seconds
+    from sqlFunctions import create_connection
+
+    logging.basicConfig(level=logging.INFO)
+    maintain_message_log(create_connection(force_rebuild=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import logging
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Connection
+from types import ModuleType
+from typing import Any, Dict, List, Literal, Optional, Tuple
+
+import toml
+import torch
+
+from requestLogging import get_context
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# One connection per thread, so concurrent requests in an API worker
+# are served concurrently by the model server.
+_LOCAL = threading.local()
+
+
+class ModelServerError(RuntimeError):
+    """
+    Raised when the model server fails to execute an operation.
+    """
+
+
+def _get_connection() -> Connection:
+    """
+    Get this thread's connection to the model server, opening it if needed.
+
+    Returns:
+        Connection: connection to the model server.
+    """
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is None or conn.closed:
+        conn = Client(CONFIG["MODEL_SERVER_SOCKET"], family="AF_UNIX")
+        _LOCAL.conn = conn
+    return conn
+
+
+def models_module() -> ModuleType:
+    """
+    Get the module implementing the model operations in this process:
+    stubModels if USE_STUB_MODELS is set, languageModels otherwise.
+    Imported on first use so API workers only load models when running in-process.
+
+    Returns:
+        ModuleType: the model operations module.
+    """
+    if CONFIG["USE_STUB_MODELS"]:
+        import stubModels
+
+        return stubModels
+
+    import languageModels
+
+    return languageModels
+
+
+def _call(operation: str, **kwargs) -> Any:
+    """
+    Execute an operation on the model server.
+    If USE_MODEL_SERVER is disabled, the operation runs in this process instead.
+
+    Args:
+        operation (str): name of the operation to run.
+        **kwargs: keyword arguments for the operation.
+
+    Raises:
+        ModelServerError: if the operation failed on the model server.
+
+    Returns:
+        Any: the result of the operation.
+    """
+    if not CONFIG["USE_MODEL_SERVER"]:
+        return getattr(models_module(), operation)(**kwargs)
+
+    conn = _get_connection()
+    try:
+        conn.send_bytes(pickle.dumps((operation, kwargs, get_context())))
+        status, payload = pickle.loads(conn.recv_bytes())
+    except (EOFError, OSError):
+        # Drop the broken connection so the next call reconnects
+        conn.close()
+        raise
+
+    if status == "error":
+        raise ModelServerError(payload)
+    return payload
+
+
+def model_server_available() -> bool:
+    """
+    Check whether a model server is listening on the configured socket.
+
+    Returns:
+        bool: True if the model server answered a ping.
+    """
+    try:
+        return _call("ping") == "pong"
+    except (FileNotFoundError, ConnectionRefusedError, EOFError, OSError):
+        return False
+
+
+def start_model_server(
+    timeout: float = CONFIG["MODEL_SERVER_STARTUP_TIMEOUT"],
+) -> subprocess.Popen:
+    """
+    Launch the model server as a separate process and wait until it accepts calls.
+    The server is shared by every API worker, so it is tied to this worker's
+    parent, the uvicorn supervisor: it runs in its own session, so signals to
+    the worker don't reach it, and exits once the supervisor is gone. A worker
+    restarted by the supervisor attaches to it again.
+
+    Args:
+        timeout (float, optional): seconds to wait for the server to accept calls.
+            Defaults to CONFIG["MODEL_SERVER_STARTUP_TIMEOUT"].
+
+    Raises:
+        TimeoutError: if the server did not come up in time.
+        RuntimeError: if the server process exited during startup.
+
+    Returns:
+        subprocess.Popen: handle of the model server process.
+    """
+    process = subprocess.Popen(
+        [sys.executable, "modelServer.py", "--supervisor-pid", str(os.getppid())],
+        start_new_session=True,
+    )
+    logger.info(f"Started model server process (pid={process.pid}).")
+
+    deadline = time.monotonic() + timeout
+    while not model_server_available():
+        if process.poll() is not None:
+            raise RuntimeError(
+                f"Model server exited during startup with code {process.returncode}."
+            )
+        if time.monotonic() > deadline:
+            process.terminate()
+            raise TimeoutError("Model server did not start in time.")
+        time.sleep(1)
+
+    logger.info("Model server is ready.")
+    return process
+
+
+def load_models() -> None:
+    """
+    Load all models in parallel. See languageModels.load_models.
+    """
+    _call("load_models")
+
+
+def warmup() -> None:
+    """
+    Run one dummy call through every model. See languageModels.warmup.
+    """
+    _call("warmup")
+
+
+def model_status() -> Dict[str, Dict[str, Any]]:
+    """
+    Get the loading state of every model. See languageModels.model_status.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: state, load duration and error for each model.
+    """
+    return _call("model_status")
+
+
+def generation_stats() -> Dict[str, Any]:
+    """
+    Get the generation counts and latencies. See languageModels.generation_stats.
+
+    Returns:
+        Dict[str, Any]: generation statistics of the model server.
+    """
+    return _call("generation_stats")
+
+
+def memory_stats() -> Dict[str, Any]:
+    """
+    Get the memory of the model process. See languageModels.memory_stats.
+
+    Returns:
+        Dict[str, Any]: process, CUDA device and model memory.
+    """
+    return _call("memory_stats")
+
+
+def sample_stacks(seconds: float) -> str:
+    """
+    Sample the stacks of the model process. See diagnostics.sample_stacks.
+
+    Args:
+        seconds (float): how long to sample.
+
+    Returns:
+        str: the folded stacks.
+    """
+    if not CONFIG["USE_MODEL_SERVER"]:
+        from diagnostics import sample_stacks as sample_local_stacks
+
+        return sample_local_stacks(seconds)
+    return _call("sample_stacks", seconds=seconds)
+
+
+def hold_article_encoder() -> None:
+    """
+    Keep the article encoder loaded between embed calls.
+    See languageModels.hold_article_encoder.
+    """
+    _call("hold_article_encoder")
+
+
+def release_article_encoder() -> None:
+    """
+    Unload the held article encoder. See languageModels.release_article_encoder.
+    """
+    _call("release_article_encoder")
+
+
+def generate_text(prompt: str, enable_thinking: bool = True, **kwargs) -> str:
+    return _call(
+        "generate_text", prompt=prompt, enable_thinking=enable_thinking, **kwargs
+    )
+
+
+def embed_texts(
+    input_type: Literal["article", "query"],
+    texts: List[str],
+    input_ids: Optional[List[List[int]]] = None,
+) -> torch.tensor:
+    """
+    Generate embeddings for the input texts. See languageModels.embed_texts.
+
+    Args:
+        input_type (Literal['article', 'query']): Type of input, either 'query' or 'article'.
+        texts (List[str]): List of input texts to embed.
+        input_ids (Optional[List[List[int]]], optional): token ids of the texts,
+            without special tokens. Defaults to None.
+
+    Returns:
+        torch.tensor: Embeddings for the input texts with shape (input_length, embedding_dim).
+    """
+    return _call(
+        "embed_texts", input_type=input_type, texts=texts, input_ids=input_ids
+    )
+
+
+def generate_texts(prompts: List[str], enable_thinking: bool = True, **kwargs) -> List[str]:
+    """
+    Generate a response to each prompt in batches. See languageModels.generate_texts.
+    """
+    return _call(
+        "generate_texts", prompts=prompts, enable_thinking=enable_thinking, **kwargs
+    )
+
+
+def rerank_chunks(query: str, chunks: List[str]) -> torch.tensor:
+    """
+    Rerank chunks based on the query. See languageModels.rerank_chunks.
+
+    Args:
+        query (str): The query string.
+        chunks (List[str]): List of chunk strings to be ranked.
+
+    Returns:
+        torch.tensor: Scores for each chunk based on relevance the query.
+    """
+    return _call("rerank_chunks", query=query, chunks=chunks)
+
+
+def generate_search_query(query: str, chat_history: str) -> str:
+    return _call("generate_search_query", query=query, chat_history=chat_history)
+
+
+def generate_chat_response(query: str, context: str) -> str:
+    return _call("generate_chat_response", query=query, context=context)
+
+
+def rerank_pairs(pairs: List[Tuple[str, str]]) -> torch.tensor:
+    """
+    Score (query, chunk) pairs in batches. See languageModels.rerank_pairs.
+
+    Args:
+        pairs (List[Tuple[str, str]]): the (query, chunk) pairs to score.
+
+    Returns:
+        torch.tensor: the relevance score of each pair.
+    """
+    return _call("rerank_pairs", pairs=pairs)
+
+
+def generate_search_queries(queries: List[str], chat_histories: List[str]) -> List[str]:
+    return _call(
+        "generate_search_queries", queries=queries, chat_histories=chat_histories
+    )
+
+
+def generate_chat_responses_with_usage(
+    queries: List[str], contexts: List[str]
+) -> List[Tuple[str, Dict[str, Optional[int]]]]:
+    return _call(
+        "generate_chat_responses_with_usage", queries=queries, contexts=contexts
+    )
+
+
+def generate_chat_responses(queries: List[str], contexts: List[str]) -> List[str]:
+    return _call("generate_chat_responses", queries=queries, contexts=contexts)
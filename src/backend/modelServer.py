@@ -0,0 +1,140 @@
+import argparse
+import logging
+import os
+import pickle
+import threading
+import time
+from datetime import datetime
+from multiprocessing.connection import Listener, Connection
+
+import toml
+
+from diagnostics import sample_stacks
+from requestLogging import configure_logging, correlation
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+
+def _handle_connection(conn: Connection, operations: dict) -> None:
+    """
+    Serve requests from a single client connection until it is closed.
+    Each request is a pickled (operation, kwargs, context) tuple, where context
+    holds the caller's correlation ids (see requestLogging.get_context), and
+    each reply is a pickled (status, payload) tuple, where status is "ok" or "error".
+
+    Payloads are pickled explicitly with the standard pickler: sending tensors
+    through Connection.send would use torch's shared memory reductions,
+    which only work between processes forked from one another.
+
+    Args:
+        conn (Connection): the accepted client connection.
+        operations (dict): mapping of operation names to callables.
+    """
+    with conn:
+        while True:
+            try:
+                operation, kwargs, context = pickle.loads(conn.recv_bytes())
+            except (EOFError, ConnectionResetError):
+                return
+
+            # Log under the correlation ids of the API request that called
+            with correlation(**context):
+                try:
+                    result = ("ok", operations[operation](**kwargs))
+                except Exception as e:
+                    logger.exception(f"Model server operation '{operation}' failed.")
+                    result = ("error", f"{type(e).__name__}: {e}")
+
+            conn.send_bytes(pickle.dumps(result))
+
+
+def _exit_with(pid: int, interval: float = 5.0) -> None:
+    """
+    Exit once the process pid is gone. The model server is shared by every
+    API worker, so it lives as long as the uvicorn supervisor, not as long as
+    the worker that launched it.
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            logger.info(f"Supervisor process {pid} exited, stopping the model server.")
+            os._exit(0)
+        except PermissionError:
+            pass
+
+
+def serve(address: str = CONFIG["MODEL_SERVER_SOCKET"]) -> None:
+    """
+    Serve embed, rerank and generate calls over a Unix socket (with the stub
+    models if USE_STUB_MODELS is set). Models are loaded lazily, or up front
+    when a client calls "load_models", so the server answers pings and status
+    requests while models are still loading. Every client
+    connection is handled in its own thread, so one API worker waiting on
+    generation does not block another's embedding.
+
+    Args:
+        address (str, optional): path of the Unix socket to listen on.
+            Defaults to CONFIG["MODEL_SERVER_SOCKET"].
+    """
+    # Import here so only the model server process holds the models
+    from modelClient import models_module
+
+    models = models_module()
+
+    operations = {
+        "ping": lambda: "pong",
+        "load_models": models.load_models,
+        "warmup": models.warmup,
+        "model_status": models.model_status,
+        "hold_article_encoder": models.hold_article_encoder,
+        "release_article_encoder": models.release_article_encoder,
+        "embed_texts": models.embed_texts,
+        "rerank_chunks": models.rerank_chunks,
+        "generate_text": models.generate_text,
+        "generate_search_query": models.generate_search_query,
+        "generate_chat_response": models.generate_chat_response,
+        "generate_texts": models.generate_texts,
+        "rerank_pairs": models.rerank_pairs,
+        "generate_search_queries": models.generate_search_queries,
+        "generate_chat_responses": models.generate_chat_responses,
+        "generate_chat_responses_with_usage": models.generate_chat_responses_with_usage,
+        "generation_stats": models.generation_stats,
+        "memory_stats": models.memory_stats,
+        "sample_stacks": sample_stacks,
+    }
+
+    # Remove a stale socket left behind by a previous server
+    if os.path.exists(address):
+        os.remove(address)
+
+    with Listener(address, family="AF_UNIX") as listener:
+        os.chmod(address, 0o600)
+        logger.info(f"Model server listening on {address}.")
+        while True:
+            conn = listener.accept()
+            threading.Thread(
+                target=_handle_connection, args=(conn, operations), daemon=True
+            ).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the models over a Unix socket.")
+    parser.add_argument(
+        "--supervisor-pid",
+        type=int,
+        default=None,
+        help="Exit once this process is gone.",
+    )
+    args = parser.parse_args()
+
+    configure_logging(
+        filename=f"logs/model_server_{datetime.now().strftime('%d-%m-%Y_%H')}.log"
+    )
+    if args.supervisor_pid is not None:
+        threading.Thread(
+            target=_exit_with, args=(args.supervisor_pid,), daemon=True
+        ).start()
+    serve()
@@ -1,7 +1,17 @@
 from datetime import datetime
 from typing import List, Optional
 
-from sqlalchemy import String, ForeignKey, DateTime, Text, Integer, Index, Boolean
+from sqlalchemy import (
+    String,
+    ForeignKey,
+    ForeignKeyConstraint,
+    DateTime,
+    Text,
+    Integer,
+    Boolean,
+    LargeBinary,
+    Float,
+)
 from sqlalchemy.orm import mapped_column, Mapped, DeclarativeBase, relationship
 from pgvector.sqlalchemy import Vector
 
@@ -24,6 +34,10 @@ class File(Base):
     file_type: Mapped[str] = mapped_column(String(50), nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime)
     modified_at: Mapped[datetime] = mapped_column(DateTime)
+    # SHA-256 of the file, matched against corpus snapshots (see corpusSnapshot.py)
+    content_hash: Mapped[Optional[str]] = mapped_column(
+        String(64), nullable=True, index=True
+    )
 
     def __repr__(self) -> str:
         return f"File(id={self.file_id}, filename={self.filename}, created_at={self.created_at})"
@@ -63,7 +77,7 @@ class Chunk(Base):
 
     # Foreign key
     article_id: Mapped[int] = mapped_column(
-        ForeignKey("articles.article_id"), nullable=False
+        ForeignKey("articles.article_id"), nullable=False, index=True
     )
 
     # Columns
@@ -72,21 +86,54 @@ class Chunk(Base):
 
     # Relationships
     article: Mapped[Article] = relationship("Article", backref="chunks")
-
-    __table_args__ = (
-        Index(
-            "idx_chunk_embedding",
-            "embedding",
-            postgresql_using="hnsw",
-            postgresql_with={"m": 16, "ef_construction": 64},
-            postgresql_ops={"embedding": "vector_cosine_ops"},
-        ),
+    # Every article the chunk appears in, see ChunkArticle
+    articles: Mapped[List[Article]] = relationship(
+        "Article", secondary="chunk_articles", viewonly=True
     )
 
+    # The HNSW indexes on embedding depend on VECTOR_INDEX_MODE,
+    # see vectorStorage.EMBEDDING_INDEXES
+
     def __repr__(self) -> str:
         return f"Chunk(id={self.chunk_id}, text={self.text[:50]})"
 
 
+class ChunkArticle(Base):
+    __tablename__ = "chunk_articles"
+
+    # Every article a chunk appears in: its own, and those of the duplicates
+    # dropped in its favour at ingestion (see deduplication.py)
+
+    # Primary keys
+    chunk_id: Mapped[int] = mapped_column(
+        ForeignKey("chunks.chunk_id"), primary_key=True
+    )
+    article_id: Mapped[int] = mapped_column(
+        ForeignKey("articles.article_id"), primary_key=True, index=True
+    )
+
+    def __repr__(self) -> str:
+        return f"ChunkArticle(chunk_id={self.chunk_id}, article_id={self.article_id})"
+
+
+class ChunkSignature(Base):
+    __tablename__ = "chunk_signatures"
+
+    # Primary key
+    chunk_id: Mapped[int] = mapped_column(
+        ForeignKey("chunks.chunk_id"), primary_key=True
+    )
+
+    # Columns
+    # SHA-256 of the normalised text, for exact duplicates
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=False, index=True)
+    # MinHash signature (uint32 values), for near duplicates
+    minhash: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"ChunkSignature(chunk_id={self.chunk_id}, content_hash={self.content_hash})"
+
+
 class Session(Base):
     __tablename__ = "sessions"
 
@@ -108,20 +155,22 @@ class Session(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    # Monthly partitions, see messageLog.py
+    __table_args__ = {"postgresql_partition_by": "RANGE (received_at)"}
 
-    # Primary key
+    # Primary key, which must include the partition key
     message_id: Mapped[int] = mapped_column(
         Integer, primary_key=True, autoincrement=True
     )
+    received_at: Mapped[datetime] = mapped_column(DateTime, primary_key=True, index=True)
 
     # Foreign key
     session_id: Mapped[int] = mapped_column(
-        ForeignKey("sessions.session_id"), nullable=False
+        ForeignKey("sessions.session_id"), nullable=False, index=True
     )
 
     # Columns
     query: Mapped[str] = mapped_column(Text, nullable=False)
-    received_at: Mapped[datetime] = mapped_column(DateTime)
     search_query: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     context_retreived_at: Mapped[Optional[datetime]] = mapped_column(
         DateTime, nullable=True
@@ -139,14 +188,135 @@ class Message(Base):
 
 class MessageContext(Base):
     __tablename__ = "message_context"
+    # Partitioned like messages, by the received_at of the message
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["message_id", "received_at"],
+            ["messages.message_id", "messages.received_at"],
+        ),
+        {"postgresql_partition_by": "RANGE (received_at)"},
+    )
 
     # Primary keys
-    message_id: Mapped[int] = mapped_column(
-        ForeignKey("messages.message_id"), primary_key=True
-    )
+    message_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    received_at: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
     chunk_id: Mapped[int] = mapped_column(
-        ForeignKey("chunks.chunk_id"), primary_key=True
+        ForeignKey("chunks.chunk_id"), primary_key=True, index=True
     )
 
     def __repr__(self) -> str:
         return f"MessageContext(id={self.message_context_id}, message_id={self.message_id}, chunk_id={self.chunk_id})"
+
+
+class MessageTrace(Base):
+    __tablename__ = "message_traces"
+    # Partitioned like messages, by the received_at of the message
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["message_id", "received_at"],
+            ["messages.message_id", "messages.received_at"],
+        ),
+        {"postgresql_partition_by": "RANGE (received_at)"},
+    )
+
+    # Primary keys
+    message_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    received_at: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+
+    # Stage durations in seconds, see requestTrace.py. Stages of batch
+    # requests run once for the whole batch, so their items share them.
+    total_seconds: Mapped[float] = mapped_column(Float, nullable=False, index=True)
+    queue_seconds: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    rewrite_seconds: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    # Speculative retrieval runs during the rewrite, see speculativeRetrieval.py
+    speculative_embed_seconds: Mapped[Optional[float]] = mapped_column(
+        Float, nullable=True
+    )
+    speculative_search_seconds: Mapped[Optional[float]] = mapped_column(
+        Float, nullable=True
+    )
+    embed_seconds: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    search_seconds: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    rerank_seconds: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    compress_seconds: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    generation_seconds: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+
+    # Token counts of the response generation
+    prompt_tokens: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    thinking_tokens: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    answer_tokens: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    # Retrieval counts
+    candidates: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    rerank_pairs: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    rerank_outcome: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    context_chunks: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # Context tokens before and after compression, see contextCompression.py
+    context_tokens: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    compressed_tokens: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    cache_hits: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # "hit", "miss" or "failed", see speculativeRetrieval.resolve
+    speculation: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    speculation_saved_seconds: Mapped[Optional[float]] = mapped_column(
+        Float, nullable=True
+    )
+    batch_size: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+
+    def __repr__(self) -> str:
+        return f"MessageTrace(message_id={self.message_id}, total_seconds={self.total_seconds})"
+
+
+class KpiRollup:
+    """
+    Columns of the KPI rollup tables: totals of the messages, feedback and sessions
+    in one time bucket, maintained as they are written (see kpiRollups.py).
+    """
+
+    # Primary key
+    bucket_start: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+
+    # Columns
+    messages: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    feedback: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    good_feedback: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    responses: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    response_seconds: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    retrievals: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    retrieval_seconds: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    generations: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    generation_seconds: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    context_chunks: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    messages_with_context: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=0
+    )
+    sessions: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    new_users: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class KpiHourly(KpiRollup, Base):
+    __tablename__ = "kpi_hourly"
+
+    def __repr__(self) -> str:
+        return f"KpiHourly(bucket_start={self.bucket_start}, messages={self.messages})"
+
+
+class KpiDaily(KpiRollup, Base):
+    __tablename__ = "kpi_daily"
+
+    def __repr__(self) -> str:
+        return f"KpiDaily(bucket_start={self.bucket_start}, messages={self.messages})"
+
+
+class KpiUser(Base):
+    __tablename__ = "kpi_users"
+
+    # Users seen so far, so each is counted once in new_users
+
+    # Primary key
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    # Columns
+    first_seen: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"KpiUser(user_id={self.user_id}, first_seen={self.first_seen})"
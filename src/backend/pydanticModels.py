@@ -1,4 +1,5 @@
-from typing import Dict, List, Any, Literal
+from datetime import datetime
+from typing import Dict, List, Any, Literal, Optional
 
 from pydantic.dataclasses import dataclass
 
@@ -27,6 +28,25 @@ class SessionResponse:
     user_id: int
 
 
+@dataclass
+class SearchFilters:
+    """
+    Dataclass for restricting context retrieval to part of the corpus.
+    Unset attributes do not filter.
+
+    Attributes:
+        article_ids (Optional[List[int]]): only search chunks of these articles
+        file_ids (Optional[List[int]]): only search chunks of articles from these files
+        ingested_after (Optional[datetime]): only search files ingested at or after this time
+        ingested_before (Optional[datetime]): only search files ingested before this time
+    """
+
+    article_ids: Optional[List[int]] = None
+    file_ids: Optional[List[int]] = None
+    ingested_after: Optional[datetime] = None
+    ingested_before: Optional[datetime] = None
+
+
 @dataclass
 class ChatQuery:
     """
@@ -36,11 +56,16 @@ class ChatQuery:
         query (str): the query to respond to
         chat_history (str): the chat history
         session_id (int): the session ID for the chat
+        filters (Optional[SearchFilters]): restricts which chunks can be retrieved
+        compress_context (Optional[bool]): keep only the most relevant sentences
+            of the context, defaults to CONTEXT_COMPRESSION in config.toml
     """
 
     query: str
     chat_history: str
     session_id: int
+    filters: Optional[SearchFilters] = None
+    compress_context: Optional[bool] = None
 
 
 @dataclass
@@ -60,6 +85,45 @@ class ChatResponse:
     context: List[Dict[str, Any]]
 
 
+@dataclass
+class ChatQueryBatch:
+    """
+    Dataclass for a batch of chat queries.
+
+    Attributes:
+        queries (List[ChatQuery]): the queries to respond to
+    """
+
+    queries: List[ChatQuery]
+
+
+@dataclass
+class BatchItemResult:
+    """
+    Dataclass for the result of one query of a batch.
+    Exactly one of response and error is set.
+
+    Attributes:
+        response (Optional[ChatResponse]): the response to the query
+        error (Optional[str]): why no response could be generated
+    """
+
+    response: Optional[ChatResponse] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class ChatResponseBatch:
+    """
+    Dataclass for the responses to a batch of chat queries.
+
+    Attributes:
+        results (List[BatchItemResult]): the result of each query, in input order
+    """
+
+    results: List[BatchItemResult]
+
+
 @dataclass
 class Message:
     """
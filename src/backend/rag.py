@@ -1,70 +1,103 @@
 import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
+import toml
 from sqlalchemy import Engine
 
-from languageModels import (
-    generate_chat_response,
+from admission import check_deadline
+from contextCompression import CompressedContext, compress_contexts
+from kpiRollups import record_messages
+from modelClient import (
+    generate_chat_responses_with_usage,
+    generate_search_queries,
     generate_search_query,
     embed_texts,
-    rerank_chunks,
 )
-from ormModels import Message, MessageContext
-from pydanticModels import ChatQuery, ChatResponse
-from sqlFunctions import vector_search, insert_data
+from ormModels import Article, Chunk, Message, MessageContext
+from pydanticModels import BatchItemResult, ChatQuery, ChatResponse
+from requestLogging import debug_payload
+from requestTrace import RequestTrace, save_traces
+from rerankCascade import RerankItem, rerank_candidates
+from retrieval import get_retrieval_backend
+from speculativeRetrieval import resolve, speculate
+from sqlFunctions import insert_data
 
+CONFIG = toml.load("config.toml")
 logger = logging.getLogger(__name__)
 
+# Embeddings of recent search queries, least recently used first
+_EMBEDDING_CACHE: "OrderedDict[str, Any]" = OrderedDict()
+_EMBEDDING_CACHE_LOCK = threading.Lock()
 
-def rag(request: ChatQuery, engine: Engine) -> ChatResponse:
 
-    received_at = datetime.now()
-
-    # Generate Search Query
-    search_query = generate_search_query(
-        query=request.query, chat_history=request.chat_history
-    )
+def _clean_search_query(search_query: str) -> str:
     # Remove "QUESTION:" from the start of the search query, if present
     if search_query.upper().strip().startswith("QUESTION:"):
         search_query = search_query[len("QUESTION:") :].strip()
-    logger.info(f"Search Query: {search_query}")
+    return search_query
 
-    # Embed Search Query
-    embeddings = embed_texts(input_type="query", texts=search_query)
 
-    # Retrieve Context
-    context = vector_search(vector=embeddings[0], engine=engine)
+def _embed_queries(queries: List[str]) -> List[Tuple[Any, bool]]:
+    """
+    Embed search queries, reusing the embeddings of the last
+    QUERY_EMBEDDING_CACHE_SIZE distinct queries. The queries missing from the
+    cache are embedded in one call.
 
-    # Rerank with Cross-Encoder
-    rerank_results = rerank_chunks(
-        query=search_query,
-        chunks=[chunk.text for chunk in context],
-    )
+    Args:
+        queries (List[str]): the search queries.
+
+    Returns:
+        List[Tuple[Any, bool]]: the embedding of each query, and whether it
+            was a cache hit.
+    """
+    with _EMBEDDING_CACHE_LOCK:
+        cached = {}
+        for query in queries:
+            if query in _EMBEDDING_CACHE:
+                _EMBEDDING_CACHE.move_to_end(query)
+                cached[query] = _EMBEDDING_CACHE[query]
 
-    # Keep only the top chunks
-    top_indices = [
-        i for i in rerank_results.topk(3).indices if rerank_results[i] >= 5.0
+    missing = list(dict.fromkeys(q for q in queries if q not in cached))
+    embedded = {}
+    if missing:
+        embedded = dict(zip(missing, embed_texts(input_type="query", texts=missing)))
+        with _EMBEDDING_CACHE_LOCK:
+            _EMBEDDING_CACHE.update(embedded)
+            while len(_EMBEDDING_CACHE) > CONFIG["QUERY_EMBEDDING_CACHE_SIZE"]:
+                _EMBEDDING_CACHE.popitem(last=False)
+
+    return [
+        (cached[q], True) if q in cached else (embedded[q], False) for q in queries
     ]
-    context = [context[i] for i in top_indices]
-    scores = [rerank_results[i].item() for i in top_indices]
-    context_retreived_at = datetime.now()
-    logger.info(f"Context Scores: {scores}")
 
-    # Generate Chat Response
-    context_str = "\n\n".join([f"{chunk.text}" for chunk in context])
 
-    response = generate_chat_response(
-        query=search_query,
-        context=context_str,
-    )
+def _compression_enabled(request: ChatQuery) -> bool:
+    if request.compress_context is None:
+        return CONFIG["CONTEXT_COMPRESSION"]
+    return request.compress_context
 
-    respone_at = datetime.now()
 
-    logger.info(f"Response: {response}")
-    logger.info(f"Response Time: {respone_at - received_at}")
+def _compression_counts(compressed: Optional[CompressedContext]) -> Dict[str, Any]:
+    if compressed is None:
+        return {}
+    return {
+        "context_tokens": compressed.context_tokens,
+        "compressed_tokens": compressed.compressed_tokens,
+    }
 
-    # Log message in the database
-    message_data = {
+
+def _message_data(
+    request: ChatQuery,
+    search_query: str,
+    response: str,
+    received_at: datetime,
+    context_retreived_at: datetime,
+    respone_at: datetime,
+) -> Dict[str, Any]:
+    return {
         "session_id": request.session_id,
         "query": request.query,
         "received_at": received_at,
@@ -74,10 +107,158 @@ def rag(request: ChatQuery, engine: Engine) -> ChatResponse:
         "response": response,
         "is_good": None,
     }
+
+
+def _article_source(article: Article) -> Dict[str, Any]:
+    return {
+        "article_id": article.article_id,
+        "title": article.title,
+        "authors": article.authors,
+        "start_page": article.start_page,
+        "end_page": article.end_page,
+        "filename": article.file.filename if article.file else None,
+    }
+
+
+def _build_response(
+    response: str, message_id: int, context: List[Chunk], scores: List[Optional[float]]
+) -> ChatResponse:
+    return ChatResponse(
+        response=response,
+        message_id=message_id,
+        context=[
+            {
+                "chunk_id": chunk.chunk_id,
+                "text": chunk.text,
+                "score": score,
+                "title": chunk.article.title if chunk.article else None,
+                "authors": chunk.article.authors if chunk.article else None,
+                "start_page": chunk.article.start_page if chunk.article else None,
+                "end_page": chunk.article.end_page if chunk.article else None,
+                "filename": (
+                    chunk.article.file.filename
+                    if chunk.article and chunk.article.file
+                    else None
+                ),
+                # Every article the chunk appears in, including duplicates
+                # dropped at ingestion
+                "articles": [_article_source(article) for article in chunk.articles],
+            }
+            for chunk, score in zip(context, scores)
+        ],
+    )
+
+
+def rag(
+    request: ChatQuery,
+    engine: Engine,
+    deadline: Optional[float] = None,
+    queue_seconds: Optional[float] = None,
+) -> ChatResponse:
+
+    received_at = datetime.now()
+    trace = RequestTrace(queue_seconds)
+
+    backend = get_retrieval_backend(engine)
+    check_deadline(deadline, "search query generation")
+
+    # Retrieve with the raw query while the search query is generated
+    speculation = None
+    if CONFIG["SPECULATIVE_RETRIEVAL"]:
+        speculation = speculate(
+            request.query, request.filters, backend, _embed_queries, trace
+        )
+
+    # Generate Search Query
+    with trace.stage("rewrite"):
+        search_query = _clean_search_query(
+            generate_search_query(
+                query=request.query, chat_history=request.chat_history
+            )
+        )
+    logger.info(f"Search Query: {search_query}")
+
+    # Embed Search Query and Retrieve Context
+    if speculation is not None:
+        retrieval = resolve(
+            speculation,
+            request.query,
+            search_query,
+            request.filters,
+            backend,
+            _embed_queries,
+            trace,
+        )
+        trace.add(
+            speculation=retrieval.speculation,
+            speculation_saved_seconds=round(retrieval.saved_seconds, 3),
+        )
+        embedding, cache_hit = retrieval.embedding, retrieval.cache_hit
+        context = retrieval.candidates
+    else:
+        with trace.stage("embed"):
+            [(embedding, cache_hit)] = _embed_queries([search_query])
+        with trace.stage("search"):
+            context = backend.search(
+                vector=embedding,
+                top_k=CONFIG["RETRIEVAL_TOP_K"],
+                filters=request.filters,
+            )
+
+    # Rerank with Cross-Encoder, keeping only the top chunks
+    with trace.stage("rerank"):
+        reranked = rerank_candidates(
+            [RerankItem(search_query, embedding, context, request.filters)], backend
+        )[0]
+    context, scores = reranked.chunks, reranked.scores
+    context_retreived_at = datetime.now()
+    logger.info(f"Context Scores: {scores}")
+    trace.add(
+        candidates=reranked.candidates,
+        rerank_pairs=reranked.pairs,
+        rerank_outcome=reranked.outcome,
+        context_chunks=len(context),
+        cache_hits=int(cache_hit),
+    )
+
+    # Keep only the sentences of the context most relevant to the search query
+    if _compression_enabled(request) and context:
+        with trace.stage("compress"):
+            [compressed] = compress_contexts([search_query], [context])
+        trace.add(**_compression_counts(compressed))
+        context_str = compressed.prompt()
+    else:
+        context_str = "\n\n".join([f"{chunk.text}" for chunk in context])
+
+    # Generate Chat Response
+    check_deadline(deadline, "response generation")
+
+    with trace.stage("generation"):
+        [(response, usage)] = generate_chat_responses_with_usage(
+            queries=[search_query], contexts=[context_str]
+        )
+    trace.add(**usage)
+
+    respone_at = datetime.now()
+
+    debug_payload(logger, "Context", lambda: context_str)
+    debug_payload(logger, "Response", lambda: response)
+    logger.info(
+        f"Response of {len(response)} characters in {respone_at - received_at}."
+    )
+
+    # Log message in the database
     message = insert_data(
         engine=engine,
         table=Message,
-        data=message_data,
+        data=_message_data(
+            request,
+            search_query,
+            response,
+            received_at,
+            context_retreived_at,
+            respone_at,
+        ),
     )[0]
 
     # If context found log it with this message in the database
@@ -85,6 +266,7 @@ def rag(request: ChatQuery, engine: Engine) -> ChatResponse:
         {
             "chunk_id": chunk.chunk_id,
             "message_id": message.message_id,
+            "received_at": message.received_at,
         }
         for chunk in context
     ]
@@ -94,25 +276,244 @@ def rag(request: ChatQuery, engine: Engine) -> ChatResponse:
             table=MessageContext,
             data=context_data,
         )
+    record_messages(engine, [message], [len(context)])
+    save_traces(engine, [trace.data(message)])
 
-    return ChatResponse(
-        response=response,
-        message_id=message.message_id,
-        context=[
+    return _build_response(response, message.message_id, context, scores)
+
+
+def _run_batched(
+    stage: str,
+    func: Callable[[List[Any]], List[Any]],
+    inputs: Dict[int, Any],
+    errors: Dict[int, str],
+) -> Dict[int, Any]:
+    """
+    Run one stage of rag_batch over the items that have not failed yet, in a
+    single batched call. If the batched call fails, every item is retried on
+    its own, so that one bad item only fails itself.
+
+    Args:
+        stage (str): name of the stage, used in error messages.
+        func (Callable[[List[Any]], List[Any]]): maps a list of inputs to a list
+            of outputs of the same length.
+        inputs (Dict[int, Any]): the input of each item, by its index in the batch.
+        errors (Dict[int, str]): error message by item index, updated in place.
+
+    Returns:
+        Dict[int, Any]: the output of each item that succeeded, by index.
+    """
+    indices = [i for i in inputs if i not in errors]
+    if not indices:
+        return {}
+
+    try:
+        return dict(zip(indices, func([inputs[i] for i in indices])))
+    except Exception:
+        logger.exception(f"Batched {stage} failed, retrying items one by one.")
+
+    outputs = {}
+    for i in indices:
+        try:
+            outputs[i] = func([inputs[i]])[0]
+        except Exception as e:
+            logger.exception(f"{stage} failed for batch item {i}.")
+            errors[i] = f"{stage} failed: {type(e).__name__}: {e}"
+    return outputs
+
+
+def rag_batch(
+    requests: List[ChatQuery],
+    engine: Engine,
+    deadline: Optional[float] = None,
+    queue_seconds: Optional[float] = None,
+) -> List[BatchItemResult]:
+    """
+    Answer many chat queries, running each stage of the pipeline once for the
+    whole batch: search queries and answers are generated in batches, query
+    embeddings in one forward pass, vector searches together and the
+    (query, chunk) pairs of each rerank cascade stage scored in one
+    cross-encoder pass. A failing item does
+    not fail the batch, its error is returned in its place.
+
+    Args:
+        requests (List[ChatQuery]): the queries to respond to.
+        engine (Engine): SQLAlchemy engine for database operations.
+        deadline (Optional[float], optional): time.monotonic() deadline, checked
+            before each generation stage. Defaults to None.
+        queue_seconds (Optional[float], optional): seconds the batch waited for
+            admission, recorded in its traces. Defaults to None.
+
+    Returns:
+        List[BatchItemResult]: the response or error of each query, in input order.
+    """
+    received_at = datetime.now()
+    trace = RequestTrace(queue_seconds, batch_size=len(requests))
+    errors: Dict[int, str] = {}
+    items = dict(enumerate(requests))
+
+    # Generate Search Queries
+    check_deadline(deadline, "search query generation")
+    with trace.stage("rewrite"):
+        search_queries = _run_batched(
+            "search query generation",
+            lambda batch: [
+                _clean_search_query(q)
+                for q in generate_search_queries(
+                    queries=[r.query for r in batch],
+                    chat_histories=[r.chat_history for r in batch],
+                )
+            ],
+            items,
+            errors,
+        )
+
+    # Embed Search Queries
+    with trace.stage("embed"):
+        embedded = _run_batched(
+            "query embedding", _embed_queries, search_queries, errors
+        )
+    embeddings = {i: embedding for i, (embedding, _) in embedded.items()}
+
+    # Retrieve Context
+    backend = get_retrieval_backend(engine)
+    with trace.stage("search"):
+        contexts = _run_batched(
+            "context retrieval",
+            lambda batch: backend.search_batch(
+                vectors=[embedding for embedding, _ in batch],
+                top_k=CONFIG["RETRIEVAL_TOP_K"],
+                filters=[filters for _, filters in batch],
+            ),
+            {i: (embeddings[i], items[i].filters) for i in embeddings},
+            errors,
+        )
+
+    # Rerank with Cross-Encoder, keeping only the top chunks
+    with trace.stage("rerank"):
+        reranked = _run_batched(
+            "reranking",
+            lambda batch: rerank_candidates(batch, backend),
             {
-                "chunk_id": chunk.chunk_id,
-                "text": chunk.text,
-                "score": score,
-                "title": chunk.article.title if chunk.article else None,
-                "authors": chunk.article.authors if chunk.article else None,
-                "start_page": chunk.article.start_page if chunk.article else None,
-                "end_page": chunk.article.end_page if chunk.article else None,
-                "filename": (
-                    chunk.article.file.filename
-                    if chunk.article and chunk.article.file
-                    else None
+                i: RerankItem(
+                    search_queries[i], embeddings[i], contexts[i], items[i].filters
+                )
+                for i in contexts
+            },
+            errors,
+        )
+    selected = {i: (result.chunks, result.scores) for i, result in reranked.items()}
+    context_retreived_at = datetime.now()
+
+    # Keep only the most relevant sentences of the contexts, scored in one pass
+    compressed = {}
+    to_compress = {
+        i: (search_queries[i], selected[i][0])
+        for i in selected
+        if _compression_enabled(items[i]) and selected[i][0]
+    }
+    if to_compress:
+        with trace.stage("compress"):
+            compressed = _run_batched(
+                "context compression",
+                lambda batch: compress_contexts(
+                    queries=[query for query, _ in batch],
+                    contexts=[chunks for _, chunks in batch],
                 ),
-            }
-            for chunk, score in zip(context, scores)
-        ],
+                to_compress,
+                errors,
+            )
+
+    # Generate Chat Responses
+    check_deadline(deadline, "response generation")
+    with trace.stage("generation"):
+        generated = _run_batched(
+            "response generation",
+            lambda batch: generate_chat_responses_with_usage(
+                queries=[query for query, _ in batch],
+                contexts=[context for _, context in batch],
+            ),
+            {
+                i: (
+                    search_queries[i],
+                    (
+                        compressed[i].prompt()
+                        if i in compressed
+                        else "\n\n".join(chunk.text for chunk in selected[i][0])
+                    ),
+                )
+                for i in selected
+            },
+            errors,
+        )
+    responses = {i: response for i, (response, _) in generated.items()}
+    respone_at = datetime.now()
+    for i in sorted(responses):
+        debug_payload(logger, f"Response {i}", lambda: responses[i])
+    logger.info(
+        f"Answered {len(responses)} of {len(requests)} batch queries "
+        f"in {respone_at - received_at}."
     )
+
+    # Log messages and their context in the database, one insert each
+    indices = sorted(responses)
+    messages = {}
+    if indices:
+        inserted = insert_data(
+            engine=engine,
+            table=Message,
+            data=[
+                _message_data(
+                    items[i],
+                    search_queries[i],
+                    responses[i],
+                    received_at,
+                    context_retreived_at,
+                    respone_at,
+                )
+                for i in indices
+            ],
+        )
+        messages = dict(zip(indices, inserted))
+
+        context_data = [
+            {
+                "chunk_id": chunk.chunk_id,
+                "message_id": messages[i].message_id,
+                "received_at": messages[i].received_at,
+            }
+            for i in indices
+            for chunk in selected[i][0]
+        ]
+        if context_data:
+            insert_data(engine=engine, table=MessageContext, data=context_data)
+        record_messages(engine, inserted, [len(selected[i][0]) for i in indices])
+        save_traces(
+            engine,
+            [
+                trace.data(
+                    messages[i],
+                    candidates=reranked[i].candidates,
+                    rerank_pairs=reranked[i].pairs,
+                    rerank_outcome=reranked[i].outcome,
+                    context_chunks=len(selected[i][0]),
+                    cache_hits=int(embedded[i][1]),
+                    **_compression_counts(compressed.get(i)),
+                    **generated[i][1],
+                )
+                for i in indices
+            ],
+        )
+
+    return [
+        (
+            BatchItemResult(
+                response=_build_response(
+                    responses[i], messages[i].message_id, *selected[i]
+                )
+            )
+            if i in messages
+            else BatchItemResult(error=errors.get(i, "No response generated."))
+        )
+        for i in range(len(requests))
+    ]
@@ -0,0 +1,162 @@
+import atexit
+import logging
+import queue
+import random
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import toml
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# Correlation ids of the request being served. Context variables follow the
+# request into FastAPI's threadpool and, through modelClient, into the
+# model server, so every log line of a request can be found by its id.
+REQUEST_ID: ContextVar[str] = ContextVar("request_id", default="-")
+SESSION_ID: ContextVar[str] = ContextVar("session_id", default="-")
+# Whether this request's expensive debug payloads are logged
+DEBUG_SAMPLED: ContextVar[bool] = ContextVar("debug_sampled", default=False)
+
+LOG_FORMAT = (
+    "%(asctime)s - %(levelname)s - [%(request_id)s %(session_id)s] "
+    "%(name)s - %(message)s"
+)
+
+
+class CorrelationFilter(logging.Filter):
+    """
+    Adds the request and session ids of the current context to each record.
+    Installed on the queue handler, so it runs in the thread that logs.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = REQUEST_ID.get()
+        record.session_id = SESSION_ID.get()
+        return True
+
+
+def configure_logging(
+    filename: str, level: str = CONFIG["LOG_LEVEL"]
+) -> QueueListener:
+    """
+    Send the root logger's records through an unbounded queue to a file
+    handler running in a background thread, so requests never wait on disk.
+    Records are formatted with their correlation ids.
+
+    Args:
+        filename (str): the log file, overwritten.
+        level (str, optional): the root log level.
+            Defaults to CONFIG["LOG_LEVEL"].
+
+    Returns:
+        QueueListener: the started listener, stopped (and flushed) at exit.
+    """
+    file_handler = logging.FileHandler(filename, mode="w")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def get_context() -> Dict[str, Any]:
+    """
+    Get the correlation context of the current request, to carry it to
+    another thread or process.
+
+    Returns:
+        Dict[str, Any]: the request id, session id and debug sampling decision.
+    """
+    return {
+        "request_id": REQUEST_ID.get(),
+        "session_id": SESSION_ID.get(),
+        "debug_sampled": DEBUG_SAMPLED.get(),
+    }
+
+
+@contextmanager
+def correlation(
+    request_id: Optional[str] = None,
+    session_id: Optional[Any] = None,
+    debug_sampled: Optional[bool] = None,
+) -> Iterator[str]:
+    """
+    Set the correlation context for the duration of the block. A new request
+    id is generated if none is given, and the debug payloads are sampled with
+    probability DEBUG_SAMPLE_RATE unless debug_sampled is given.
+
+    Args:
+        request_id (Optional[str], optional): the request id. Defaults to a new one.
+        session_id (Optional[Any], optional): the chat session id. Defaults to
+            the current one.
+        debug_sampled (Optional[bool], optional): whether to log the debug
+            payloads. Defaults to a new sampling decision.
+
+    Yields:
+        str: the request id.
+    """
+    request_id = request_id or uuid.uuid4().hex[:16]
+    if debug_sampled is None:
+        debug_sampled = random.random() < CONFIG["DEBUG_SAMPLE_RATE"]
+
+    tokens = [
+        (REQUEST_ID, REQUEST_ID.set(request_id)),
+        (DEBUG_SAMPLED, DEBUG_SAMPLED.set(debug_sampled)),
+    ]
+    if session_id is not None:
+        tokens.append((SESSION_ID, SESSION_ID.set(str(session_id))))
+    try:
+        yield request_id
+    finally:
+        for variable, token in reversed(tokens):
+            variable.reset(token)
+
+
+def set_session(session_id: Any) -> None:
+    """
+    Tag the rest of the current request's log lines with its chat session.
+
+    Args:
+        session_id (Any): the chat session id.
+    """
+    SESSION_ID.set(str(session_id))
+
+
+def debug_enabled(target: logging.Logger) -> bool:
+    """
+    Check whether expensive debug payloads should be built: the logger logs
+    DEBUG records and the current request was sampled.
+
+    Args:
+        target (logging.Logger): the logger the payload would go to.
+
+    Returns:
+        bool: whether to build and log the payload.
+    """
+    return DEBUG_SAMPLED.get() and target.isEnabledFor(logging.DEBUG)
+
+
+def debug_payload(target: logging.Logger, label: str, build: Callable[[], Any]) -> None:
+    """
+    Log an expensive debug payload, built only if debug_enabled.
+
+    Args:
+        target (logging.Logger): the logger to log to.
+        label (str): what the payload is.
+        build (Callable[[], Any]): builds the payload.
+    """
+    if debug_enabled(target):
+        target.debug(f"{label}: {build()}")
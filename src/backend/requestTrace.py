@@ -0,0 +1,181 @@
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+import toml
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session
+
+from diagnostics import trace_allocations
+from ormModels import Message, MessageTrace
+from sqlFunctions import insert_data
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# Pipeline stages timed by rag and rag_batch, in order
+STAGES = (
+    "rewrite",
+    "speculative_embed",
+    "speculative_search",
+    "embed",
+    "search",
+    "rerank",
+    "compress",
+    "generation",
+)
+COUNTS = (
+    "prompt_tokens",
+    "thinking_tokens",
+    "answer_tokens",
+    "candidates",
+    "rerank_pairs",
+    "rerank_outcome",
+    "context_chunks",
+    "context_tokens",
+    "compressed_tokens",
+    "cache_hits",
+    "speculation",
+    "speculation_saved_seconds",
+)
+
+
+class RequestTrace:
+    """
+    The duration of each pipeline stage of a chat request, and its token,
+    candidate and cache counts, saved as a MessageTrace row with its message.
+
+    A batch request has one trace: its stages run once for the whole batch,
+    and the counts of each item are passed to data.
+    """
+
+    def __init__(self, queue_seconds: Optional[float] = None, batch_size: int = 1):
+        self.started = time.perf_counter()
+        self.queue_seconds = queue_seconds
+        self.batch_size = batch_size
+        self.seconds: Dict[str, float] = {}
+        self.counts: Dict[str, Any] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Time the body of the with block as one of STAGES, and record its
+        allocations if tracemalloc is tracing (see diagnostics.trace_allocations).
+
+        Args:
+            name (str): the stage.
+        """
+        start = time.perf_counter()
+        try:
+            with trace_allocations(name):
+                yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def add(self, **counts: Any) -> None:
+        """
+        Record counts, see COUNTS.
+        """
+        self.counts.update(counts)
+
+    def data(self, message: Message, **counts: Any) -> Dict[str, Any]:
+        """
+        Get the MessageTrace row of a message, with the time since the trace
+        started (plus the queue wait) as its total.
+
+        Args:
+            message (Message): the inserted message.
+            **counts: counts of this message, on top of the trace's.
+
+        Returns:
+            Dict[str, Any]: the MessageTrace data.
+        """
+        total = time.perf_counter() - self.started + (self.queue_seconds or 0.0)
+        return {
+            "message_id": message.message_id,
+            "received_at": message.received_at,
+            "total_seconds": total,
+            "queue_seconds": self.queue_seconds,
+            **{f"{stage}_seconds": self.seconds.get(stage) for stage in STAGES},
+            **{name: None for name in COUNTS},
+            **self.counts,
+            **counts,
+            "batch_size": self.batch_size,
+        }
+
+
+def _breakdown(trace: Dict[str, Any]) -> str:
+    stages = ", ".join(
+        f"{stage} {trace[f'{stage}_seconds']:.2f}s"
+        for stage in ("queue", *STAGES)
+        if trace.get(f"{stage}_seconds") is not None
+    )
+    counts = ", ".join(
+        f"{name} {trace[name]}" for name in COUNTS if trace.get(name) is not None
+    )
+    return f"{stages}; {counts}"
+
+
+def save_traces(engine: Engine, traces: List[Dict[str, Any]]) -> None:
+    """
+    Insert the traces of logged messages, and log those slower than
+    SLOW_REQUEST_SECONDS with their breakdown. Never raises, a trace must
+    not fail the request it describes.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        traces (List[Dict[str, Any]]): MessageTrace data, see RequestTrace.data.
+    """
+    for trace in traces:
+        if trace["total_seconds"] >= CONFIG["SLOW_REQUEST_SECONDS"]:
+            logger.warning(
+                f"Slow request: message {trace['message_id']} took "
+                f"{trace['total_seconds']:.2f}s ({_breakdown(trace)})."
+            )
+
+    try:
+        insert_data(engine=engine, table=MessageTrace, data=traces)
+    except Exception:
+        logger.exception("Failed to save the request traces.")
+
+
+def slowest_requests(
+    engine: Engine, limit: int = 20, hours: float = 24
+) -> List[Dict[str, Any]]:
+    """
+    Get the slowest requests of the last hours, with their stage breakdown.
+    Only the partitions of those hours are read.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        limit (int, optional): number of requests. Defaults to 20.
+        hours (float, optional): how far back to look. Defaults to 24.
+
+    Returns:
+        List[Dict[str, Any]]: the query, search query and trace of each request,
+            slowest first.
+    """
+    since = datetime.now() - timedelta(hours=hours)
+    columns = [
+        column
+        for column in MessageTrace.__table__.columns
+        if column.key != "message_id"
+    ]
+    with Session(engine) as session:
+        rows = session.execute(
+            select(Message.message_id, Message.query, Message.search_query, *columns)
+            .join(
+                MessageTrace,
+                (MessageTrace.message_id == Message.message_id)
+                & (MessageTrace.received_at == Message.received_at),
+            )
+            .where(Message.received_at >= since)
+            .where(MessageTrace.received_at >= since)
+            .order_by(MessageTrace.total_seconds.desc())
+            .limit(limit)
+        ).all()
+    return [dict(row._mapping) for row in rows]
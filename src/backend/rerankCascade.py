@@ -0,0 +1,274 @@
+import logging
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional
+
+import numpy as np
+import toml
+from torch import tensor
+
+from modelClient import rerank_pairs
+from ormModels import Chunk
+from pydanticModels import SearchFilters
+from retrieval import RetrievalBackend
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RerankItem:
+    """
+    A search query and its retrieved candidate chunks, to be reranked.
+
+    Attributes:
+        query (str): the search query.
+        vector (tensor): the query embedding, used to widen the search.
+        candidates (List[Chunk]): the retrieved chunks, ordered by increasing
+            cosine distance.
+        filters (Optional[SearchFilters]): the filters of the search.
+        top_k (int): number of chunks the candidates were retrieved with.
+    """
+
+    query: str
+    vector: tensor
+    candidates: List[Chunk]
+    filters: Optional[SearchFilters] = None
+    top_k: int = CONFIG["RETRIEVAL_TOP_K"]
+
+
+@dataclass
+class RerankResult:
+    """
+    The context chunks kept for a query and what it took to choose them.
+
+    Attributes:
+        chunks (List[Chunk]): the kept chunks, best first.
+        scores (List[Optional[float]]): the cross-encoder score of each kept
+            chunk, None if the cross-encoder was skipped.
+        pairs (int): number of (query, chunk) pairs scored by the cross-encoder.
+        candidates (int): number of candidates retrieved, including widened searches.
+        outcome (str): "full", "skipped", "early_exit", "exhausted" or "widened".
+    """
+
+    chunks: List[Chunk]
+    scores: List[Optional[float]]
+    pairs: int
+    candidates: int
+    outcome: str
+
+
+@dataclass
+class _CascadeState:
+    item: RerankItem
+    top_k: int
+    # Whether the candidates are scored in stages, or all at once
+    staged: bool = True
+    scores: Dict[int, float] = field(default_factory=dict)
+    widened: bool = False
+    result: Optional[RerankResult] = None
+
+    @property
+    def unscored(self) -> List[int]:
+        return [i for i in range(len(self.item.candidates)) if i not in self.scores]
+
+    def passing(self) -> List[int]:
+        """
+        Scored candidates that clear RERANK_MIN_SCORE, best first.
+        """
+        passing = [i for i, s in self.scores.items() if s >= CONFIG["RERANK_MIN_SCORE"]]
+        return sorted(passing, key=lambda i: -self.scores[i])
+
+    def finish(self, outcome: str) -> None:
+        kept = self.passing()[: CONFIG["RERANK_KEEP"]]
+        self.result = RerankResult(
+            chunks=[self.item.candidates[i] for i in kept],
+            scores=[self.scores[i] for i in kept],
+            pairs=len(self.scores),
+            candidates=len(self.item.candidates),
+            outcome=outcome,
+        )
+
+
+def cosine_distances(vector: tensor, chunks: List[Chunk]) -> np.ndarray:
+    """
+    Cosine distance between a query embedding and each chunk's embedding.
+
+    Args:
+        vector (tensor): the query embedding.
+        chunks (List[Chunk]): the chunks.
+
+    Returns:
+        np.ndarray: the distance to each chunk, in chunk order.
+    """
+    query = np.asarray(vector.tolist(), dtype=np.float32)
+    embeddings = np.asarray([chunk.embedding for chunk in chunks], dtype=np.float32)
+    similarities = embeddings @ query
+    similarities /= np.maximum(
+        np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query), 1e-12
+    )
+    return 1.0 - similarities
+
+
+def _is_decisive(item: RerankItem) -> bool:
+    """
+    The vector distances are decisive when the nearest RERANK_KEEP candidates
+    are all within RERANK_SKIP_DISTANCE of the query: they would be kept
+    whatever the cross-encoder says about the farther ones.
+    """
+    nearest = item.candidates[: CONFIG["RERANK_KEEP"]]
+    if not nearest or CONFIG["RERANK_SKIP_DISTANCE"] <= 0:
+        return False
+    return bool(
+        cosine_distances(item.vector, nearest).max() <= CONFIG["RERANK_SKIP_DISTANCE"]
+    )
+
+
+def _exit_likely(item: RerankItem) -> bool:
+    """
+    An early exit is only likely when the nearest RERANK_KEEP candidates are
+    close to the query, within RERANK_STAGED_MAX_DISTANCE. Otherwise the
+    cascade would score every candidate anyway, in more sequential calls.
+    """
+    nearest = item.candidates[: CONFIG["RERANK_KEEP"]]
+    return bool(
+        cosine_distances(item.vector, nearest).max()
+        <= CONFIG["RERANK_STAGED_MAX_DISTANCE"]
+    )
+
+
+def _widen(states: List[_CascadeState], backend: RetrievalBackend) -> None:
+    """
+    Search again with double the top_k of each state, and append the chunks
+    that were not retrieved before to its candidates. Searches of the same
+    top_k are issued as one batch.
+    """
+    by_top_k: Dict[int, List[_CascadeState]] = {}
+    for state in states:
+        state.top_k = min(state.top_k * 2, CONFIG["RERANK_MAX_TOP_K"])
+        state.widened = True
+        by_top_k.setdefault(state.top_k, []).append(state)
+
+    for top_k, group in by_top_k.items():
+        results = backend.search_batch(
+            vectors=[state.item.vector for state in group],
+            top_k=top_k,
+            filters=[state.item.filters for state in group],
+        )
+        for state, chunks in zip(group, results):
+            seen = {chunk.chunk_id for chunk in state.item.candidates}
+            state.item.candidates.extend(c for c in chunks if c.chunk_id not in seen)
+
+
+def rerank_candidates(
+    items: List[RerankItem],
+    backend: RetrievalBackend,
+    cascade: bool = CONFIG["RERANK_CASCADE"],
+) -> List[RerankResult]:
+    """
+    Choose the context chunks of each query: the top RERANK_KEEP candidates
+    with a cross-encoder score of at least RERANK_MIN_SCORE.
+
+    Without the cascade every candidate is scored. The cascade scores candidates
+    in order of vector similarity, RERANK_STAGE_SIZE at a time, and:
+
+    - skips the cross-encoder when the vector distances are decisive
+      (see _is_decisive), keeping the nearest candidates unscored.
+    - stops once RERANK_KEEP candidates score at least RERANK_EARLY_EXIT_SCORE.
+      This is a heuristic, not a bound: the less similar candidates left are
+      not expected to beat that score, but nothing rules it out. Candidates of
+      queries unlikely to exit early (see _exit_likely) are scored in one
+      stage instead.
+    - widens the search, doubling top_k up to RERANK_MAX_TOP_K, when every
+      candidate has been scored and none cleared RERANK_MIN_SCORE.
+
+    Each stage scores the pairs of every unfinished query in one cross-encoder
+    call, so batches of queries are reranked together.
+
+    Args:
+        items (List[RerankItem]): the queries and their candidates.
+        backend (RetrievalBackend): the backend to widen searches with.
+        cascade (bool, optional): whether to use the cascade.
+            Defaults to CONFIG["RERANK_CASCADE"].
+
+    Returns:
+        List[RerankResult]: the kept chunks of each query, in input order.
+    """
+    states = [
+        _CascadeState(
+            item=replace(item, candidates=list(item.candidates)),
+            top_k=item.top_k,
+            staged=cascade and bool(item.candidates) and _exit_likely(item),
+        )
+        for item in items
+    ]
+    baselines = [len(item.candidates) for item in items]
+
+    for state in states:
+        if not state.item.candidates:
+            state.finish("full" if not cascade else "exhausted")
+        elif cascade and _is_decisive(state.item):
+            nearest = state.item.candidates[: CONFIG["RERANK_KEEP"]]
+            state.result = RerankResult(
+                chunks=nearest,
+                scores=[None] * len(nearest),
+                pairs=0,
+                candidates=len(state.item.candidates),
+                outcome="skipped",
+            )
+
+    stage_size = CONFIG["RERANK_STAGE_SIZE"] if cascade else None
+    while True:
+        active = [state for state in states if state.result is None]
+        if not active:
+            break
+
+        # Score the next stage of every unfinished query in one pass
+        stage = {
+            id(state): state.unscored[: stage_size if state.staged else None]
+            for state in active
+        }
+        pairs = [
+            (state.item.query, state.item.candidates[i].text)
+            for state in active
+            for i in stage[id(state)]
+        ]
+        scores = rerank_pairs(pairs).tolist() if pairs else []
+
+        start = 0
+        to_widen = []
+        for state in active:
+            indices = stage[id(state)]
+            state.scores.update(zip(indices, scores[start : start + len(indices)]))
+            start += len(indices)
+
+            if not cascade:
+                state.finish("full")
+                continue
+
+            passing = state.passing()
+            if (
+                len(passing) >= CONFIG["RERANK_KEEP"]
+                and state.scores[passing[CONFIG["RERANK_KEEP"] - 1]]
+                >= CONFIG["RERANK_EARLY_EXIT_SCORE"]
+            ):
+                state.finish("early_exit" if state.unscored else "exhausted")
+            elif not state.unscored:
+                if not passing and state.top_k < CONFIG["RERANK_MAX_TOP_K"]:
+                    to_widen.append(state)
+                else:
+                    state.finish("widened" if state.widened else "exhausted")
+
+        if to_widen:
+            _widen(to_widen, backend)
+            for state in to_widen:
+                if not state.unscored:
+                    state.finish("widened")
+
+    for state, baseline in zip(states, baselines):
+        result = state.result
+        logger.info(
+            f"Rerank ({result.outcome}): scored {result.pairs} pairs of "
+            f"{result.candidates} candidates, {baseline - result.pairs} fewer than "
+            f"a full rerank of the top {baseline}. Scores: {result.scores}"
+        )
+    return [state.result for state in states]
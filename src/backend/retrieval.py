@@ -0,0 +1,622 @@
+import fcntl
+import logging
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import Engine, func, select
+from sqlalchemy.orm import Session, joinedload, selectinload
+from torch import tensor
+import toml
+
+from ormModels import Article, Chunk, ChunkArticle, File
+from pydanticModels import SearchFilters
+from sqlFunctions import vector_search
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 768
+# Rows converted to float32 at a time by the exact search
+_SEARCH_BLOCK_ROWS = 65536
+# Queries searched together by search_batch
+_SEARCH_QUERY_GROUP = 64
+# Filters matching at most this many chunks are searched exactly by hnsw
+_EXACT_FILTER_ROWS = 20000
+
+_BACKEND: Optional["RetrievalBackend"] = None
+_BACKEND_LOCK = threading.Lock()
+
+
+class RetrievalBackend(ABC):
+    """
+    Finds the chunks closest to a query embedding.
+    """
+
+    @abstractmethod
+    def search(
+        self,
+        vector: tensor,
+        top_k: int = 10,
+        max_distance: float = 0.5,
+        filters: Optional[SearchFilters] = None,
+    ) -> List[Chunk]:
+        """
+        Find the chunks closest to a vector by cosine distance.
+
+        Args:
+            vector (tensor): the query embedding.
+            top_k (int, optional): maximum number of chunks to return. Defaults to 10.
+            max_distance (float, optional): maximum cosine distance of returned chunks.
+                Defaults to 0.5.
+            filters (Optional[SearchFilters], optional): restricts which chunks are
+                searched. Defaults to None.
+
+        Returns:
+            List[Chunk]: the closest chunks, ordered by increasing distance.
+        """
+
+    def search_batch(
+        self,
+        vectors: List[tensor],
+        top_k: int = 10,
+        max_distance: float = 0.5,
+        filters: Optional[List[Optional[SearchFilters]]] = None,
+    ) -> List[List[Chunk]]:
+        """
+        Run search for several vectors. Backends override this to share work
+        between the searches.
+
+        Args:
+            vectors (List[tensor]): the query embeddings.
+            top_k (int, optional): maximum chunks returned per vector. Defaults to 10.
+            max_distance (float, optional): maximum cosine distance of returned chunks.
+                Defaults to 0.5.
+            filters (Optional[List[Optional[SearchFilters]]], optional): the filters
+                of each vector. Defaults to None.
+
+        Returns:
+            List[List[Chunk]]: the closest chunks of each vector, in input order.
+        """
+        filters = filters or [None] * len(vectors)
+        return [
+            self.search(vector, top_k, max_distance, f)
+            for vector, f in zip(vectors, filters)
+        ]
+
+    def refresh(self) -> bool:
+        """
+        Bring the backend up to date with the chunks table.
+
+        Returns:
+            bool: True if the backend changed.
+        """
+        return False
+
+    def close(self) -> None:
+        """
+        Stop any background work of the backend.
+        """
+
+
+class PgVectorBackend(RetrievalBackend):
+    """
+    Searches the HNSW indexes of the chunks table, see sqlFunctions.vector_search.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    def search(
+        self,
+        vector: tensor,
+        top_k: int = 10,
+        max_distance: float = 0.5,
+        filters: Optional[SearchFilters] = None,
+    ) -> List[Chunk]:
+        return vector_search(
+            vector=vector,
+            engine=self.engine,
+            top_k=top_k,
+            max_distance=max_distance,
+            filters=filters,
+        )
+
+    def search_batch(
+        self,
+        vectors: List[tensor],
+        top_k: int = 10,
+        max_distance: float = 0.5,
+        filters: Optional[List[Optional[SearchFilters]]] = None,
+    ) -> List[List[Chunk]]:
+        # Issue the searches concurrently, each on its own pooled connection
+        filters = filters or [None] * len(vectors)
+        with ThreadPoolExecutor(max_workers=CONFIG["BATCH_SEARCH_WORKERS"]) as executor:
+            return list(
+                executor.map(
+                    lambda args: self.search(args[0], top_k, max_distance, args[1]),
+                    zip(vectors, filters),
+                )
+            )
+
+
+@dataclass
+class _Snapshot:
+    """
+    The chunk embeddings of one generation of the chunks table, and the articles
+    each chunk appears in. Row i of chunk_ids and embeddings describes the same
+    chunk. The link arrays have one entry per (chunk, article) pair of
+    chunk_articles: a chunk deduplicated at ingestion appears in several articles.
+    """
+
+    generation: Tuple[int, int, int]
+    chunk_ids: np.ndarray
+    # Unit norm embeddings, memory-mapped float16 (rows, EMBEDDING_DIM)
+    embeddings: np.ndarray
+    # Row of the chunk, article, file and file ingestion time (datetime64[us])
+    # of every chunk_articles link
+    link_rows: np.ndarray
+    link_article_ids: np.ndarray
+    link_file_ids: np.ndarray
+    link_created_at: np.ndarray
+    hnsw: Optional[object] = None
+
+
+class InMemoryBackend(RetrievalBackend):
+    """
+    Searches a copy of the chunk embeddings held in this process, either exactly
+    (a matrix product over every chunk) or with an hnswlib HNSW graph.
+
+    The embeddings are normalised, stored as float16 and memory-mapped from
+    RETRIEVAL_INDEX_DIR, so API workers on one host share the pages and a
+    restart does not rebuild the copy. Postgres stays the source of truth:
+    the copy is tagged with the generation of the chunks table (row count,
+    highest chunk_id and number of chunk_articles links) and refreshed whenever
+    it changes. Ingestion only appends chunks, so a refresh normally just adds
+    the new rows and re-reads the links. The matching chunks
+    are then loaded from Postgres by primary key.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        directory: os.PathLike = CONFIG["RETRIEVAL_INDEX_DIR"],
+        method: str = CONFIG["RETRIEVAL_MEMORY_METHOD"],
+        refresh_interval: float = CONFIG["RETRIEVAL_REFRESH_INTERVAL"],
+    ):
+        if method not in ("exact", "hnsw"):
+            raise ValueError("Invalid search method. Must be 'exact' or 'hnsw'.")
+
+        self.engine = engine
+        self.directory = Path(directory)
+        self.method = method
+        self._snapshot: Optional[_Snapshot] = None
+        self._refresh_lock = threading.Lock()
+        self._closed = threading.Event()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.refresh()
+
+        if refresh_interval:
+            threading.Thread(
+                target=self._refresh_periodically, args=(refresh_interval,), daemon=True
+            ).start()
+
+    def _refresh_periodically(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh the in-memory retrieval index.")
+
+    def close(self) -> None:
+        self._closed.set()
+
+    def _generation(self) -> Tuple[int, int, int]:
+        with Session(self.engine) as session:
+            count, max_chunk_id = session.execute(
+                select(func.count(Chunk.embedding), func.max(Chunk.chunk_id))
+            ).one()
+            # Duplicates found later link new articles to existing chunks
+            links = session.scalar(select(func.count()).select_from(ChunkArticle))
+        return count, max_chunk_id or 0, links
+
+    def _generation_dir(self, generation: Tuple[int, int, int]) -> Path:
+        return self.directory / "generation-{}-{}-{}".format(*generation)
+
+    def _fetch_rows(self, after_chunk_id: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Read the chunks with a chunk_id above after_chunk_id from Postgres.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: chunk ids and normalised float16
+                embeddings.
+        """
+        stmt = (
+            select(Chunk.chunk_id, Chunk.embedding)
+            .where(Chunk.chunk_id > after_chunk_id)
+            .where(Chunk.embedding.is_not(None))
+            .order_by(Chunk.chunk_id)
+        )
+        chunk_ids, embeddings = [], []
+        with Session(self.engine) as session:
+            for chunk_id, embedding in session.execute(
+                stmt.execution_options(yield_per=10000)
+            ):
+                chunk_ids.append(chunk_id)
+                embeddings.append(embedding)
+
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(
+            -1, EMBEDDING_DIM
+        )
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = (embeddings / np.maximum(norms, 1e-12)).astype(np.float16)
+        return np.asarray(chunk_ids, dtype=np.int64), embeddings
+
+    def _fetch_links(self, chunk_ids: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Read every chunk_articles link of the chunks with the article's file
+        and ingestion time, which the search filters apply to.
+
+        Args:
+            chunk_ids (np.ndarray): the chunk ids of the snapshot, ascending.
+
+        Returns:
+            Dict[str, np.ndarray]: the link arrays of _Snapshot, by field name.
+        """
+        stmt = (
+            select(
+                ChunkArticle.chunk_id,
+                ChunkArticle.article_id,
+                Article.file_id,
+                File.created_at,
+            )
+            .join(Article, ChunkArticle.article_id == Article.article_id)
+            .join(File, Article.file_id == File.file_id)
+        )
+        columns = ([], [], [], [])
+        with Session(self.engine) as session:
+            for row in session.execute(stmt.execution_options(yield_per=10000)):
+                for column, value in zip(columns, row):
+                    column.append(value)
+
+        link_chunk_ids = np.asarray(columns[0], dtype=np.int64)
+        rows = np.searchsorted(chunk_ids, link_chunk_ids)
+        # Drop the links of chunks that are not in the snapshot (not embedded yet)
+        found = rows < len(chunk_ids)
+        found[found] = chunk_ids[rows[found]] == link_chunk_ids[found]
+        return {
+            "link_rows": rows[found],
+            "link_article_ids": np.asarray(columns[1], dtype=np.int64)[found],
+            "link_file_ids": np.asarray(columns[2], dtype=np.int64)[found],
+            "link_created_at": np.asarray(columns[3], dtype="datetime64[us]")[found],
+        }
+
+    def _write_snapshot(
+        self, generation: Tuple[int, int, int], previous: Optional[_Snapshot]
+    ) -> None:
+        """
+        Write the snapshot of a generation to disk, reusing the rows (and HNSW
+        graph) of the previous snapshot if the new generation only appended
+        chunks. The links are always read again.
+        """
+        chunk_ids, embeddings = self._fetch_rows(
+            after_chunk_id=previous.generation[1] if previous else 0
+        )
+        previous_hnsw = None
+        if previous is not None:
+            if previous.generation[0] + len(chunk_ids) == generation[0]:
+                logger.info(f"Appending {len(chunk_ids)} chunks to the retrieval index.")
+                chunk_ids = np.concatenate([previous.chunk_ids, chunk_ids])
+                embeddings = np.concatenate([previous.embeddings, embeddings])
+                previous_hnsw = self._generation_dir(previous.generation) / "hnsw.bin"
+            else:
+                # Chunks were deleted or rewritten: rebuild from scratch
+                return self._write_snapshot(generation, previous=None)
+
+        # Build in a temporary directory and rename it, so readers never see
+        # a partial snapshot
+        final_dir = self._generation_dir(generation)
+        tmp_dir = final_dir.with_name(final_dir.name + f".tmp-{os.getpid()}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir()
+
+        matrix = np.lib.format.open_memmap(
+            tmp_dir / "embeddings.npy",
+            mode="w+",
+            dtype=np.float16,
+            shape=embeddings.shape,
+        )
+        matrix[:] = embeddings
+        matrix.flush()
+        del matrix
+        np.savez(
+            tmp_dir / "metadata.npz", chunk_ids=chunk_ids, **self._fetch_links(chunk_ids)
+        )
+
+        if self.method == "hnsw":
+            import hnswlib
+
+            # Extend a copy of the previous graph, the loaded one is being searched
+            hnsw = hnswlib.Index(space="ip", dim=EMBEDDING_DIM)
+            if previous_hnsw is not None and previous_hnsw.exists():
+                hnsw.load_index(str(previous_hnsw), max_elements=max(len(chunk_ids), 1))
+                start = hnsw.get_current_count()
+            else:
+                hnsw.init_index(
+                    max_elements=max(len(chunk_ids), 1),
+                    M=CONFIG["HNSW_M"],
+                    ef_construction=CONFIG["HNSW_EF_CONSTRUCTION"],
+                )
+                start = 0
+            if len(chunk_ids) > start:
+                hnsw.add_items(
+                    embeddings[start:].astype(np.float32),
+                    np.arange(start, len(chunk_ids)),
+                )
+            hnsw.save_index(str(tmp_dir / "hnsw.bin"))
+
+        os.rename(tmp_dir, final_dir)
+
+    def _load_snapshot(self, generation: Tuple[int, int, int]) -> _Snapshot:
+        generation_dir = self._generation_dir(generation)
+        metadata = np.load(generation_dir / "metadata.npz")
+        embeddings = np.load(generation_dir / "embeddings.npy", mmap_mode="r")
+
+        hnsw = None
+        if self.method == "hnsw":
+            import hnswlib
+
+            hnsw = hnswlib.Index(space="ip", dim=EMBEDDING_DIM)
+            hnsw.load_index(
+                str(generation_dir / "hnsw.bin"), max_elements=max(len(embeddings), 1)
+            )
+
+        return _Snapshot(
+            generation=generation,
+            chunk_ids=metadata["chunk_ids"],
+            embeddings=embeddings,
+            link_rows=metadata["link_rows"],
+            link_article_ids=metadata["link_article_ids"],
+            link_file_ids=metadata["link_file_ids"],
+            link_created_at=metadata["link_created_at"],
+            hnsw=hnsw,
+        )
+
+    def refresh(self) -> bool:
+        """
+        Load the snapshot of the current generation of the chunks table,
+        building it first if no worker has done so yet.
+
+        Returns:
+            bool: True if a new snapshot was loaded.
+        """
+        with self._refresh_lock:
+            generation = self._generation()
+            if self._snapshot is not None and self._snapshot.generation == generation:
+                return False
+
+            # Only one worker builds a generation, the others wait and load it
+            with open(self.directory / ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Another worker may have built a newer generation meanwhile
+                generation = self._generation()
+                generation_dir = self._generation_dir(generation)
+                if not generation_dir.exists() or (
+                    self.method == "hnsw"
+                    and not (generation_dir / "hnsw.bin").exists()
+                ):
+                    shutil.rmtree(generation_dir, ignore_errors=True)
+                    self._write_snapshot(generation, previous=self._snapshot)
+
+                # Load before releasing the lock, so no other worker removes
+                # the generation while it is being read
+                self._snapshot = self._load_snapshot(generation)
+
+                # Remove older generations. Workers still searching them keep
+                # their loaded graph and mapped pages until they switch over.
+                for path in self.directory.glob("generation-*"):
+                    if path != generation_dir:
+                        shutil.rmtree(path, ignore_errors=True)
+
+            logger.info(
+                f"Loaded retrieval index generation {generation} "
+                f"({len(self._snapshot.chunk_ids)} chunks, method={self.method})."
+            )
+            return True
+
+    def _filter_mask(
+        self, snapshot: _Snapshot, filters: Optional[SearchFilters]
+    ) -> Optional[np.ndarray]:
+        if filters is None:
+            return None
+
+        # A chunk matches if any article it appears in matches every filter
+        links = np.ones(len(snapshot.link_rows), dtype=bool)
+        if filters.article_ids:
+            links &= np.isin(snapshot.link_article_ids, filters.article_ids)
+        if filters.file_ids:
+            links &= np.isin(snapshot.link_file_ids, filters.file_ids)
+        if filters.ingested_after:
+            after = np.datetime64(filters.ingested_after, "us")
+            links &= snapshot.link_created_at >= after
+        if filters.ingested_before:
+            before = np.datetime64(filters.ingested_before, "us")
+            links &= snapshot.link_created_at < before
+
+        mask = np.zeros(len(snapshot.chunk_ids), dtype=bool)
+        mask[snapshot.link_rows[links]] = True
+        return mask
+
+    def _search_exact(
+        self,
+        snapshot: _Snapshot,
+        queries: np.ndarray,
+        k: int,
+        masks: List[Optional[np.ndarray]],
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # One pass over the matrix for all queries. Rows are converted to
+        # float32 block by block, float16 matrix products are slow on cpu.
+        similarities = np.empty((len(snapshot.chunk_ids), len(queries)), np.float32)
+        for start in range(0, len(similarities), _SEARCH_BLOCK_ROWS):
+            block = snapshot.embeddings[start : start + _SEARCH_BLOCK_ROWS]
+            similarities[start : start + len(block)] = (
+                block.astype(np.float32) @ queries.T
+            )
+
+        k = min(k, len(similarities))
+        results = []
+        for column, mask in zip(similarities.T, masks):
+            if mask is not None:
+                column[~mask] = -np.inf
+            rows = np.argpartition(-column, k - 1)[:k]
+            rows = rows[np.argsort(-column[rows])]
+            rows = rows[np.isfinite(column[rows])]
+            results.append((rows, 1 - column[rows]))
+        return results
+
+    def _search_hnsw(
+        self,
+        snapshot: _Snapshot,
+        queries: np.ndarray,
+        k: int,
+        masks: List[Optional[np.ndarray]],
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        snapshot.hnsw.set_ef(max(40, k))
+        results = []
+        for query, mask in zip(queries, masks):
+            if mask is not None and mask.sum() <= _EXACT_FILTER_ROWS:
+                results.append(self._search_rows(snapshot, query, mask, k))
+                continue
+            try:
+                rows, distances = snapshot.hnsw.knn_query(
+                    query,
+                    k=min(k, len(snapshot.chunk_ids) if mask is None else mask.sum()),
+                    filter=None if mask is None else (lambda row: bool(mask[row])),
+                )
+            except RuntimeError:
+                # The filtered graph walk found fewer than k matching chunks
+                logger.warning("Filtered hnsw search fell back to exact search.")
+                results.append(self._search_rows(snapshot, query, mask, k))
+                continue
+            results.append((rows[0].astype(np.int64), distances[0]))
+        return results
+
+    def _search_rows(
+        self, snapshot: _Snapshot, query: np.ndarray, mask: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Exact search over only the chunks matching a filter
+        rows = np.flatnonzero(mask)
+        similarities = snapshot.embeddings[rows].astype(np.float32) @ query
+        order = np.argsort(-similarities)[:k]
+        return rows[order], 1 - similarities[order]
+
+    def search(
+        self,
+        vector: tensor,
+        top_k: int = 10,
+        max_distance: float = 0.5,
+        filters: Optional[SearchFilters] = None,
+    ) -> List[Chunk]:
+        return self.search_batch([vector], top_k, max_distance, [filters])[0]
+
+    def search_batch(
+        self,
+        vectors: List[tensor],
+        top_k: int = 10,
+        max_distance: float = 0.5,
+        filters: Optional[List[Optional[SearchFilters]]] = None,
+    ) -> List[List[Chunk]]:
+        snapshot = self._snapshot
+        if snapshot is None or not len(snapshot.chunk_ids):
+            return [[] for _ in vectors]
+
+        queries = np.asarray([vector.tolist() for vector in vectors], dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        masks = [
+            self._filter_mask(snapshot, f) for f in (filters or [None] * len(vectors))
+        ]
+
+        search = self._search_hnsw if self.method == "hnsw" else self._search_exact
+        results = []
+        for start in range(0, len(queries), _SEARCH_QUERY_GROUP):
+            results.extend(
+                search(
+                    snapshot,
+                    queries[start : start + _SEARCH_QUERY_GROUP],
+                    top_k,
+                    masks[start : start + _SEARCH_QUERY_GROUP],
+                )
+            )
+        chunk_ids = [
+            [
+                int(chunk_id)
+                for chunk_id, distance in zip(snapshot.chunk_ids[rows], distances)
+                if distance < max_distance
+            ]
+            for rows, distances in results
+        ]
+
+        # Load the chunks of every query with a single primary key lookup
+        all_ids = {chunk_id for ids in chunk_ids for chunk_id in ids}
+        chunks: Dict[int, Chunk] = {}
+        if all_ids:
+            with Session(self.engine) as session:
+                chunks = {
+                    chunk.chunk_id: chunk
+                    for chunk in session.scalars(
+                        select(Chunk)
+                        .options(
+                            joinedload(Chunk.article).joinedload(Article.file),
+                            selectinload(Chunk.articles).joinedload(Article.file),
+                        )
+                        .where(Chunk.chunk_id.in_(all_ids))
+                    )
+                }
+        return [[chunks[i] for i in ids if i in chunks] for ids in chunk_ids]
+
+
+RETRIEVAL_BACKENDS = {
+    "pgvector": PgVectorBackend,
+    "memory": InMemoryBackend,
+}
+
+
+def get_retrieval_backend(
+    engine: Engine, name: str = CONFIG["RETRIEVAL_BACKEND"]
+) -> RetrievalBackend:
+    """
+    Get this process's retrieval backend, creating it on first use.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        name (str, optional): the backend, one of RETRIEVAL_BACKENDS.
+            Defaults to CONFIG["RETRIEVAL_BACKEND"].
+
+    Returns:
+        RetrievalBackend: the retrieval backend.
+    """
+    global _BACKEND
+    if _BACKEND is None:
+        with _BACKEND_LOCK:
+            if _BACKEND is None:
+                if name not in RETRIEVAL_BACKENDS:
+                    raise ValueError(
+                        f"Invalid retrieval backend. Must be one of {list(RETRIEVAL_BACKENDS)}."
+                    )
+                _BACKEND = RETRIEVAL_BACKENDS[name](engine)
+    return _BACKEND
+
+
+def close_retrieval_backend() -> None:
+    """
+    Stop the background work of this process's retrieval backend, if it was created.
+    """
+    if _BACKEND is not None:
+        _BACKEND.close()
@@ -0,0 +1,241 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import toml
+
+from ormModels import Chunk
+from pydanticModels import SearchFilters
+from requestTrace import RequestTrace
+from rerankCascade import cosine_distances
+from retrieval import RetrievalBackend
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+# Embeds a list of queries, returning each embedding and whether it was cached
+EmbedQueries = Callable[[List[str]], List[Tuple[Any, bool]]]
+
+_EXECUTOR = ThreadPoolExecutor(
+    max_workers=CONFIG["SPECULATION_WORKERS"], thread_name_prefix="speculation"
+)
+
+
+@dataclass
+class _Speculation:
+    embedding: Any
+    cache_hit: bool
+    candidates: List[Chunk]
+    # perf_counter times the speculative retrieval started and finished
+    started: float
+    finished: float
+
+
+@dataclass
+class Retrieval:
+    """
+    The candidates retrieved for a search query.
+
+    Attributes:
+        embedding (Any): the search query embedding.
+        cache_hit (bool): whether the embedding came from the cache.
+        candidates (List[Chunk]): the candidates, ordered by increasing cosine
+            distance to the search query.
+        speculation (Optional[str]): "hit" if the speculative candidates were
+            reused, "miss" if they were merged with a follow-up search, "failed"
+            if the speculative retrieval failed, None without speculation.
+        saved_seconds (float): retrieval time hidden behind the query rewrite.
+    """
+
+    embedding: Any
+    cache_hit: bool
+    candidates: List[Chunk]
+    speculation: Optional[str] = None
+    saved_seconds: float = 0.0
+
+
+class SpeculationStats:
+    """
+    Counts speculation outcomes and the retrieval time they saved.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {"hit": 0, "miss": 0, "failed": 0}
+        self._saved_seconds = 0.0
+
+    def record(self, retrieval: Retrieval) -> None:
+        with self._lock:
+            self._counts[retrieval.speculation] += 1
+            self._saved_seconds += retrieval.saved_seconds
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the speculation outcome counts, hit rate and saved time.
+
+        Returns:
+            Dict[str, Any]: speculation statistics of this API worker.
+        """
+        with self._lock:
+            total = sum(self._counts.values())
+            return {
+                "enabled": CONFIG["SPECULATIVE_RETRIEVAL"],
+                **self._counts,
+                "hit_rate": round(self._counts["hit"] / total, 4) if total else None,
+                "saved_seconds": round(self._saved_seconds, 3),
+                "avg_saved_seconds": (
+                    round(self._saved_seconds / total, 3) if total else None
+                ),
+            }
+
+
+SPECULATION_STATS = SpeculationStats()
+
+
+def speculate(
+    query: str,
+    filters: Optional[SearchFilters],
+    backend: RetrievalBackend,
+    embed: EmbedQueries,
+    trace: RequestTrace,
+) -> Future:
+    """
+    Start embedding the raw user query and searching with it in the
+    background, while the search query is being rewritten.
+
+    Args:
+        query (str): the raw user query.
+        filters (Optional[SearchFilters]): the search filters.
+        backend (RetrievalBackend): the retrieval backend.
+        embed (EmbedQueries): embeds queries.
+        trace (RequestTrace): the request's trace, timing the speculative_embed
+            and speculative_search stages.
+
+    Returns:
+        Future: resolves to the speculative retrieval, see resolve.
+    """
+
+    def retrieve() -> _Speculation:
+        started = time.perf_counter()
+        with trace.stage("speculative_embed"):
+            [(embedding, cache_hit)] = embed([query])
+        with trace.stage("speculative_search"):
+            candidates = backend.search(
+                vector=embedding, top_k=CONFIG["RETRIEVAL_TOP_K"], filters=filters
+            )
+        return _Speculation(
+            embedding, cache_hit, candidates, started, time.perf_counter()
+        )
+
+    # Run in a copy of this context, so its logs and model calls carry the request id
+    return _EXECUTOR.submit(contextvars.copy_context().run, retrieve)
+
+
+def _retrieve(
+    search_query: str,
+    filters: Optional[SearchFilters],
+    backend: RetrievalBackend,
+    embed: EmbedQueries,
+    trace: RequestTrace,
+) -> Retrieval:
+    with trace.stage("embed"):
+        [(embedding, cache_hit)] = embed([search_query])
+    with trace.stage("search"):
+        candidates = backend.search(
+            vector=embedding, top_k=CONFIG["RETRIEVAL_TOP_K"], filters=filters
+        )
+    return Retrieval(embedding, cache_hit, candidates)
+
+
+def resolve(
+    speculation: Future,
+    query: str,
+    search_query: str,
+    filters: Optional[SearchFilters],
+    backend: RetrievalBackend,
+    embed: EmbedQueries,
+    trace: RequestTrace,
+    max_distance: float = CONFIG["SPECULATION_MAX_DISTANCE"],
+) -> Retrieval:
+    """
+    Get the candidates of the rewritten search query from a speculative
+    retrieval. They are reused as they are if the search query is the raw
+    query, or its embedding is within max_distance of the raw query's.
+    Otherwise a follow-up search with the search query runs, and the
+    speculative candidates it missed are merged into its results.
+
+    Args:
+        speculation (Future): the speculative retrieval, see speculate.
+        query (str): the raw user query.
+        search_query (str): the rewritten search query.
+        filters (Optional[SearchFilters]): the search filters.
+        backend (RetrievalBackend): the retrieval backend.
+        embed (EmbedQueries): embeds queries.
+        trace (RequestTrace): the request's trace.
+        max_distance (float, optional): cosine distance between the two query
+            embeddings up to which the speculative candidates are reused.
+            Defaults to CONFIG["SPECULATION_MAX_DISTANCE"].
+
+    Returns:
+        Retrieval: the candidates of the search query.
+    """
+    rewritten = time.perf_counter()
+    try:
+        speculative = speculation.result()
+    except Exception:
+        logger.exception("Speculative retrieval failed, retrieving after the rewrite.")
+        retrieval = _retrieve(search_query, filters, backend, embed, trace)
+        retrieval.speculation = "failed"
+        SPECULATION_STATS.record(retrieval)
+        return retrieval
+
+    # Retrieval time that ran while the rewrite was generated
+    overlap = max(0.0, min(speculative.finished, rewritten) - speculative.started)
+
+    if search_query == query:
+        embedding, cache_hit, distance = speculative.embedding, True, 0.0
+    else:
+        with trace.stage("embed"):
+            [(embedding, cache_hit)] = embed([search_query])
+        distance = _query_distance(speculative.embedding, embedding)
+
+    if distance <= max_distance:
+        retrieval = Retrieval(
+            embedding, cache_hit, speculative.candidates, "hit", overlap
+        )
+    else:
+        with trace.stage("search"):
+            followup = backend.search(
+                vector=embedding, top_k=CONFIG["RETRIEVAL_TOP_K"], filters=filters
+            )
+        # Merge, keeping the order of increasing distance to the search query
+        seen = {chunk.chunk_id for chunk in followup}
+        merged = followup + [
+            chunk for chunk in speculative.candidates if chunk.chunk_id not in seen
+        ]
+        distances = cosine_distances(embedding, merged) if merged else []
+        merged = [chunk for _, chunk in sorted(zip(distances, merged), key=_first)]
+        retrieval = Retrieval(embedding, cache_hit, merged, "miss", 0.0)
+
+    logger.info(
+        f"Speculative retrieval {retrieval.speculation} (query distance "
+        f"{distance:.3f}), saved {retrieval.saved_seconds:.3f}s."
+    )
+    SPECULATION_STATS.record(retrieval)
+    return retrieval
+
+
+def _query_distance(first: Any, second: Any) -> float:
+    first = np.asarray(first.tolist(), dtype=np.float32)
+    second = np.asarray(second.tolist(), dtype=np.float32)
+    norms = max(float(np.linalg.norm(first) * np.linalg.norm(second)), 1e-12)
+    return 1.0 - float(first @ second) / norms
+
+
+def _first(pair: Tuple[float, Chunk]) -> float:
+    return pair[0]
@@ -1,25 +1,33 @@
-from typing import List, Dict, Any, Type
+from typing import List, Dict, Any, Optional, Type
 import os
 import logging
 
-from sqlalchemy import create_engine, Engine, select, insert, text
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import create_engine, Engine, Select, select, insert, text, func, cast
+from sqlalchemy.orm import Session, joinedload, selectinload
+from pgvector.sqlalchemy import BIT, HALFVEC, VECTOR
 from sqlalchemy.engine import URL
 from sqlalchemy_utils import database_exists, create_database, drop_database
 from torch import tensor
 import toml
 
-from ormModels import Base, File, Chunk, Article
+from messageLog import copy_unpartitioned, ensure_partitions, migrate_unpartitioned
+from ormModels import Base, File, Chunk, ChunkArticle, Article
+from pydanticModels import SearchFilters
+from vectorStorage import IndexMode, create_embedding_index, drop_partial_indexes
 
 CONFIG = toml.load("config.toml")
 logger = logging.getLogger(__name__)
 
 
-def create_connection() -> Engine:
+def create_connection(force_rebuild: bool = CONFIG["FORCE_REBUILD"]) -> Engine:
     """
     Opens a connection to the PostgreSQL database specified in the configuration file.
     Also creates the database and tables if they do not exist.
 
+    Args:
+        force_rebuild (bool, optional): drop and recreate the database if it exists.
+            Defaults to CONFIG["FORCE_REBUILD"].
+
     Returns:
         Engine: SQLAlchemy engine connected to the PostgreSQL database.
     """
@@ -33,7 +41,7 @@ def create_connection() -> Engine:
         database=CONFIG["DATABASE"],
     )
 
-    if CONFIG["FORCE_REBUILD"] and database_exists(db_url):
+    if force_rebuild and database_exists(db_url):
         logger.info("Dropping existing database...")
         drop_database(db_url)
 
@@ -48,8 +56,46 @@ def create_connection() -> Engine:
         with session.begin():
             session.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
 
+    # Databases created before the message log was partitioned
+    migrate_unpartitioned(engine)
+
     Base.metadata.create_all(engine)
 
+    # create_all doesn't add columns to existing tables
+    with Session(engine) as session:
+        session.execute(
+            text("ALTER TABLE files ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)")
+        )
+        for stage in ("speculative_embed", "speculative_search"):
+            session.execute(
+                text(
+                    f"ALTER TABLE message_traces "
+                    f"ADD COLUMN IF NOT EXISTS {stage}_seconds FLOAT"
+                )
+            )
+        # Search filters match chunks through chunk_articles, so every chunk
+        # needs a link to its own article. Chunks stored before the table
+        # existed don't have one.
+        session.execute(
+            text(
+                "INSERT INTO chunk_articles (chunk_id, article_id) "
+                "SELECT chunk_id, article_id FROM chunks WHERE NOT EXISTS "
+                "(SELECT 1 FROM chunk_articles l WHERE l.chunk_id = chunks.chunk_id)"
+            )
+        )
+        session.commit()
+
+    # create_all skips indexes of tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    create_embedding_index(engine)
+    drop_partial_indexes(engine)
+
+    # The message log only accepts rows for months with a partition
+    ensure_partitions(engine)
+    copy_unpartitioned(engine)
+
     return engine
 
 
@@ -69,7 +115,10 @@ def insert_data(
     """
 
     with Session(engine) as session:
-        outputs = session.scalars(insert(table).returning(table), data)
+        # Return the rows in the order of data, so callers can zip them together
+        outputs = session.scalars(
+            insert(table).returning(table, sort_by_parameter_order=True), data
+        )
         session.commit()
         return outputs.all()
 
@@ -90,20 +139,118 @@ def get_files(engine: Engine) -> List[File]:
         return session.scalars(stmt).all()
 
 
+def _apply_filters(stmt: Select, filters: SearchFilters) -> Select:
+    """
+    Restrict a select statement over chunks to the chunks matching the filters.
+    A chunk matches if any article it appears in (see ChunkArticle) matches
+    every filter, so a search of a reprint also finds the chunks deduplicated
+    in favour of the original.
+
+    Args:
+        stmt (Select): a select statement over the chunks table.
+        filters (SearchFilters): the filters to apply.
+
+    Returns:
+        Select: the filtered statement.
+    """
+    links = select(ChunkArticle.chunk_id)
+    if filters.article_ids:
+        links = links.where(ChunkArticle.article_id.in_(filters.article_ids))
+
+    if filters.file_ids or filters.ingested_after or filters.ingested_before:
+        links = links.join(Article, ChunkArticle.article_id == Article.article_id)
+        if filters.file_ids:
+            links = links.where(Article.file_id.in_(filters.file_ids))
+
+    if filters.ingested_after or filters.ingested_before:
+        links = links.join(File, Article.file_id == File.file_id)
+        if filters.ingested_after:
+            links = links.where(File.created_at >= filters.ingested_after)
+        if filters.ingested_before:
+            links = links.where(File.created_at < filters.ingested_before)
+
+    return stmt.where(Chunk.chunk_id.in_(links))
+
+
 def vector_search(
-    vector: tensor, engine: Engine, top_k: int = 10, max_distance: float = 0.5
+    vector: tensor,
+    engine: Engine,
+    top_k: int = 10,
+    max_distance: float = 0.5,
+    mode: IndexMode = CONFIG["VECTOR_INDEX_MODE"],
+    filters: Optional[SearchFilters] = None,
 ) -> List[Chunk]:
+    """
+    Find the chunks closest to a vector by cosine distance, using the index
+    of the given storage mode (see vectorStorage.EMBEDDING_INDEXES).
+    In binary mode, the hamming distance pre-search returns
+    top_k * BINARY_RESCORE_FACTOR candidates which are then re-scored exactly
+    against the full precision embeddings.
 
-    with Session(engine) as session:
+    Filters are applied inside the index scan rather than to its results.
+    pgvector's iterative scan keeps walking the HNSW graph until enough chunks
+    pass the filters. For a selective filter, such as a single article or file,
+    the planner instead finds the matching chunks through the chunk_articles
+    index and computes their exact distances.
+
+    Args:
+        vector (tensor): the query embedding.
+        engine (Engine): SQLAlchemy engine for database operations.
+        top_k (int, optional): maximum number of chunks to return. Defaults to 10.
+        max_distance (float, optional): maximum cosine distance of returned chunks.
+            Defaults to 0.5.
+        mode (IndexMode, optional): the storage mode to search.
+            Defaults to CONFIG["VECTOR_INDEX_MODE"].
+        filters (Optional[SearchFilters], optional): restricts which chunks are
+            searched. Defaults to None.
 
+    Returns:
+        List[Chunk]: the closest chunks, ordered by increasing distance.
+    """
+    vector = vector.tolist()
+    exact_distance = Chunk.embedding.cosine_distance(vector)
+
+    if mode == "vector":
+        index_distance = exact_distance
+        limit = top_k
+    elif mode == "halfvec":
+        index_distance = Chunk.embedding.cast(HALFVEC(768)).cosine_distance(vector)
+        limit = top_k
+    elif mode == "binary":
+        index_distance = (
+            func.binary_quantize(Chunk.embedding)
+            .cast(BIT(768))
+            .hamming_distance(
+                func.binary_quantize(cast(vector, VECTOR(768))).cast(BIT(768))
+            )
+        )
+        limit = top_k * CONFIG["BINARY_RESCORE_FACTOR"]
+    else:
+        raise ValueError(
+            "Invalid index mode. Must be 'vector', 'halfvec' or 'binary'."
+        )
+
+    candidates = select(Chunk.chunk_id)
+    if filters is not None:
+        candidates = _apply_filters(candidates, filters)
+    candidates = candidates.order_by(index_distance).limit(limit).subquery()
+
+    with Session(engine) as session:
+        # The HNSW scan returns at most ef_search rows
+        session.execute(text(f"SET LOCAL hnsw.ef_search = {max(40, limit)}"))
+        if filters is not None:
+            session.execute(text("SET LOCAL hnsw.iterative_scan = relaxed_order"))
         results = session.scalars(
             select(Chunk)
             .options(
                 joinedload(Chunk.article).joinedload(
                     Article.file
-                )  # Eager load relationships
+                ),  # Eager load relationships
+                selectinload(Chunk.articles).joinedload(Article.file),
             )
-            .order_by(Chunk.embedding.cosine_distance(vector) < max_distance)
+            .where(Chunk.chunk_id.in_(select(candidates.c.chunk_id)))
+            .where(exact_distance < max_distance)
+            .order_by(exact_distance)
             .limit(top_k)
         )
 
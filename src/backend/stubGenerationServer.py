@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, Dict, Iterator, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# A stand-in for an OpenAI compatible inference server (vLLM, llama.cpp
+# server), to run GENERATION_BACKEND="openai" without a GPU:
+#
+#   python stubGenerationServer.py --port 8001
+#
+# and set GENERATION_API_URL="http://localhost:8001". Responses echo the end of
+# the prompt, word by word, after a short thinking section when
+# chat_template_kwargs.enable_thinking is set. --fail-rate answers that share
+# of requests with a 503, to exercise the client's retries.
+
+app = FastAPI()
+OPTIONS = argparse.Namespace(
+    model="Qwen/Qwen3-4B-AWQ", token_seconds=0.01, fail_rate=0.0, reasoning_parser=False
+)
+
+
+def _completion(body: Dict[str, Any]) -> List[Dict[str, str]]:
+    """
+    The (content, reasoning_content) deltas of the stub completion.
+    """
+    prompt = body["messages"][-1]["content"]
+    thinking = body.get("chat_template_kwargs", {}).get("enable_thinking", True)
+    words = f"Stub response to: {prompt[-200:]}".split(" ")
+    words = words[: body.get("max_tokens") or len(words)]
+
+    deltas = []
+    if thinking:
+        thoughts = ["Stub", "thinking", "content."]
+        if OPTIONS.reasoning_parser:
+            deltas += [{"reasoning_content": f"{word} "} for word in thoughts]
+        else:
+            deltas += [{"content": "<think>\n"}]
+            deltas += [{"content": f"{word} "} for word in thoughts]
+            deltas += [{"content": "\n</think>\n\n"}]
+    deltas += [{"content": f"{word} "} for word in words]
+    return deltas
+
+
+def _events(body: Dict[str, Any], deltas: List[Dict[str, str]]) -> Iterator[str]:
+    for delta in deltas:
+        time.sleep(OPTIONS.token_seconds)
+        event = {"object": "chat.completion.chunk", "model": body["model"]}
+        event["choices"] = [{"index": 0, "delta": delta, "finish_reason": None}]
+        yield f"data: {json.dumps(event)}\n\n"
+    if body.get("stream_options", {}).get("include_usage"):
+        usage = {
+            "prompt_tokens": len(body["messages"][-1]["content"].split()),
+            "completion_tokens": len(deltas),
+        }
+        yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.get("/v1/models")
+def models() -> Dict[str, Any]:
+    return {"object": "list", "data": [{"id": OPTIONS.model, "object": "model"}]}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    if random.random() < OPTIONS.fail_rate:
+        return JSONResponse(status_code=503, content={"error": "Stub failure."})
+
+    body = await request.json()
+    deltas = _completion(body)
+    if body.get("stream"):
+        return StreamingResponse(_events(body, deltas), media_type="text/event-stream")
+
+    await asyncio.sleep(OPTIONS.token_seconds * len(deltas))
+    message = {
+        "role": "assistant",
+        "content": "".join(delta.get("content", "") for delta in deltas),
+    }
+    reasoning = "".join(delta.get("reasoning_content", "") for delta in deltas)
+    if reasoning:
+        message["reasoning_content"] = reasoning
+    return {
+        "object": "chat.completion",
+        "model": body["model"],
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": len(body["messages"][-1]["content"].split()),
+            "completion_tokens": len(deltas),
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Stub OpenAI compatible chat completions server."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--model", default=OPTIONS.model)
+    parser.add_argument(
+        "--token-seconds",
+        type=float,
+        default=OPTIONS.token_seconds,
+        help="delay before each streamed token",
+    )
+    parser.add_argument(
+        "--fail-rate",
+        type=float,
+        default=OPTIONS.fail_rate,
+        help="share of requests answered with a 503",
+    )
+    parser.add_argument(
+        "--reasoning-parser",
+        action="store_true",
+        help="send the thinking as reasoning_content, like vLLM's reasoning parser",
+    )
+    args = parser.parse_args()
+    vars(OPTIONS).update(
+        model=args.model,
+        token_seconds=args.token_seconds,
+        fail_rate=args.fail_rate,
+        reasoning_parser=args.reasoning_parser,
+    )
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
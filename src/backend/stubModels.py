@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from typing import Any, Dict, List, Literal, Optional, Tuple
+
+import numpy as np
+import toml
+import torch
+
+from diagnostics import process_memory
+from generationBackends import GENERATION_STATS, Generation
+
+logger = logging.getLogger(__name__)
+CONFIG = toml.load("config.toml")
+
+# Lightweight stand-ins for languageModels, selected with USE_STUB_MODELS.
+# They need no weights and no GPU, so the serving path can be load tested on
+# any machine (see loadTest.py). Each function has the signature of its
+# languageModels counterpart. Embeddings and scores are deterministic functions
+# of the text, and generation sleeps while holding a lock, like a single GPU
+# running one generate call at a time.
+
+EMBEDDING_DIM = 768
+# Weight of the component shared by every stub embedding. Unrelated texts are
+# 1 / (1 + _SHARED_WEIGHT ** 2) = 0.41 apart in cosine distance, within the
+# search's max distance of 0.5, and texts sharing words are closer.
+_SHARED_WEIGHT = 1.2
+# Serialises generate calls, like the single inference model
+_GENERATION_LOCK = threading.Lock()
+MODEL_STATUS: Dict[str, Dict[str, Any]] = {
+    name: {"state": "pending", "seconds": None, "error": None}
+    for name in ("inference", "query_encoder", "cross_encoder", "warmup")
+}
+
+
+def _seed(text: str) -> int:
+    return int.from_bytes(hashlib.sha256(text.encode()).digest()[:4], "little")
+
+
+def _embed(text: str) -> np.ndarray:
+    """
+    Embed a text as its hashed bag of words, so texts sharing words land close
+    together and searches return chunks related to the query. Dimension 0 is
+    the shared component, the words are hashed into the others.
+    """
+    counts = np.zeros(EMBEDDING_DIM)
+    for word in re.findall(r"\w+", text.lower()):
+        counts[1 + _seed(word) % (EMBEDDING_DIM - 1)] += 1
+    norm = np.linalg.norm(counts)
+    if norm:
+        counts /= norm
+    counts[0] = _SHARED_WEIGHT
+    return counts
+
+
+def load_models() -> None:
+    for status in MODEL_STATUS.values():
+        status.update(state="ready", seconds=0.0)
+    logger.info("Using stub models.")
+
+
+def warmup() -> None:
+    MODEL_STATUS["warmup"].update(state="ready", seconds=0.0)
+
+
+def model_status() -> Dict[str, Dict[str, Any]]:
+    return {name: dict(status) for name, status in MODEL_STATUS.items()}
+
+
+def memory_stats() -> Dict[str, Any]:
+    return {
+        "process": process_memory(),
+        "devices": [],
+        "models": {},
+        "cache_releases": 0,
+    }
+
+
+def hold_article_encoder() -> None:
+    pass
+
+
+def release_article_encoder() -> None:
+    pass
+
+
+def embed_texts(
+    input_type: Literal["article", "query"],
+    texts: List[str],
+    input_ids: Optional[List[List[int]]] = None,
+) -> torch.tensor:
+    if isinstance(texts, str):
+        texts = [texts]
+    time.sleep(CONFIG["STUB_EMBED_SECONDS"])
+    return torch.tensor(np.stack([_embed(text) for text in texts]), dtype=torch.float32)
+
+
+def rerank_pairs(pairs: List[Tuple[str, str]], batch_size: int = 0) -> torch.tensor:
+    time.sleep(CONFIG["STUB_RERANK_SECONDS"])
+    # Scores around the rerank threshold of 5, so some chunks are kept
+    return torch.tensor(
+        [2.0 + 6.0 * (_seed(query + chunk) % 1000) / 1000 for query, chunk in pairs],
+        dtype=torch.float32,
+    )
+
+
+def rerank_chunks(query: str, chunks: List[str]) -> torch.tensor:
+    return rerank_pairs([(query, chunk) for chunk in chunks])
+
+
+def _simulate_generation(num_prompts: int, enable_thinking: bool) -> None:
+    seconds = CONFIG["STUB_GENERATE_SECONDS"] * (2 if enable_thinking else 1)
+    for _ in range(0, num_prompts, CONFIG["GENERATION_BATCH_SIZE"]):
+        with _GENERATION_LOCK:
+            time.sleep(seconds)
+
+
+def generate_texts(
+    prompts: List[str],
+    enable_thinking: bool = True,
+    max_new_tokens: int = CONFIG["MAX_NEW_TOKENS"],
+    batch_size: int = CONFIG["GENERATION_BATCH_SIZE"],
+) -> List[str]:
+    start = time.perf_counter()
+    _simulate_generation(len(prompts), enable_thinking)
+    responses = [f"Stub response to: {prompt[-200:]}" for prompt in prompts]
+    GENERATION_STATS.record(
+        time.perf_counter() - start,
+        [Generation(text=r, thinking="", completion_tokens=len(r.split())) for r in responses],
+    )
+    return responses
+
+
+def generate_text(
+    prompt: str,
+    enable_thinking: bool = True,
+    max_new_tokens: int = CONFIG["MAX_NEW_TOKENS"],
+) -> str:
+    return generate_texts([prompt], enable_thinking, max_new_tokens)[0]
+
+
+def generation_stats() -> Dict[str, Any]:
+    return GENERATION_STATS.stats()
+
+
+def generate_search_query(query: str, chat_history: str) -> str:
+    _simulate_generation(1, enable_thinking=False)
+    return query
+
+
+def generate_chat_response(query: str, context: str) -> str:
+    return generate_text(f"{query}\n\n{context}", enable_thinking=True)
+
+
+def generate_search_queries(queries: List[str], chat_histories: List[str]) -> List[str]:
+    _simulate_generation(len(queries), enable_thinking=False)
+    return list(queries)
+
+
+def generate_chat_responses_with_usage(
+    queries: List[str], contexts: List[str]
+) -> List[Tuple[str, Dict[str, Optional[int]]]]:
+    return [
+        (
+            response,
+            {
+                "prompt_tokens": len(q.split()) + len(c.split()),
+                "thinking_tokens": 0,
+                "answer_tokens": len(response.split()),
+            },
+        )
+        for q, c, response in zip(
+            queries, contexts, generate_chat_responses(queries, contexts)
+        )
+    ]
+
+
+def generate_chat_responses(queries: List[str], contexts: List[str]) -> List[str]:
+    return generate_texts(
+        [f"{q}\n\n{c}" for q, c in zip(queries, contexts)], enable_thinking=True
+    )
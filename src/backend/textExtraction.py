@@ -1,4 +1,4 @@
-from typing import List, Dict
+from typing import Dict, Iterator, List, Optional, Tuple
 import os
 import re
 
@@ -7,13 +7,50 @@ import pymupdf
 
 class Article:
     """
-    Class to extract and process text from a PDF article.
+    Class holding the title, authors, page range and body text of one article
+    extracted from a PDF document.
+    """
+
+    def __init__(self, title: str, start_page: int):
+
+        self.title = title
+        self.authors = None
+        self.start_page = start_page
+        self.end_page = None
+        self.body = None
+        self.irregular_blocks = []
+
+        # Body blocks, joined into self.body once the article is complete
+        self._body_parts = []
+
+    def _finish(self, end_page: int) -> None:
+        """
+        Close the article at the given page and assemble its body text.
+
+        Args:
+            end_page (int): the last page of the article (0-indexed).
+        """
+        self.end_page = end_page
+
+        # Remove line breaks unless they are followed by a capital letter, indicating a new sentence
+        self.body = re.sub(r"\n(?=[^A-Z])", "", "\n".join(self._body_parts).strip())
+        self._body_parts = []
+
+    def __repr__(self) -> str:
+        return f"Article(title={self.title}, pages={self.start_page}-{self.end_page})"
+
+
+class Document:
+    """
+    Class to extract and process text from a PDF document,
+    which may contain one or more articles.
     """
 
     def __init__(
         self,
         path: os.PathLike,
         title_size: int = 20,
+        max_title_size: int = 40,
         author_size: int = 15,
         body_size: int = 10,
         note_size: int = 7.5,
@@ -22,23 +59,17 @@ class Article:
         # Init attributes
         self.path = path
         self.title_size = title_size
+        self.max_title_size = max_title_size
         self.author_size = author_size
         self.body_size = body_size
         self.note_size = note_size
 
-        # Init data attributes to None
-        self.title = None
-        self.authors = None
-        self.start_page = None
-        self.end_page = None
-        self.body = None
-        self.irregular_blocks = None
-
-        # Open the PDF document
-        self.doc = pymupdf.open(path)
-        self.num_pages = len(self.doc)
+        # Init data attributes
+        self.articles: List[Article] = []
+        self.doc = None
+        self.num_pages = None
 
-        # Process the PDF file to extract title, authors, and body text
+        # Process the PDF file to extract the title, authors, and body text of each article
         self._process_file()
 
     def _read_page_blocks(self, page_number: int) -> List[Dict]:
@@ -87,57 +118,70 @@ class Article:
                 parsed_blocks.append({"text": block_text, "size": avg_font_size})
         return parsed_blocks
 
-    def _parse_doc(self) -> Dict[int, List[Dict]]:
+    def _iter_blocks(self) -> Iterator[Tuple[int, Dict]]:
         """
-        Parse the entire document to extract text blocks and their average font sizes.
+        Lazily parse the document page by page. A page is only read once the
+        consumer has used up the blocks of the previous page, so stopping the
+        iteration early skips reading the remaining pages entirely.
 
-        Returns:
-            List[Dict]: A list of dictionaries with block text and average font size for each page.
+        Yields:
+            Tuple[int, Dict]: the page number and a dictionary with the block text
+                and average font size, for each block in reading order.
         """
-        all_blocks = {}
         for page_number in range(self.num_pages):
             blocks = self._read_page_blocks(page_number)
-            parsed_blocks = self._parse_blocks(blocks)
-            all_blocks[page_number] = parsed_blocks
-        return all_blocks
+            for block in self._parse_blocks(blocks):
+                yield page_number, block
+
+    def _is_title(self, block: Dict) -> bool:
+        # Blocks far larger than a title are figure text, not headlines
+        return self.title_size <= block["size"] <= self.max_title_size
 
     def _process_file(self) -> None:
         """
-        Process the PDF file to extract title, authors, and body text.
-        Ignore any text before the first headline
-        or after the second headline (if applicable).
+        Process the PDF file in a single pass, splitting it into articles.
+        Ignore any text before the first headline. Every following headline
+        closes the current article and starts the next one.
+        The document is closed as soon as processing finishes.
         """
-        page_blocks = self._parse_doc()
-        start = False
-        self.body = ""
-        self.irregular_blocks = []
-        for page, blocks in page_blocks.items():
-            for block in blocks:
-                # If no title has been found yet, check for the title
-                if not start and block["size"] < self.title_size:
-                    continue
-                if not start and block["size"] >= self.title_size:
-                    start = True
-                    self.start_page = page
-                    self.title = block["text"]
-                    continue
-
-                # If the title has been found, check next title to break
-                if block["size"] == self.title_size:
-                    self.end_page = page
-                    break
-
-                # If block is too small, skip it
-                if block["size"] <= self.note_size:
-                    continue
-
-                # Add block to appropriate attribute
-                if block["size"] == self.author_size and not self.authors:
-                    self.authors = block["text"]
-                elif block["size"] == self.body_size:
-                    self.body += block["text"] + "\n"
-                else:
-                    self.irregular_blocks.append(block)
-
-        # Remove line breaks unless they are followed by a capital letter, indicating a new sentence
-        self.body = re.sub(r"\n(?=[^A-Z])", "", self.body.strip())
+        article: Optional[Article] = None
+        in_title = False
+        page = 0
+
+        with pymupdf.open(self.path) as doc:
+            self.doc = doc
+            self.num_pages = len(doc)
+            try:
+                for page, block in self._iter_blocks():
+                    if self._is_title(block):
+                        # Titles spanning several lines may be split into several blocks
+                        if in_title:
+                            article.title += " " + block["text"]
+                            continue
+
+                        # A new headline starts a new article
+                        if article is not None:
+                            article._finish(end_page=page)
+                        article = Article(title=block["text"], start_page=page)
+                        self.articles.append(article)
+                        in_title = True
+                        continue
+                    in_title = False
+
+                    # Ignore any text before the first title, and blocks that are too small
+                    if article is None or block["size"] <= self.note_size:
+                        continue
+
+                    # Add block to appropriate attribute
+                    if block["size"] == self.author_size and not article.authors:
+                        article.authors = block["text"]
+                    elif block["size"] == self.body_size:
+                        article._body_parts.append(block["text"])
+                    else:
+                        article.irregular_blocks.append(block)
+            finally:
+                self.doc = None
+
+        # The last article runs to the end of the document
+        if article is not None:
+            article._finish(end_page=self.num_pages - 1)
@@ -1,16 +1,22 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from pathlib import Path
 from datetime import datetime
+from functools import lru_cache
+import hashlib
 import logging
+import os
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from sqlalchemy import Engine
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
+import toml
 
-from textExtraction import Article
-from languageModels import embed_texts
-from ormModels import Chunk, Article as ArticleORM, File
+from deduplication import ChunkDeduplicator
+from textExtraction import Article, Document
+from ormModels import Article as ArticleORM, File
 from sqlFunctions import insert_data, get_files
 
+CONFIG = toml.load("config.toml")
 logger = logging.getLogger(__name__)
 TEXT_SPLITTER = RecursiveCharacterTextSplitter(
     chunk_size=1500,
@@ -39,6 +45,158 @@ def generate_chunks(
     return text_splitter.split_text(article.body)
 
 
+@lru_cache(maxsize=1)
+def get_chunk_tokenizer() -> PreTrainedTokenizerBase:
+    """
+    Load the article encoder's tokenizer, used to measure chunk sizes in tokens.
+
+    Returns:
+        PreTrainedTokenizerBase: the MedCPT article encoder tokenizer.
+    """
+    return AutoTokenizer.from_pretrained(CONFIG["ARTICLE_EMBEDDING_MODEL"])
+
+
+def _boundary_score(text: str, offsets: List[tuple], index: int) -> int:
+    """
+    Score how natural it is to split the text before the token at index,
+    mirroring the separator priority of TEXT_SPLITTER.
+
+    Returns:
+        int: 3 for a line break, 2 for a sentence end, 1 for a word boundary
+            and 0 inside a word.
+    """
+    gap = text[offsets[index - 1][1] : offsets[index][0]]
+    if "\n" in gap:
+        return 3
+    if gap and text[offsets[index - 1][1] - 1] in ".?!":
+        return 2
+    if gap:
+        return 1
+    return 0
+
+
+def generate_token_chunks(
+    article: Article,
+    tokenizer: PreTrainedTokenizerBase = None,
+    max_tokens: int = CONFIG["CHUNK_MAX_TOKENS"],
+    overlap_tokens: int = CONFIG["CHUNK_OVERLAP_TOKENS"],
+) -> List[Dict[str, Any]]:
+    """
+    Generate chunks from an article's body that fill the article encoder's window.
+    The body is tokenized once. Each chunk ends at the best boundary (line break,
+    then sentence end, then word boundary) in the second half of the window,
+    and the next chunk starts at the best boundary within the overlap.
+    The token ids of each chunk are returned with it, so the embedding stage
+    does not tokenize the text again.
+
+    Args:
+        article (Article): An instance of the Article class containing the article's body.
+        tokenizer (PreTrainedTokenizerBase, optional): tokenizer measuring chunk sizes.
+            Defaults to the article encoder tokenizer.
+        max_tokens (int, optional): maximum tokens per chunk, excluding special tokens.
+            Defaults to CONFIG["CHUNK_MAX_TOKENS"].
+        overlap_tokens (int, optional): maximum tokens shared by consecutive chunks.
+            Defaults to CONFIG["CHUNK_OVERLAP_TOKENS"].
+
+    Returns:
+        List[Dict[str, Any]]: the "text" and "input_ids" (without special tokens)
+            of each chunk.
+    """
+    tokenizer = tokenizer or get_chunk_tokenizer()
+    text = article.body
+    encoding = tokenizer(
+        text,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        verbose=False,
+    )
+    input_ids, offsets = encoding["input_ids"], encoding["offset_mapping"]
+
+    chunks = []
+    start = 0
+    while start < len(input_ids):
+        end = min(start + max_tokens, len(input_ids))
+        if end < len(input_ids):
+            end = max(
+                range(start + max_tokens // 2, end + 1),
+                key=lambda i: (_boundary_score(text, offsets, i), i),
+            )
+
+        chunks.append(
+            {
+                "text": text[offsets[start][0] : offsets[end - 1][1]],
+                "input_ids": input_ids[start:end],
+            }
+        )
+        if end == len(input_ids):
+            break
+
+        # Start the next chunk at the best boundary inside the overlap
+        candidates = range(max(end - overlap_tokens, start + 1), end)
+        start = max(
+            candidates,
+            key=lambda i: (_boundary_score(text, offsets, i), -i),
+            default=end,
+        )
+        if _boundary_score(text, offsets, start) == 0:
+            start = end
+
+    return chunks
+
+
+def count_truncated_chunks(
+    articles: List[Article],
+    text_splitter: RecursiveCharacterTextSplitter = TEXT_SPLITTER,
+    max_tokens: int = CONFIG["CHUNK_MAX_TOKENS"],
+) -> Dict[str, int]:
+    """
+    Count the chunks of the character splitter that exceed the encoder's window,
+    i.e. whose tail is silently cut off when they are embedded.
+
+    Args:
+        articles (List[Article]): articles to chunk.
+        text_splitter (RecursiveCharacterTextSplitter, optional): the character
+            splitter to check. Defaults to TEXT_SPLITTER.
+        max_tokens (int, optional): window size, excluding special tokens.
+            Defaults to CONFIG["CHUNK_MAX_TOKENS"].
+
+    Returns:
+        Dict[str, int]: the number of chunks, truncated chunks and truncated tokens.
+    """
+    tokenizer = get_chunk_tokenizer()
+    chunks = [
+        chunk for article in articles for chunk in generate_chunks(article, text_splitter)
+    ]
+    lengths = [
+        len(ids)
+        for ids in tokenizer(chunks, add_special_tokens=False, verbose=False)[
+            "input_ids"
+        ]
+    ]
+    return {
+        "chunks": len(chunks),
+        "truncated_chunks": sum(length > max_tokens for length in lengths),
+        "truncated_tokens": sum(max(length - max_tokens, 0) for length in lengths),
+    }
+
+
+def file_hash(path: os.PathLike) -> str:
+    """
+    SHA-256 of a file's content, read in 1 MiB blocks.
+
+    Args:
+        path (os.PathLike): the file.
+
+    Returns:
+        str: the hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while block := file.read(2**20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def idetify_new_files(
     directory: Path,
     existing_files: List[str],
@@ -63,6 +221,7 @@ def idetify_new_files(
                     "file_type": "pdf",
                     "created_at": datetime.now(),
                     "modified_at": datetime.now(),
+                    "content_hash": file_hash(file_path),
                 }
             )
     return new_files
@@ -71,6 +230,7 @@ def idetify_new_files(
 def process_files(files: List[File]) -> List[Dict[str, Any]]:
     """
     Process a list of File objects to extract article information.
+    Each file is opened and parsed once, and every article it contains is extracted.
 
     Args:
         files (List[File]): A list of File objects representing PDF files.
@@ -81,40 +241,49 @@ def process_files(files: List[File]) -> List[Dict[str, Any]]:
 
     article_data = []
     for file in files:
-        article = Article(file.file_path)
-        article_data.append(
-            {
-                "file_id": file.file_id,
-                "start_page": article.start_page,
-                "end_page": article.end_page,
-                "title": article.title,
-                "authors": article.authors,
-                "body": article.body,
-            }
-        )
+        document = Document(file.file_path)
+        logger.info(f"Found {len(document.articles)} articles in {file.filename}.")
+        for article in document.articles:
+            article_data.append(
+                {
+                    "file_id": file.file_id,
+                    "start_page": article.start_page,
+                    "end_page": article.end_page,
+                    "title": article.title,
+                    "authors": article.authors or "",
+                    "body": article.body,
+                }
+            )
     return article_data
 
 
-def process_articles(articles: List[ArticleORM]) -> List[Dict[str, Any]]:
+def process_articles(
+    articles: List[ArticleORM], deduplicator: Optional[ChunkDeduplicator] = None
+) -> List[Dict[str, Any]]:
     """
     Process a list of ArticleORM objects to extract article information.
 
     Args:
         articles (List[ArticleORM]): A list of ArticleORM objects representing articles.
+        deduplicator (Optional[ChunkDeduplicator], optional): if given, chunks that
+            duplicate one seen before are left out and recorded by the deduplicator.
+            Defaults to None.
 
     Returns:
         List[Dict[str, Any]]: A list of dictionaries containing extracted article information.
+            With the token chunker, each also holds the chunk's "input_ids", and
+            with a deduplicator its "content_hash" and "minhash".
     """
     chunk_data = []
     for article in articles:
-        chunks = generate_chunks(article)
-        for chunk_text in chunks:
-            chunk_data.append(
-                {
-                    "article_id": article.article_id,
-                    "text": chunk_text,
-                }
-            )
+        if CONFIG["CHUNKER"] == "token":
+            chunks = generate_token_chunks(article)
+        else:
+            chunks = [{"text": text} for text in generate_chunks(article)]
+        for chunk in chunks:
+            chunk = {"article_id": article.article_id, **chunk}
+            if deduplicator is None or not deduplicator.check(chunk):
+                chunk_data.append(chunk)
     return chunk_data
 
 
@@ -125,6 +294,7 @@ def process_directory(
     """
     Process all unseen PDF files in a directory. Extract article information,
     generate chunks, embed them, and insert into the database.
+    The stages overlap, see ingestionPipeline.IngestionPipeline.
 
     Args:
         directory (Path): The path to the directory containing PDF files.
@@ -139,27 +309,14 @@ def process_directory(
         files = insert_data(engine, File, file_data)
         logger.info("Inserted new files into the database.")
 
-        # Extract article information from the files and insert into the database
-        article_data = process_files(files)
-        logger.info(f"Extracted {len(article_data)} articles from files.")
-        articles = insert_data(engine, ArticleORM, article_data)
-        logger.info("Inserted articles into the database.")
+        # Extract, chunk, embed and insert the articles of the files in a
+        # streaming pipeline, see ingestionPipeline.py
+        from ingestionPipeline import IngestionPipeline
 
-        # Generate chunks from the articles
-        chunk_data = process_articles(articles)
-        logger.info(f"Found {len(chunk_data)} chunks from articles.")
-
-        # Embed the chunks and insert them into the database
-        embeddings = embed_texts(
-            input_type="article",
-            texts=[chunk["text"] for chunk in chunk_data],
+        stats = IngestionPipeline(engine).run(files)
+        logger.info(
+            f"Inserted {stats['stages']['extract']['items']} articles and "
+            f"{stats['stages']['write']['items']} chunks into the database."
         )
-        logger.info(f"Generated embeddings for chunks.")
-
-        for chunk, embedding in zip(chunk_data, embeddings):
-            chunk["embedding"] = embedding
-
-        insert_data(engine, Chunk, chunk_data)
-        logger.info("Inserted chunks into the database.")
     else:
         logger.info("No new files to process.")
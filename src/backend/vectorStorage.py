@@ -0,0 +1,156 @@
+import argparse
+import logging
+import time
+from typing import Dict, Literal
+
+from sqlalchemy import Engine, text
+from sqlalchemy.orm import Session
+import toml
+
+CONFIG = toml.load("config.toml")
+logger = logging.getLogger(__name__)
+
+IndexMode = Literal["vector", "halfvec", "binary"]
+
+# HNSW index over chunks.embedding for each storage mode. The table always keeps
+# the full precision vectors, the compact modes only index a cast of them:
+#   - vector: full precision, 4 bytes per dimension.
+#   - halfvec: half precision, 2 bytes per dimension.
+#   - binary: 1 bit per dimension, searched by hamming distance and re-scored
+#       against the full precision vectors (see sqlFunctions.vector_search).
+EMBEDDING_INDEXES: Dict[str, Dict[str, str]] = {
+    "vector": {
+        "name": "idx_chunk_embedding",
+        "expression": "embedding vector_cosine_ops",
+    },
+    "halfvec": {
+        "name": "idx_chunk_embedding_halfvec",
+        "expression": "(embedding::halfvec(768)) halfvec_cosine_ops",
+    },
+    "binary": {
+        "name": "idx_chunk_embedding_binary",
+        "expression": "(binary_quantize(embedding)::bit(768)) bit_hamming_ops",
+    },
+}
+
+
+def _create_index(session: Session, name: str, mode: IndexMode) -> None:
+    index = EMBEDDING_INDEXES[mode]
+    session.execute(
+        text(
+            f"CREATE INDEX IF NOT EXISTS {name} ON chunks "
+            f"USING hnsw ({index['expression']}) "
+            f"WITH (m = {CONFIG['HNSW_M']}, "
+            f"ef_construction = {CONFIG['HNSW_EF_CONSTRUCTION']})"
+        )
+    )
+
+
+def drop_partial_indexes(engine: Engine) -> int:
+    """
+    Drop the per-article partial HNSW indexes of earlier versions. Search
+    filters now match chunks through chunk_articles, which an index predicate
+    over chunks can't express, so they went unused.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+
+    Returns:
+        int: number of indexes dropped.
+    """
+    with Session(engine) as session:
+        with session.begin():
+            names = [
+                name
+                for index in EMBEDDING_INDEXES.values()
+                for name in session.scalars(
+                    text(
+                        "SELECT indexname FROM pg_indexes "
+                        "WHERE indexname LIKE :pattern"
+                    ),
+                    {"pattern": index["name"].replace("_", r"\_") + r"\_article\_%"},
+                )
+            ]
+            for name in names:
+                session.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    if names:
+        logger.info(f"Dropped {len(names)} partial indexes.")
+    return len(names)
+
+
+def create_embedding_index(
+    engine: Engine, mode: IndexMode = CONFIG["VECTOR_INDEX_MODE"]
+) -> None:
+    """
+    Create the HNSW index for the given storage mode, if it does not exist yet.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        mode (IndexMode, optional): the storage mode to index.
+            Defaults to CONFIG["VECTOR_INDEX_MODE"].
+    """
+    with Session(engine) as session:
+        with session.begin():
+            _create_index(session, EMBEDDING_INDEXES[mode]["name"], mode)
+
+
+def migrate_embedding_index(engine: Engine, mode: IndexMode) -> float:
+    """
+    Convert the chunks table to another storage mode: build the new index,
+    and drop the indexes of every other mode.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        mode (IndexMode): the storage mode to migrate to.
+
+    Returns:
+        float: index build time in seconds.
+    """
+    start = time.perf_counter()
+    create_embedding_index(engine, mode)
+    build_seconds = time.perf_counter() - start
+
+    with Session(engine) as session:
+        with session.begin():
+            for other_mode, index in EMBEDDING_INDEXES.items():
+                if other_mode == mode:
+                    continue
+                session.execute(text(f"DROP INDEX IF EXISTS {index['name']}"))
+
+    logger.info(f"Migrated chunks to '{mode}' storage in {build_seconds:.1f}s.")
+    return build_seconds
+
+
+def embedding_index_size(engine: Engine, mode: IndexMode) -> int:
+    """
+    Get the on-disk size of the index of a storage mode.
+
+    Args:
+        engine (Engine): SQLAlchemy engine for database operations.
+        mode (IndexMode): the storage mode.
+
+    Returns:
+        int: index size in bytes.
+    """
+    with Session(engine) as session:
+        return session.execute(
+            text("SELECT pg_relation_size(:name)"),
+            {"name": EMBEDDING_INDEXES[mode]["name"]},
+        ).scalar_one()
+
+
+if __name__ == "__main__":
+    from sqlFunctions import create_connection
+
+    parser = argparse.ArgumentParser(
+        description="Convert the chunks table to another vector storage mode."
+    )
+    parser.add_argument("mode", choices=list(EMBEDDING_INDEXES))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    engine = create_connection(force_rebuild=False)
+    seconds = migrate_embedding_index(engine, args.mode)
+    size = embedding_index_size(engine, args.mode)
+    print(f"Built '{args.mode}' index in {seconds:.1f}s ({size / 2**20:.1f} MiB).")
+    print(f"Set VECTOR_INDEX_MODE=\"{args.mode}\" in config.toml to search it.")
@@ -53,10 +53,16 @@ def init_state() -> None:
 
 def parse_context(context: list[dict]) -> str:
 
-    sources = [
-        f"['{chunk['title']}'](http://localhost:9090/{chunk['filename']}#page={chunk['start_page'] + 1})"
+    # A chunk found in several articles (e.g. a reprint) cites all of them
+    articles = [
+        article
         for chunk in context
-        if chunk.get("title") and chunk.get("authors")
+        for article in chunk.get("articles") or [chunk]
+    ]
+    sources = [
+        f"['{article['title']}'](http://localhost:9090/{article['filename']}#page={article['start_page'] + 1})"
+        for article in articles
+        if article.get("title") and article.get("authors")
     ]
 
     sources = set(sources)
@@ -130,6 +136,9 @@ def chatbot() -> None:
                         ),
                         "session_id": st.session_state["session_id"],
                     },
+                    # Below the client timeout, so the backend's 504 arrives
+                    # before the client gives up
+                    headers={"X-Request-Timeout": "110"},
                     timeout=120,
                 )
 
@@ -138,6 +147,11 @@ def chatbot() -> None:
                     st.session_state["context"] = response.json().get("context", [])
                     st.session_state["message_id"] = response.json().get("message_id")
 
+                elif response.status_code == 429:
+                    answer = (
+                        "MedChat is busy right now. Please try again in "
+                        f"{response.headers.get('Retry-After', 'a few')} seconds."
+                    )
                 else:
                     answer = (
                         "Sorry, I could not find an answer to that question."